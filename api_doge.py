@@ -13,6 +13,12 @@ from app.storage.mysql_manager import setup_database, engine, start_mysql_health
 from app.storage.redis_manager import setup_redis, close_redis, start_health_check
 from app.storage.milvus_manager import setup_milvus, close_milvus
 from app.memory.chat_history_manager import ChatHistory
+from app.llm.http_client import setup_llm_http_client, close_llm_http_client
+from app.llm.gateway import setup_llm_gateway, close_llm_gateway
+from app.llm.rate_limiter import setup_llm_rate_limiter, close_llm_rate_limiter
+from app.llm.response_cache import setup_llm_response_cache, close_llm_response_cache
+from app.prompts.prompts import memory_prompt_builder
+from app.memory.chat_write_pipeline import ChatWriteProducer, setup_chat_write_workers, close_chat_write_workers
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.exceptions import HTTPException
@@ -29,16 +35,36 @@ async def lifespan(app: FastAPI):
         app.state.redis_manager = await setup_redis()
         start_health_check(app)
 
+        # 启动时加载编码表，加载失败时prompt的token预算按字符估算
+        if not memory_prompt_builder.counter.exact:
+            app_logger.warning("Prompt tokenizer is unavailable, token budgets fall back to character estimates")
+
+        app.state.llm_http_client = await setup_llm_http_client()
+        app.state.llm_gateway = await setup_llm_gateway()
+        app.state.llm_rate_limiter = await setup_llm_rate_limiter(app.state.redis_manager)
+
         app.state.milvus_manager = await setup_milvus(
             settings.OPENAI_APIKEY,
             redis=app.state.redis_manager,
             host=settings.MILVUS_HOST,
             port=settings.MILVUS_PORT
         )
+        app.state.llm_response_cache = await setup_llm_response_cache(
+            app.state.redis_manager,
+            app.state.milvus_manager
+        )
+
+        chat_writer = ChatWriteProducer(app.state.redis_manager) if settings.CHAT_WRITE_PIPELINE_ENABLED else None
+        if chat_writer is not None and settings.CHAT_WRITE_WORKER_IN_PROCESS:
+            app.state.chat_write_workers = await setup_chat_write_workers(
+                app.state.redis_manager,
+                app.state.milvus_manager
+            )
 
         app.state.chat_history = ChatHistory(
             app.state.redis_manager,
-            app.state.milvus_manager
+            app.state.milvus_manager,
+            chat_writer=chat_writer
         )
 
         # 根据操作系统设置信号处理
@@ -66,8 +92,16 @@ async def graceful_shutdown(app: FastAPI, sig: signal.Signals = None):
     else:
         app_logger.info("Initiating graceful shutdown")
 
-    await close_redis(app)
+    if hasattr(app.state, 'chat_history'):
+        await app.state.chat_history.close()
+    await close_chat_write_workers(app)
+    await close_llm_response_cache(app)
+    await close_llm_rate_limiter(app)
+    await close_llm_gateway(app)
+    await close_llm_http_client(app)
+    # Milvus关闭时还要写Redis（embedding缓存、注册表访问时间），需先于Redis关闭
     await close_milvus(app)
+    await close_redis(app)
     await engine.dispose()
     await async_app_logger.info("Graceful shutdown completed")
 
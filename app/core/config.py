@@ -28,6 +28,16 @@ class Settings(BaseSettings):
     REDIS_PWD: Optional[str] = None if IS_LOCAL_DB else os.getenv("REDIS_PWD")
     REDIS_POOL_SIZE: int = int(os.getenv("REDIS_POOL_SIZE", 5))
     REDIS_TIMEOUT: int = int(os.getenv("REDIS_TIMEOUT", 30))
+    # Redis值编码：json为旧的纯文本格式（灰度期间兼容老版本），orjson/msgpack为带版本字节的二进制格式
+    REDIS_CODEC: str = os.getenv("REDIS_CODEC", "orjson")
+    REDIS_CODEC_COMPRESS_THRESHOLD: int = int(os.getenv("REDIS_CODEC_COMPRESS_THRESHOLD", 1024))
+    REDIS_CODEC_ZSTD_LEVEL: int = int(os.getenv("REDIS_CODEC_ZSTD_LEVEL", 3))
+    # 进程内近端缓存，通过pub/sub频道广播失效
+    REDIS_NEAR_CACHE_ENABLED: bool = os.getenv("REDIS_NEAR_CACHE_ENABLED", "no").lower() == "yes"
+    REDIS_NEAR_CACHE_SIZE: int = int(os.getenv("REDIS_NEAR_CACHE_SIZE", 10000))
+    REDIS_NEAR_CACHE_TTL: float = float(os.getenv("REDIS_NEAR_CACHE_TTL", 30))
+    REDIS_NEAR_CACHE_CHANNEL: str = os.getenv("REDIS_NEAR_CACHE_CHANNEL", "near_cache_invalidate")
+    REDIS_NEAR_CACHE_PREFIXES: str = os.getenv("REDIS_NEAR_CACHE_PREFIXES", "tw_recent_list_,tw_important_memories_,tw_imem_rec:")
 
     MYSQL_HOST: str = os.getenv("MYSQL_HOST", "")
     MYSQL_PORT: int = int(os.getenv("MYSQL_PORT", 0))
@@ -46,6 +56,89 @@ class Settings(BaseSettings):
     MILVUS_PORT: int = int(os.getenv("MILVUS_PORT", 0))
     MILVUS_URI: str = f"http://{MILVUS_HOST}:{MILVUS_PORT}"
     MILVUS_MAX_WORKERS: int = int(os.getenv("MILVUS_MAX_WORKERS", 50))
+    MILVUS_HANDLE_CACHE_SIZE: int = int(os.getenv("MILVUS_HANDLE_CACHE_SIZE", 2000))
+    MILVUS_HANDLE_CACHE_TTL: int = int(os.getenv("MILVUS_HANDLE_CACHE_TTL", 1800))
+    MILVUS_MAX_CONCURRENT_OPENS: int = int(os.getenv("MILVUS_MAX_CONCURRENT_OPENS", 8))
+    MILVUS_RELEASE_ON_EVICT: bool = os.getenv("MILVUS_RELEASE_ON_EVICT", "no").lower() == "yes"
+    # 句柄淘汰后，所有worker都超过这么久未访问才release（秒），需大于MILVUS_REGISTRY_TOUCH_INTERVAL
+    MILVUS_RELEASE_IDLE_SECONDS: float = float(os.getenv("MILVUS_RELEASE_IDLE_SECONDS", 3600))
+    # 蓝绿重建切换alias后，延迟多久删除旧版本collection（秒）
+    MILVUS_REBUILD_DROP_DELAY: float = float(os.getenv("MILVUS_REBUILD_DROP_DELAY", 30))
+    # 同名collection的重建跨worker互斥：锁的过期时间（持有期间自动续期）和最长等待时间（秒）
+    MILVUS_REBUILD_LOCK_TTL: float = float(os.getenv("MILVUS_REBUILD_LOCK_TTL", 30))
+    MILVUS_REBUILD_LOCK_WAIT: float = float(os.getenv("MILVUS_REBUILD_LOCK_WAIT", 600))
+    # 重建期间追加的数据先记在Redis list中，重建结束后写入新版本；重建进程异常退出时该list按此过期（秒）
+    MILVUS_REBUILD_JOURNAL_TTL: int = int(os.getenv("MILVUS_REBUILD_JOURNAL_TTL", 86400))
+    # 重建拿到锁后等待已开始的追加写完的最长时间（秒），也是in-flight计数的过期时间
+    MILVUS_REBUILD_APPEND_WAIT: float = float(os.getenv("MILVUS_REBUILD_APPEND_WAIT", 60))
+    # collection注册表：Redis hash + changelog，本地Bloom filter判定不存在的collection
+    MILVUS_REGISTRY_KEY: str = os.getenv("MILVUS_REGISTRY_KEY", "milvus_collection_registry")
+    MILVUS_REGISTRY_REFRESH_INTERVAL: float = float(os.getenv("MILVUS_REGISTRY_REFRESH_INTERVAL", 1))
+    MILVUS_REGISTRY_FULL_RELOAD_INTERVAL: float = float(os.getenv("MILVUS_REGISTRY_FULL_RELOAD_INTERVAL", 3600))
+    MILVUS_REGISTRY_LOG_MAX: int = int(os.getenv("MILVUS_REGISTRY_LOG_MAX", 100_000))
+    MILVUS_REGISTRY_BLOOM_CAPACITY: int = int(os.getenv("MILVUS_REGISTRY_BLOOM_CAPACITY", 1_000_000))
+    MILVUS_REGISTRY_BLOOM_ERROR_RATE: float = float(os.getenv("MILVUS_REGISTRY_BLOOM_ERROR_RATE", 0.001))
+    MILVUS_REGISTRY_CACHE_SIZE: int = int(os.getenv("MILVUS_REGISTRY_CACHE_SIZE", 20000))
+    MILVUS_REGISTRY_TOUCH_INTERVAL: float = float(os.getenv("MILVUS_REGISTRY_TOUCH_INTERVAL", 300))
+    # thread: langchain Milvus + 线程池；async: pymilvus AsyncMilvusClient原生异步
+    MILVUS_CLIENT_MODE: str = os.getenv("MILVUS_CLIENT_MODE", "thread")
+    MILVUS_ASYNC_MAX_CONCURRENCY: int = int(os.getenv("MILVUS_ASYNC_MAX_CONCURRENCY", 64))
+    MILVUS_ASYNC_MAX_QUEUE: int = int(os.getenv("MILVUS_ASYNC_MAX_QUEUE", 1000))
+    MILVUS_ASYNC_TIMEOUT: float = float(os.getenv("MILVUS_ASYNC_TIMEOUT", 10))
+    MILVUS_EMBEDDING_DIM: int = int(os.getenv("MILVUS_EMBEDDING_DIM", 1536))
+    # collection: 每个(user, character)一个collection；shared: 共享collection + partition key过滤
+    MILVUS_STORAGE_MODE: str = os.getenv("MILVUS_STORAGE_MODE", "collection")
+    MILVUS_SHARED_CHAT_COLLECTION: str = os.getenv("MILVUS_SHARED_CHAT_COLLECTION", "chat_history_shared")
+    MILVUS_SHARED_SOCIAL_COLLECTION: str = os.getenv("MILVUS_SHARED_SOCIAL_COLLECTION", "character_social_shared")
+    MILVUS_SHARED_NUM_PARTITIONS: int = int(os.getenv("MILVUS_SHARED_NUM_PARTITIONS", 64))
+    # save_social按chunk内容哈希增量更新，不再drop后全量重建
+    SOCIAL_INCREMENTAL_UPDATE: bool = os.getenv("SOCIAL_INCREMENTAL_UPDATE", "yes").lower() == "yes"
+    # 增量更新的跨worker锁：过期时间（持有期间自动续期）和最长等待时间（秒）
+    SOCIAL_INDEX_LOCK_TTL: float = float(os.getenv("SOCIAL_INDEX_LOCK_TTL", 30))
+    SOCIAL_INDEX_LOCK_WAIT: float = float(os.getenv("SOCIAL_INDEX_LOCK_WAIT", 120))
+
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", 20000))
+    EMBEDDING_CACHE_TTL: int = int(os.getenv("EMBEDDING_CACHE_TTL", 7 * 24 * 3600))
+    EMBEDDING_CACHE_REDIS_TIMEOUT: float = float(os.getenv("EMBEDDING_CACHE_REDIS_TIMEOUT", 0.2))
+
+    MILVUS_SEARCH_BATCH_ENABLED: bool = os.getenv("MILVUS_SEARCH_BATCH_ENABLED", "yes").lower() == "yes"
+    MILVUS_SEARCH_BATCH_WINDOW_MS: float = float(os.getenv("MILVUS_SEARCH_BATCH_WINDOW_MS", 3))
+    MILVUS_SEARCH_BATCH_MAX_SIZE: int = int(os.getenv("MILVUS_SEARCH_BATCH_MAX_SIZE", 64))
+
+    # 聊天记录写入Milvus的异步管道（Redis Streams）
+    CHAT_WRITE_PIPELINE_ENABLED: bool = os.getenv("CHAT_WRITE_PIPELINE_ENABLED", "yes").lower() == "yes"
+    CHAT_WRITE_WORKER_IN_PROCESS: bool = os.getenv("CHAT_WRITE_WORKER_IN_PROCESS", "yes").lower() == "yes"
+    CHAT_WRITE_WORKERS: int = int(os.getenv("CHAT_WRITE_WORKERS", 1))
+    CHAT_WRITE_STREAM: str = os.getenv("CHAT_WRITE_STREAM", "chat_write_stream")
+    CHAT_WRITE_DLQ_STREAM: str = os.getenv("CHAT_WRITE_DLQ_STREAM", "chat_write_stream_dlq")
+    CHAT_WRITE_GROUP: str = os.getenv("CHAT_WRITE_GROUP", "chat_write_workers")
+    CHAT_WRITE_STREAM_MAXLEN: int = int(os.getenv("CHAT_WRITE_STREAM_MAXLEN", 1_000_000))
+    CHAT_WRITE_BATCH_SIZE: int = int(os.getenv("CHAT_WRITE_BATCH_SIZE", 64))
+    CHAT_WRITE_BLOCK_MS: int = int(os.getenv("CHAT_WRITE_BLOCK_MS", 1000))
+    CHAT_WRITE_CLAIM_IDLE_MS: int = int(os.getenv("CHAT_WRITE_CLAIM_IDLE_MS", 60_000))
+    CHAT_WRITE_MAX_DELIVERIES: int = int(os.getenv("CHAT_WRITE_MAX_DELIVERIES", 5))
+
+    # 重要记忆更新调度：按(user, character)合并多轮对话后再调用LLM
+    MEMORY_UPDATE_SCHEDULER_ENABLED: bool = os.getenv("MEMORY_UPDATE_SCHEDULER_ENABLED", "yes").lower() == "yes"
+    MEMORY_UPDATE_DEBOUNCE_SECONDS: float = float(os.getenv("MEMORY_UPDATE_DEBOUNCE_SECONDS", 20))
+    MEMORY_UPDATE_MAX_TURNS: int = int(os.getenv("MEMORY_UPDATE_MAX_TURNS", 5))
+    MEMORY_UPDATE_MAX_WAIT_SECONDS: float = float(os.getenv("MEMORY_UPDATE_MAX_WAIT_SECONDS", 120))
+    MEMORY_UPDATE_MIN_CHARS: int = int(os.getenv("MEMORY_UPDATE_MIN_CHARS", 2))
+    MEMORY_UPDATE_MAX_CONCURRENCY: int = int(os.getenv("MEMORY_UPDATE_MAX_CONCURRENCY", 16))
+    # 结构化重要记忆：prompt中只放top-k条，总数超过上限时淘汰重要度最低的
+    MEMORY_RECORDS_TOP_K: int = int(os.getenv("MEMORY_RECORDS_TOP_K", 15))
+    MEMORY_RECORDS_MAX: int = int(os.getenv("MEMORY_RECORDS_MAX", 200))
+    MEMORY_IMPORTANCE_DEFAULT: float = float(os.getenv("MEMORY_IMPORTANCE_DEFAULT", 0.5))
+    MEMORY_IMPORTANCE_REINFORCE: float = float(os.getenv("MEMORY_IMPORTANCE_REINFORCE", 0.1))
+    MEMORY_IMPORTANCE_WEIGHT: float = float(os.getenv("MEMORY_IMPORTANCE_WEIGHT", 0.2))
+    # 流式调用，updated_important_memories完整后提前结束；精简模式不要求输出thought_process
+    MEMORY_UPDATE_STREAMING: bool = os.getenv("MEMORY_UPDATE_STREAMING", "yes").lower() == "yes"
+    MEMORY_UPDATE_LEAN_OUTPUT: bool = os.getenv("MEMORY_UPDATE_LEAN_OUTPUT", "no").lower() == "yes"
+    # build_context并发读取各来源的总时限（秒），超时的来源本轮不等待
+    CHAT_CONTEXT_DEADLINE: float = float(os.getenv("CHAT_CONTEXT_DEADLINE", 1.5))
+    CHAT_CONTEXT_LONG_CHAT_K: int = int(os.getenv("CHAT_CONTEXT_LONG_CHAT_K", 3))
+    CHAT_CONTEXT_SOCIAL_K: int = int(os.getenv("CHAT_CONTEXT_SOCIAL_K", 3))
+    CHAT_CONTEXT_SCORE_THRESHOLD: float = float(os.getenv("CHAT_CONTEXT_SCORE_THRESHOLD", 0.6))
 
     LOCAL_PROXY_TYPE: str = os.getenv("LOCAL_PROXY_TYPE", "socks5")
     LOCAL_PROXY_PORT: int = int(os.getenv("LOCAL_PROXY_PORT", 8080))
@@ -57,10 +150,58 @@ class Settings(BaseSettings):
     PROXY_HTTP_CLIENT: Optional[httpx.Client] = None
     HTTP_CLIENT: Optional[httpx.Client] = None
 
+    # 模型调用共用的HTTP连接池
+    LLM_HTTP_MAX_CONNECTIONS: int = int(os.getenv("LLM_HTTP_MAX_CONNECTIONS", 100))
+    LLM_HTTP_MAX_KEEPALIVE: int = int(os.getenv("LLM_HTTP_MAX_KEEPALIVE", 20))
+    LLM_HTTP_KEEPALIVE_EXPIRY: float = float(os.getenv("LLM_HTTP_KEEPALIVE_EXPIRY", 60))
+    LLM_HTTP_TIMEOUT: float = float(os.getenv("LLM_HTTP_TIMEOUT", 40))
+    LLM_HTTP_CONNECT_TIMEOUT: float = float(os.getenv("LLM_HTTP_CONNECT_TIMEOUT", 10))
+    LLM_HTTP2: bool = os.getenv("LLM_HTTP2", "no").lower() == "yes"
+    # 出站LLM限流（额度取MAX_REQUESTS_PER_MINUTE / MAX_TOKENS_PER_MINUTE）
+    LLM_RATE_LIMIT_ENABLED: bool = os.getenv("LLM_RATE_LIMIT_ENABLED", "yes").lower() == "yes"
+    LLM_RATE_LIMIT_SHARED: bool = os.getenv("LLM_RATE_LIMIT_SHARED", "no").lower() == "yes"
+    LLM_RATE_LIMIT_REDIS_PREFIX: str = os.getenv("LLM_RATE_LIMIT_REDIS_PREFIX", "llm_rate_limit")
+    LLM_RATE_LIMIT_BURST_SECONDS: float = float(os.getenv("LLM_RATE_LIMIT_BURST_SECONDS", 10))
+    LLM_RATE_LIMIT_TIMEOUT: float = float(os.getenv("LLM_RATE_LIMIT_TIMEOUT", 20))
+    LLM_RATE_LIMIT_BACKGROUND_TIMEOUT: float = float(os.getenv("LLM_RATE_LIMIT_BACKGROUND_TIMEOUT", 120))
+    LLM_RATE_LIMIT_429_PAUSE: float = float(os.getenv("LLM_RATE_LIMIT_429_PAUSE", 5))
+
+    # LLM响应缓存：endpoint:ttl列表按endpoint开启，语义匹配需单独开启
+    LLM_RESPONSE_CACHE_ENABLED: bool = os.getenv("LLM_RESPONSE_CACHE_ENABLED", "yes").lower() == "yes"
+    LLM_RESPONSE_CACHE_ENDPOINTS: str = os.getenv("LLM_RESPONSE_CACHE_ENDPOINTS", "memory_update:3600")
+    LLM_RESPONSE_CACHE_SEMANTIC_ENDPOINTS: str = os.getenv("LLM_RESPONSE_CACHE_SEMANTIC_ENDPOINTS", "")
+    LLM_RESPONSE_CACHE_TTL: int = int(os.getenv("LLM_RESPONSE_CACHE_TTL", 3600))
+    LLM_RESPONSE_CACHE_PREFIX: str = os.getenv("LLM_RESPONSE_CACHE_PREFIX", "llm_resp")
+    LLM_RESPONSE_CACHE_SEMANTIC_COLLECTION: str = os.getenv("LLM_RESPONSE_CACHE_SEMANTIC_COLLECTION",
+                                                           "llm_response_cache")
+    # 语义匹配的余弦相似度阈值
+    LLM_RESPONSE_CACHE_SEMANTIC_THRESHOLD: float = float(os.getenv("LLM_RESPONSE_CACHE_SEMANTIC_THRESHOLD", 0.95))
+    LLM_RESPONSE_CACHE_SEMANTIC_MAX_CHARS: int = int(os.getenv("LLM_RESPONSE_CACHE_SEMANTIC_MAX_CHARS", 6000))
+
+    # 记忆更新prompt的token预算，超出时按段落优先级截断
+    MEMORY_PROMPT_TOKEN_BUDGET: int = int(os.getenv("MEMORY_PROMPT_TOKEN_BUDGET", 6000))
+    PROMPT_TOKENIZER_ENCODING: str = os.getenv("PROMPT_TOKENIZER_ENCODING", "o200k_base")
+
     OPENAI_APIKEY: str = os.getenv("OPENAI_APIKEY", "")
     CLAUDE_API_KEY: str = os.getenv("CLAUDE_API_KEY", "")
     GROK_API_KEY: str = os.getenv("GROK_API_KEY", "")
     BASE_URL: str = os.getenv("BASE_URL", "")
+    # 模型网关：provider顺序即failover顺序，base_url可替换为本地假服务做测试
+    OPENAI_BASE_URL: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+    GROK_BASE_URL: str = os.getenv("GROK_BASE_URL", "https://api.x.ai/v1")
+    CLAUDE_BASE_URL: str = os.getenv("CLAUDE_BASE_URL", "https://api.anthropic.com/v1")
+    LLM_GATEWAY_PROVIDERS: str = os.getenv("LLM_GATEWAY_PROVIDERS", "openai,grok,claude")
+    LLM_GATEWAY_MODELS: str = os.getenv("LLM_GATEWAY_MODELS",
+                                        "openai=gpt-4o-mini,grok=grok-2-latest,claude=claude-3-5-haiku-latest")
+    LLM_GATEWAY_TIMEOUT: float = float(os.getenv("LLM_GATEWAY_TIMEOUT", 30))
+    LLM_GATEWAY_HEDGE: bool = os.getenv("LLM_GATEWAY_HEDGE", "no").lower() == "yes"
+    LLM_GATEWAY_MAX_HEDGES: int = int(os.getenv("LLM_GATEWAY_MAX_HEDGES", 1))
+    LLM_GATEWAY_HEDGE_DEFAULT_DELAY: float = float(os.getenv("LLM_GATEWAY_HEDGE_DEFAULT_DELAY", 8))
+    LLM_GATEWAY_MIN_SAMPLES: int = int(os.getenv("LLM_GATEWAY_MIN_SAMPLES", 20))
+    LLM_GATEWAY_LATENCY_WINDOW: int = int(os.getenv("LLM_GATEWAY_LATENCY_WINDOW", 200))
+    LLM_GATEWAY_FAILURE_THRESHOLD: int = int(os.getenv("LLM_GATEWAY_FAILURE_THRESHOLD", 3))
+    LLM_GATEWAY_CIRCUIT_COOLDOWN: float = float(os.getenv("LLM_GATEWAY_CIRCUIT_COOLDOWN", 10))
+    LLM_GATEWAY_MAX_COOLDOWN: float = float(os.getenv("LLM_GATEWAY_MAX_COOLDOWN", 300))
     TTS_URL: str = os.getenv("TTS_URL", "")
     CRYPTO_AGENT_BASEURL: str = os.getenv("CRYPTO_AGENT_BASEURL", "http://13.212.37.80:8000")
 
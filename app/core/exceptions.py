@@ -44,7 +44,8 @@ class ModelError(DogeAgentError):
     """AI模型相关错误的基类"""
 
     def __init__(self, message: str, **kwargs):
-        super().__init__(message, error_code="MODEL_ERROR", **kwargs)
+        kwargs.setdefault("error_code", "MODEL_ERROR")
+        super().__init__(message, **kwargs)
 
 
 class GrokAPIError(ModelError):
@@ -65,7 +66,7 @@ class ModelTimeoutError(ModelError):
     """模型调用超时"""
 
     def __init__(self, message: str, timeout: int, **kwargs):
-        details = kwargs.get("details", {})
+        details = kwargs.pop("details", {})
         details["timeout_seconds"] = timeout
         super().__init__(message, error_code="MODEL_TIMEOUT", details=details, **kwargs)
 
@@ -139,7 +140,8 @@ class DatabaseError(DogeAgentError):
     """数据库相关错误的基类"""
 
     def __init__(self, message: str, **kwargs):
-        super().__init__(message, error_code="DB_ERROR", **kwargs)
+        kwargs.setdefault("error_code", "DB_ERROR")
+        super().__init__(message, **kwargs)
 
 
 class MySQLError(DatabaseError):
@@ -162,6 +164,16 @@ class RedisError(DatabaseError):
         super().__init__(message, error_code="REDIS_ERROR", details=details, **kwargs)
 
 
+class MilvusError(DatabaseError):
+    """Milvus错误"""
+
+    def __init__(self, message: str, operation: Optional[str] = None, **kwargs):
+        details = kwargs.pop("details", {})
+        if operation:
+            details["operation"] = operation
+        super().__init__(message, error_code="MILVUS_ERROR", details=details, **kwargs)
+
+
 # Input/Validation Related Exceptions
 class ValidationError(DogeAgentError):
     """输入验证错误"""
@@ -195,7 +207,7 @@ class RateLimitError(DogeAgentError):
             reset_time: Optional[datetime] = None,
             **kwargs
     ):
-        details = kwargs.get("details", {})
+        details = kwargs.pop("details", {})
         details.update({
             "limit": limit,
             "reset_time": reset_time.isoformat() if reset_time else None
@@ -0,0 +1,176 @@
+# app/llm/fake_provider.py
+"""
+本地的假OpenAI兼容provider，按脚本依次返回指定的状态码、延迟和内容，支持SSE流式返回。
+把OPENAI_BASE_URL/GROK_BASE_URL指向它即可在本地演练网关的切换、429透传和hedging。
+
+python -m app.llm.fake_provider --port 18080 [--status 200] [--delay 0] [--content ok]
+python -m app.llm.fake_provider --check   # 起几个假服务跑一遍网关的关键路径
+"""
+import argparse
+import asyncio
+import json
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from app.core.config import settings
+from app.core.exceptions import RateLimitError
+from app.llm.gateway import LLMGateway, OpenAICompatibleAdapter
+from app.llm.http_client import LLMHttpClient
+
+
+class Step:
+    """一次调用的返回方式，脚本用完后重复最后一步"""
+    __slots__ = ("status", "delay", "content", "retry_after")
+
+    def __init__(self, status: int = 200, delay: float = 0.0, content: str = "ok",
+                 retry_after: Optional[float] = None):
+        self.status = status
+        self.delay = delay
+        self.content = content
+        self.retry_after = retry_after
+
+
+class FakeProvider:
+    def __init__(self, steps: List[Step] = None, host: str = "127.0.0.1", port: int = 0):
+        self.steps = steps or [Step()]
+        self.host = host
+        self.port = port
+        self.calls = 0
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def _next_step(self) -> Step:
+        step = self.steps[min(self.calls, len(self.steps) - 1)]
+        self.calls += 1
+        return step
+
+    async def _chat(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        step = self._next_step()
+        if step.delay:
+            await asyncio.sleep(step.delay)
+        if step.status != 200:
+            headers = {"Retry-After": str(step.retry_after)} if step.retry_after is not None else None
+            return web.json_response({"error": {"message": f"fake status {step.status}"}},
+                                     status=step.status, headers=headers)
+        if not body.get("stream"):
+            return web.json_response({
+                "id": f"fake-{self.calls}",
+                "object": "chat.completion",
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": step.content},
+                             "finish_reason": "stop"}],
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in step.content.split(" "):
+            chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def start(self) -> "FakeProvider":
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def run_checks() -> Dict[str, bool]:
+    """起假服务验证网关：5xx切换、429透传retry-after、慢provider触发hedging、流式提前退出也计为成功"""
+    messages = [{"role": "user", "content": "hi"}]
+    results: Dict[str, bool] = {}
+    http_client = LLMHttpClient(http2=False)
+    providers: List[FakeProvider] = []
+
+    async def gateway(*scripts: List[Step], hedge: bool = False) -> LLMGateway:
+        adapters = []
+        for i, steps in enumerate(scripts):
+            provider = await FakeProvider(steps).start()
+            providers.append(provider)
+            adapters.append(OpenAICompatibleAdapter("fake-key", provider.base_url, "fake-model",
+                                                    timeout=5, name=f"fake{i}"))
+        return LLMGateway(adapters=adapters, http_client=http_client, hedge=hedge)
+
+    default_delay = settings.LLM_GATEWAY_HEDGE_DEFAULT_DELAY
+    try:
+        gw = await gateway([Step(status=500)], [Step(content="from fallback")])
+        response = await gw.chat(messages)
+        results["failover"] = (response["choices"][0]["message"]["content"] == "from fallback"
+                               and gw.failovers == 1 and gw.health["fake0"].consecutive_failures == 1)
+
+        gw = await gateway([Step(status=429, retry_after=7)], [Step(status=429, retry_after=3)])
+        try:
+            await gw.chat(messages)
+            results["rate_limit_passthrough"] = False
+        except RateLimitError as e:
+            results["rate_limit_passthrough"] = e.details.get("retry_after") == 3
+
+        settings.LLM_GATEWAY_HEDGE_DEFAULT_DELAY = 0.2
+        gw = await gateway([Step(delay=2, content="slow")], [Step(content="fast")], hedge=True)
+        response = await gw.chat(messages)
+        results["hedging"] = (response["choices"][0]["message"]["content"] == "fast"
+                              and gw.health["fake0"].hedged == 1 and gw.health["fake1"].hedge_wins == 1)
+
+        gw = await gateway([Step(status=500), Step(content="one two three")])
+        try:
+            await gw.chat(messages)
+        except Exception:
+            pass
+        async for _ in gw.stream_chat(messages):
+            break
+        results["stream_success"] = gw.health["fake0"].consecutive_failures == 0
+    finally:
+        settings.LLM_GATEWAY_HEDGE_DEFAULT_DELAY = default_delay
+        for provider in providers:
+            await provider.stop()
+        await http_client.close()
+    return results
+
+
+async def serve(args):
+    provider = await FakeProvider([Step(args.status, args.delay, args.content, args.retry_after)],
+                                  port=args.port).start()
+    print(f"fake provider listening on {provider.base_url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await provider.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible provider for gateway drills")
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--status", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=0.0)
+    parser.add_argument("--content", default="ok")
+    parser.add_argument("--retry-after", type=float, default=None)
+    args = parser.parse_args()
+
+    if not args.check:
+        asyncio.run(serve(args))
+        return
+    results = asyncio.run(run_checks())
+    for name, ok in results.items():
+        print(f"{name:<24}{'ok' if ok else 'FAILED'}")
+    if not all(results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
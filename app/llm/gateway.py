@@ -0,0 +1,456 @@
+# app/llm/gateway.py
+"""
+多provider的模型网关：OpenAI兼容接口（OpenAI、Grok）和Claude的适配器，统一返回OpenAI格式的响应。
+按配置顺序选择健康的provider，失败自动切换到下一个；连续失败的provider熔断一段时间。
+开启hedging时，主provider超过其p95延迟仍未返回，就并发请求下一个provider，取先成功的结果。
+各provider的base_url可通过配置替换，便于对接本地的假服务测试。
+"""
+import asyncio
+import json
+import time
+from collections import deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Type
+
+import httpx
+
+from app.core.config import settings
+from app.core.exceptions import GrokAPIError, ModelError, ModelTimeoutError, RateLimitError
+from app.core.logger import app_logger, async_error_logger
+from app.llm.http_client import LLMHttpClient, get_llm_http_client
+
+
+class ProviderError(Exception):
+    """单个provider调用失败，网关据此决定是否切换以及是否计入健康统计"""
+
+    def __init__(self, provider: str, message: str, status_code: Optional[int] = None,
+                 retry_after: Optional[float] = None, timeout: bool = False):
+        super().__init__(f"{provider}: {message}")
+        self.provider = provider
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.timeout = timeout
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.status_code == 429
+
+    @property
+    def provider_fault(self) -> bool:
+        # 请求本身有问题（400/404/422等）不算provider不健康
+        return self.status_code is None or self.status_code >= 500 or self.status_code in (401, 403, 408, 429)
+
+
+class ProviderAdapter:
+    name = "base"
+    error_class: Type[ModelError] = ModelError
+
+    def __init__(self, api_key: str, base_url: str, model: str, timeout: float = None):
+        self.api_key = api_key
+        self.base_url = base_url.rstrip("/")
+        self.model = model
+        self.timeout = timeout or settings.LLM_GATEWAY_TIMEOUT
+
+    def build_request(self, messages: List[Dict], model: str, params: Dict) -> Tuple[str, Dict, Dict]:
+        raise NotImplementedError
+
+    def parse_response(self, body: Dict) -> Dict:
+        raise NotImplementedError
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        """解析一行SSE，返回增量文本，没有文本时返回None"""
+        raise NotImplementedError
+
+
+class OpenAICompatibleAdapter(ProviderAdapter):
+    name = "openai"
+
+    def __init__(self, api_key: str, base_url: str, model: str, timeout: float = None, name: str = None,
+                 error_class: Type[ModelError] = None):
+        super().__init__(api_key, base_url, model, timeout)
+        self.name = name or self.name
+        self.error_class = error_class or self.error_class
+
+    def build_request(self, messages: List[Dict], model: str, params: Dict) -> Tuple[str, Dict, Dict]:
+        headers = {"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+        return f"{self.base_url}/chat/completions", headers, dict(params, model=model, messages=messages)
+
+    def parse_response(self, body: Dict) -> Dict:
+        return body
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        if not line.startswith("data:"):
+            return None
+        payload = line[5:].strip()
+        if not payload or payload == "[DONE]":
+            return None
+        choices = json.loads(payload).get("choices") or [{}]
+        return (choices[0].get("delta") or {}).get("content")
+
+
+class ClaudeAdapter(ProviderAdapter):
+    name = "claude"
+    api_version = "2023-06-01"
+
+    def build_request(self, messages: List[Dict], model: str, params: Dict) -> Tuple[str, Dict, Dict]:
+        headers = {"Content-Type": "application/json", "x-api-key": self.api_key,
+                   "anthropic-version": self.api_version}
+        system = [m["content"] for m in messages if m.get("role") == "system"]
+        if (params.get("response_format") or {}).get("type") == "json_object":
+            # Claude没有response_format参数，改用指令约束输出
+            system.append("只输出一个合法的JSON对象，不要输出其他内容。")
+        data = {
+            "model": model,
+            "messages": [m for m in messages if m.get("role") != "system"],
+            "max_tokens": params.get("max_tokens") or 4096,
+        }
+        if system:
+            data["system"] = "\n\n".join(system)
+        if "temperature" in params:
+            data["temperature"] = params["temperature"]
+        if params.get("stream"):
+            data["stream"] = True
+        return f"{self.base_url}/messages", headers, data
+
+    def parse_stream_line(self, line: str) -> Optional[str]:
+        if not line.startswith("data:"):
+            return None
+        event = json.loads(line[5:].strip() or "{}")
+        if event.get("type") == "content_block_delta":
+            return (event.get("delta") or {}).get("text")
+        return None
+
+    def parse_response(self, body: Dict) -> Dict:
+        text = "".join(block.get("text", "") for block in body.get("content", []) if block.get("type") == "text")
+        usage = body.get("usage", {})
+        prompt_tokens, completion_tokens = usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+        return {
+            "id": body.get("id"),
+            "model": body.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                         "finish_reason": body.get("stop_reason")}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                      "total_tokens": prompt_tokens + completion_tokens},
+        }
+
+
+class ProviderHealth:
+    def __init__(self, window: int = None):
+        self.latencies = deque(maxlen=window or settings.LLM_GATEWAY_LATENCY_WINDOW)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.rate_limited = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def available(self, now: float) -> bool:
+        # 熔断到期后放行请求试探，再失败会立刻重新熔断
+        return now >= self.open_until
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < settings.LLM_GATEWAY_MIN_SAMPLES:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def record_success(self, latency: Optional[float]):
+        # 流式调用的总耗时取决于输出长度，不计入p95
+        if latency is not None:
+            self.latencies.append(latency)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def record_failure(self, error: ProviderError):
+        self.failures += 1
+        self.timeouts += error.timeout
+        if error.rate_limited:
+            self.rate_limited += 1
+            self.open_until = max(self.open_until,
+                                  time.monotonic() + (error.retry_after or settings.LLM_GATEWAY_CIRCUIT_COOLDOWN))
+            return
+        self.consecutive_failures += 1
+        excess = self.consecutive_failures - settings.LLM_GATEWAY_FAILURE_THRESHOLD
+        if excess >= 0:
+            cooldown = min(settings.LLM_GATEWAY_CIRCUIT_COOLDOWN * 2 ** excess, settings.LLM_GATEWAY_MAX_COOLDOWN)
+            self.open_until = time.monotonic() + cooldown
+
+    def stats(self) -> Dict:
+        now = time.monotonic()
+        return {
+            "available": self.available(now),
+            "open_for": max(0.0, self.open_until - now),
+            "requests": self.requests,
+            "failures": self.failures,
+            "timeouts": self.timeouts,
+            "rate_limited": self.rate_limited,
+            "consecutive_failures": self.consecutive_failures,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+        }
+
+
+def build_adapters() -> List[ProviderAdapter]:
+    """按LLM_GATEWAY_PROVIDERS的顺序创建适配器，没有配置api key的provider跳过"""
+    models = dict(item.split("=", 1) for item in settings.LLM_GATEWAY_MODELS.split(",") if "=" in item)
+    factories = {
+        "openai": lambda: OpenAICompatibleAdapter(settings.OPENAI_APIKEY, settings.OPENAI_BASE_URL,
+                                                  models.get("openai", "gpt-4o-mini")),
+        "grok": lambda: OpenAICompatibleAdapter(settings.GROK_API_KEY, settings.GROK_BASE_URL,
+                                                models.get("grok", "grok-2-latest"), name="grok",
+                                                error_class=GrokAPIError),
+        "claude": lambda: ClaudeAdapter(settings.CLAUDE_API_KEY, settings.CLAUDE_BASE_URL,
+                                        models.get("claude", "claude-3-5-haiku-latest")),
+    }
+    adapters = []
+    for name in settings.LLM_GATEWAY_PROVIDERS.split(","):
+        name = name.strip()
+        if name not in factories:
+            if name:
+                app_logger.warning(f"Unknown LLM provider in LLM_GATEWAY_PROVIDERS: {name}")
+            continue
+        adapter = factories[name]()
+        if adapter.api_key:
+            adapters.append(adapter)
+    return adapters
+
+
+class LLMGateway:
+    def __init__(self, adapters: List[ProviderAdapter] = None, http_client: Optional[LLMHttpClient] = None,
+                 hedge: bool = None):
+        self.adapters = adapters if adapters is not None else build_adapters()
+        self.http_client = http_client
+        self.hedge = settings.LLM_GATEWAY_HEDGE if hedge is None else hedge
+        self.health: Dict[str, ProviderHealth] = {adapter.name: ProviderHealth() for adapter in self.adapters}
+
+        self.requests = 0
+        self.failovers = 0
+        self.exhausted = 0
+
+    def _candidates(self) -> List[ProviderAdapter]:
+        now = time.monotonic()
+        available = [adapter for adapter in self.adapters if self.health[adapter.name].available(now)]
+        if available:
+            return available
+        # 全部熔断时按最早恢复的顺序尝试，不直接失败
+        return sorted(self.adapters, key=lambda adapter: self.health[adapter.name].open_until)
+
+    def _hedge_delay(self, adapter: ProviderAdapter) -> float:
+        p95 = self.health[adapter.name].percentile(0.95)
+        return p95 if p95 is not None else settings.LLM_GATEWAY_HEDGE_DEFAULT_DELAY
+
+    async def _call(self, adapter: ProviderAdapter, messages: List[Dict], model: str, params: Dict) -> Dict:
+        health = self.health[adapter.name]
+        health.requests += 1
+        url, headers, data = adapter.build_request(messages, model, params)
+        client = self.http_client or get_llm_http_client()
+        start = time.monotonic()
+        try:
+            response = await client.post(url, headers=headers, json=data, timeout=adapter.timeout)
+        except httpx.TimeoutException as e:
+            raise ProviderError(adapter.name, f"timed out after {adapter.timeout}s: {e!r}", timeout=True)
+        except httpx.HTTPError as e:
+            raise ProviderError(adapter.name, f"http error: {e!r}")
+        if response.status_code != 200:
+            raise ProviderError(adapter.name, f"status {response.status_code}, content: {response.text[:500]}",
+                                status_code=response.status_code, retry_after=self._retry_after(response))
+        try:
+            result = adapter.parse_response(response.json())
+        except (ValueError, KeyError, TypeError) as e:
+            raise ProviderError(adapter.name, f"invalid response body: {e!r}")
+        health.record_success(time.monotonic() - start)
+        result["provider"] = adapter.name
+        return result
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        if response.status_code != 429:
+            return None
+        try:
+            return float(response.headers.get("retry-after") or 0) or None
+        except ValueError:
+            return None
+
+    async def chat(self, messages: List[Dict], params: Dict = None, models: Dict[str, str] = None,
+                   hedge: bool = None) -> Dict:
+        """
+        params为OpenAI格式的请求参数（temperature、max_tokens、response_format等），
+        models可按provider覆盖默认模型。返回OpenAI格式的响应，额外带provider字段
+        """
+        if not self.adapters:
+            raise ModelError("No LLM provider configured", details={"providers": settings.LLM_GATEWAY_PROVIDERS})
+        self.requests += 1
+        params = params or {}
+        models = models or {}
+        hedge = self.hedge if hedge is None else hedge
+        candidates = self._candidates()
+        pending: Dict[asyncio.Task, ProviderAdapter] = {}
+        errors: List[ProviderError] = []
+        hedges_left = settings.LLM_GATEWAY_MAX_HEDGES if hedge else 0
+        next_index = 0
+
+        def launch() -> ProviderAdapter:
+            nonlocal next_index
+            adapter = candidates[next_index]
+            next_index += 1
+            task = asyncio.create_task(self._call(adapter, messages, models.get(adapter.name, adapter.model), params))
+            pending[task] = adapter
+            return adapter
+
+        primary = launch()
+        try:
+            while pending:
+                wait_timeout = None
+                if hedges_left and next_index < len(candidates) and len(pending) == 1:
+                    wait_timeout = self._hedge_delay(primary)
+                done, _ = await asyncio.wait(pending, timeout=wait_timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # 主请求超过p95仍未返回，再发一个provider，谁先成功用谁
+                    hedges_left -= 1
+                    self.health[primary.name].hedged += 1
+                    launch()
+                    continue
+                winner = None
+                for task in done:
+                    adapter = pending.pop(task)
+                    error = task.exception()
+                    if error is None:
+                        winner = winner or (adapter, task.result())
+                        continue
+                    if not isinstance(error, ProviderError):
+                        raise error
+                    errors.append(error)
+                    if error.provider_fault:
+                        self.health[adapter.name].record_failure(error)
+                    await async_error_logger.error(f"LLM provider {adapter.name} failed: {error}")
+                if winner is not None:
+                    if winner[0] is not primary:
+                        self.health[winner[0].name].hedge_wins += 1
+                    return winner[1]
+                if not pending and next_index < len(candidates):
+                    self.failovers += 1
+                    primary = launch()
+        finally:
+            for task in pending:
+                task.cancel()
+
+        self.exhausted += 1
+        raise self._final_error(errors)
+
+    async def _stream(self, adapter: ProviderAdapter, messages: List[Dict], model: str,
+                      params: Dict) -> AsyncIterator[str]:
+        health = self.health[adapter.name]
+        health.requests += 1
+        url, headers, data = adapter.build_request(messages, model, dict(params, stream=True))
+        client = self.http_client or get_llm_http_client()
+        try:
+            async with client.stream("POST", url, headers=headers, json=data, timeout=adapter.timeout) as response:
+                if response.status_code != 200:
+                    await response.aread()
+                    raise ProviderError(adapter.name, f"status {response.status_code}, "
+                                                      f"content: {response.text[:500]}",
+                                        status_code=response.status_code, retry_after=self._retry_after(response))
+                started = False
+                async for line in response.aiter_lines():
+                    try:
+                        delta = adapter.parse_stream_line(line)
+                    except ValueError as e:
+                        raise ProviderError(adapter.name, f"invalid stream event: {e!r}")
+                    if delta:
+                        if not started:
+                            # 调用方通常拿到需要的内容就提前退出，收到第一段即视为provider可用
+                            started = True
+                            health.record_success(None)
+                        yield delta
+        except httpx.TimeoutException as e:
+            raise ProviderError(adapter.name, f"timed out after {adapter.timeout}s: {e!r}", timeout=True)
+        except httpx.HTTPError as e:
+            raise ProviderError(adapter.name, f"http error: {e!r}")
+
+    async def stream_chat(self, messages: List[Dict], params: Dict = None,
+                          models: Dict[str, str] = None) -> AsyncIterator[str]:
+        """
+        流式调用，逐段返回增量文本。收到第一段之前失败会切换provider，之后失败直接抛出；
+        调用方提前退出迭代时连接随之关闭，不再接收剩余输出
+        """
+        if not self.adapters:
+            raise ModelError("No LLM provider configured", details={"providers": settings.LLM_GATEWAY_PROVIDERS})
+        self.requests += 1
+        params = params or {}
+        models = models or {}
+        errors: List[ProviderError] = []
+        for index, adapter in enumerate(self._candidates()):
+            if index:
+                self.failovers += 1
+            started = False
+            stream = self._stream(adapter, messages, models.get(adapter.name, adapter.model), params)
+            try:
+                async for delta in stream:
+                    started = True
+                    yield delta
+                return
+            except ProviderError as error:
+                errors.append(error)
+                if error.provider_fault:
+                    self.health[adapter.name].record_failure(error)
+                await async_error_logger.error(f"LLM provider {adapter.name} stream failed: {error}")
+                if started:
+                    break
+            finally:
+                # 调用方提前退出时立即关闭连接
+                await stream.aclose()
+        self.exhausted += 1
+        raise self._final_error(errors)
+
+    def _final_error(self, errors: List[ProviderError]) -> Exception:
+        details = {"errors": {error.provider: str(error) for error in errors}}
+        if all(error.rate_limited for error in errors):
+            retry_after = min((error.retry_after for error in errors if error.retry_after), default=None)
+            details["retry_after"] = retry_after or settings.LLM_RATE_LIMIT_429_PAUSE
+            return RateLimitError("All LLM providers are rate limited", limit=settings.MAX_REQUESTS_PER_MINUTE,
+                                  details=details)
+        if all(error.timeout for error in errors):
+            return ModelTimeoutError("All LLM providers timed out", timeout=settings.LLM_GATEWAY_TIMEOUT,
+                                     details=details)
+        providers = {error.provider for error in errors}
+        if len(providers) == 1:
+            adapter = next(adapter for adapter in self.adapters if adapter.name in providers)
+            return adapter.error_class(f"LLM provider failed: {errors[-1]}", details=details)
+        return ModelError(f"All LLM providers failed: {errors[-1]}", details=details)
+
+    def stats(self) -> Dict:
+        return {
+            "providers": [adapter.name for adapter in self.adapters],
+            "hedge": self.hedge,
+            "requests": self.requests,
+            "failovers": self.failovers,
+            "exhausted": self.exhausted,
+            "health": {name: health.stats() for name, health in self.health.items()},
+        }
+
+
+_llm_gateway: Optional[LLMGateway] = None
+
+
+def get_llm_gateway() -> LLMGateway:
+    """返回共享网关；独立脚本等没有经过lifespan的场景下按需创建"""
+    global _llm_gateway
+    if _llm_gateway is None:
+        _llm_gateway = LLMGateway()
+    return _llm_gateway
+
+
+async def setup_llm_gateway() -> LLMGateway:
+    gateway = get_llm_gateway()
+    app_logger.info(f"LLM gateway setup completed (providers={[a.name for a in gateway.adapters]}, "
+                    f"hedge={gateway.hedge})")
+    return gateway
+
+
+async def close_llm_gateway(app):
+    global _llm_gateway
+    _llm_gateway = None
+    app_logger.info("LLM gateway closed")
@@ -0,0 +1,120 @@
+# app/llm/http_client.py
+"""
+所有模型调用共用的长连接HTTP客户端（httpx连接池 + keep-alive，可选HTTP/2）。
+在api_doge.py的lifespan中创建，graceful_shutdown时关闭。
+"""
+import time
+from typing import Any, Dict, Optional
+
+import httpx
+
+from app.core.config import settings
+from app.core.logger import app_logger
+
+try:
+    import h2  # noqa: F401  httpx的HTTP/2支持依赖h2
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+class LLMHttpClient:
+    def __init__(self, proxy_url: Optional[str] = None, max_connections: int = None,
+                 max_keepalive_connections: int = None, keepalive_expiry: float = None,
+                 timeout: float = None, connect_timeout: float = None, http2: bool = None):
+        self.max_connections = max_connections or settings.LLM_HTTP_MAX_CONNECTIONS
+        http2 = settings.LLM_HTTP2 if http2 is None else http2
+        if http2 and not HTTP2_AVAILABLE:
+            app_logger.warning("LLM_HTTP2 is enabled but h2 is not installed, falling back to HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.client = httpx.AsyncClient(
+            proxy=proxy_url,
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=max_keepalive_connections or settings.LLM_HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=keepalive_expiry or settings.LLM_HTTP_KEEPALIVE_EXPIRY
+            ),
+            timeout=httpx.Timeout(timeout or settings.LLM_HTTP_TIMEOUT,
+                                  connect=connect_timeout or settings.LLM_HTTP_CONNECT_TIMEOUT)
+        )
+
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self.total_seconds = 0.0
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            return await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.total_seconds += time.perf_counter() - start
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    def stream(self, method: str, url: str, **kwargs):
+        # 流式请求直接交给httpx，连接同样来自共享连接池
+        self.requests += 1
+        return self.client.stream(method, url, **kwargs)
+
+    def _pool_connections(self) -> Dict[str, int]:
+        # httpx没有公开连接池状态，这里尽力读取httpcore连接池，取不到时只返回请求计数
+        pool = getattr(getattr(self.client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is None:
+            return {}
+        idle = sum(1 for connection in connections if connection.is_idle())
+        return {"open_connections": len(connections), "idle_connections": idle}
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            self._pool_connections(),
+            http2=self.http2,
+            max_connections=self.max_connections,
+            in_flight=self.in_flight,
+            max_in_flight=self.max_in_flight,
+            utilization=self.in_flight / self.max_connections,
+            requests=self.requests,
+            errors=self.errors,
+            avg_latency=self.total_seconds / self.requests if self.requests else 0.0,
+        )
+
+    async def close(self):
+        await self.client.aclose()
+
+
+_llm_http_client: Optional[LLMHttpClient] = None
+
+
+def get_llm_http_client() -> LLMHttpClient:
+    """返回共享客户端；独立脚本等没有经过lifespan的场景下按需创建"""
+    global _llm_http_client
+    if _llm_http_client is None:
+        _llm_http_client = LLMHttpClient(proxy_url=settings.PROXY_URL if settings.IS_USE_PROXY else None)
+    return _llm_http_client
+
+
+async def setup_llm_http_client() -> LLMHttpClient:
+    client = get_llm_http_client()
+    app_logger.info(f"LLM HTTP client setup completed (http2={client.http2}, "
+                    f"max_connections={client.max_connections})")
+    return client
+
+
+async def close_llm_http_client(app):
+    global _llm_http_client
+    if hasattr(app.state, 'llm_http_client'):
+        await app.state.llm_http_client.close()
+    _llm_http_client = None
+    app_logger.info("LLM HTTP client closed")
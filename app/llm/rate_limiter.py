@@ -0,0 +1,286 @@
+# app/llm/rate_limiter.py
+"""
+出站LLM请求的限流调度：请求数、token数两个令牌桶同时约束。
+排队的调用方按优先级（交互请求优先于后台记忆更新）、同优先级先到先得的顺序放行，
+超过等待期限抛出RateLimitError。可选通过Redis在多个worker之间共享额度。
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Dict, List, Optional
+
+from app.core.config import settings
+from app.core.exceptions import RateLimitError
+from app.core.logger import app_logger, async_error_logger
+from app.storage.redis_manager import RedisManager
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# KEYS: 请求桶, token桶  ARGV: 请求速率/秒, 请求桶容量, token速率/秒, token桶容量, 请求需求, token需求, key过期秒数
+# 返回需要等待的秒数（字符串），"0"表示已扣减额度
+TAKE_SCRIPT = """
+if redis.replicate_commands then
+    redis.replicate_commands()
+end
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local function level_of(key, rate, cap)
+    local state = redis.call('HMGET', key, 'level', 'ts')
+    local level = tonumber(state[1]) or cap
+    local ts = tonumber(state[2]) or now
+    return math.min(cap, level + math.max(0, now - ts) * rate)
+end
+local req_rate, req_cap = tonumber(ARGV[1]), tonumber(ARGV[2])
+local tok_rate, tok_cap = tonumber(ARGV[3]), tonumber(ARGV[4])
+local req_need, tok_need = tonumber(ARGV[5]), tonumber(ARGV[6])
+local req_level = level_of(KEYS[1], req_rate, req_cap)
+local tok_level = level_of(KEYS[2], tok_rate, tok_cap)
+local wait = 0
+if req_level < req_need then
+    wait = math.max(wait, (req_need - req_level) / req_rate)
+end
+if tok_level < tok_need then
+    wait = math.max(wait, (tok_need - tok_level) / tok_rate)
+end
+if wait == 0 then
+    req_level = req_level - req_need
+    tok_level = tok_level - tok_need
+end
+redis.call('HSET', KEYS[1], 'level', tostring(req_level), 'ts', tostring(now))
+redis.call('HSET', KEYS[2], 'level', tostring(tok_level), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+return tostring(wait)
+"""
+
+
+def estimate_tokens(messages: List[Dict], max_tokens: int = 0) -> int:
+    """发请求前粗略估算token数：ASCII约4字符一个token，中日韩等字符约一字一个token，再加上max_tokens"""
+    prompt_tokens = 0
+    for message in messages:
+        content = message.get("content") or ""
+        if not isinstance(content, str):
+            content = str(content)
+        ascii_chars = sum(1 for ch in content if ord(ch) < 128)
+        prompt_tokens += ascii_chars // 4 + (len(content) - ascii_chars) + 4
+    return prompt_tokens + max_tokens
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "level", "updated_at")
+
+    def __init__(self, per_minute: int, burst_seconds: float):
+        self.rate = per_minute / 60
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_for(self, amount: float) -> float:
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+
+class _Waiter:
+    __slots__ = ("priority", "seq", "tokens", "future")
+
+    def __init__(self, priority: int, seq: int, tokens: int, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.tokens = tokens
+        self.future = future
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class LLMRateLimiter:
+    def __init__(self, requests_per_minute: int = None, tokens_per_minute: int = None,
+                 burst_seconds: float = None, redis: Optional[RedisManager] = None, key_prefix: str = None):
+        self.requests_per_minute = requests_per_minute or settings.MAX_REQUESTS_PER_MINUTE
+        self.tokens_per_minute = tokens_per_minute or settings.MAX_TOKENS_PER_MINUTE
+        burst_seconds = burst_seconds or settings.LLM_RATE_LIMIT_BURST_SECONDS
+        self.request_bucket = _TokenBucket(self.requests_per_minute, burst_seconds)
+        self.token_bucket = _TokenBucket(self.tokens_per_minute, burst_seconds)
+        # 传入redis时多个worker共享额度，Redis不可用时退回本地桶
+        self.redis = redis
+        key_prefix = key_prefix or settings.LLM_RATE_LIMIT_REDIS_PREFIX
+        self.redis_keys = [f"{key_prefix}:requests", f"{key_prefix}:tokens"]
+        self.blocked_until = 0.0
+
+        self._waiters: List[_Waiter] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+
+        self.granted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.wait_seconds = 0.0
+        self.redis_errors = 0
+        self.penalties = 0
+
+    async def acquire(self, tokens: int, priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None) -> int:
+        """预占1个请求和tokens个token的额度，返回实际预占的token数，用于之后reconcile"""
+        tokens = int(min(max(tokens, 1), self.token_bucket.capacity))
+        if timeout is None:
+            timeout = (settings.LLM_RATE_LIMIT_TIMEOUT if priority <= PRIORITY_INTERACTIVE
+                       else settings.LLM_RATE_LIMIT_BACKGROUND_TIMEOUT)
+
+        if not self._waiters and await self._try_take(tokens) == 0:
+            self.granted += 1
+            return tokens
+
+        self.queued += 1
+        start = time.monotonic()
+        waiter = _Waiter(priority, next(self._seq), tokens, asyncio.get_running_loop().create_future())
+        heapq.heappush(self._waiters, waiter)
+        self._wakeup.set()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                return tokens
+            waiter.future.cancel()
+            self.rejected += 1
+            raise RateLimitError(
+                f"LLM rate limit wait exceeded {timeout}s",
+                limit=self.requests_per_minute,
+                details={"tokens_per_minute": self.tokens_per_minute, "requested_tokens": tokens,
+                         "priority": priority, "queue_length": len(self._waiters)}
+            )
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # 已经分到额度但调用方被取消，归还token
+                asyncio.ensure_future(self.reconcile(tokens, 0))
+            waiter.future.cancel()
+            raise
+        finally:
+            self.wait_seconds += time.monotonic() - start
+        return tokens
+
+    async def _pump(self):
+        # 只放行队首：高优先级先走，同优先级按到达顺序，避免大请求被小请求一直插队
+        while self._waiters:
+            head = self._waiters[0]
+            if head.future.done():
+                heapq.heappop(self._waiters)
+                continue
+            wait = await self._try_take(head.tokens)
+            if wait == 0:
+                heapq.heappop(self._waiters)
+                if head.future.done():
+                    await self.reconcile(head.tokens, 0)
+                else:
+                    self.granted += 1
+                    head.future.set_result(True)
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _try_take(self, tokens: int) -> float:
+        now = time.monotonic()
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.redis is not None:
+            try:
+                wait = await self.redis.run_script(
+                    TAKE_SCRIPT,
+                    keys=self.redis_keys,
+                    args=[self.request_bucket.rate, self.request_bucket.capacity, self.token_bucket.rate,
+                          self.token_bucket.capacity, 1, tokens, 120]
+                )
+                return float(wait)
+            except Exception as e:
+                self.redis_errors += 1
+                await async_error_logger.error(f"Shared LLM rate limiter unavailable, using local buckets: {e}")
+
+        self.request_bucket.refill(now)
+        self.token_bucket.refill(now)
+        wait = max(self.request_bucket.wait_for(1), self.token_bucket.wait_for(tokens))
+        if wait == 0:
+            self.request_bucket.level -= 1
+            self.token_bucket.level -= tokens
+        return wait
+
+    async def reconcile(self, reserved: int, actual: int):
+        """拿到响应里的实际用量后修正token桶：多预占的归还，少算的补扣"""
+        delta = reserved - actual
+        if delta == 0:
+            return
+        if self.redis is not None:
+            try:
+                await self.redis.execute_pipeline([("hincrbyfloat", self.redis_keys[1], "level", delta)])
+                return
+            except Exception as e:
+                self.redis_errors += 1
+                await async_error_logger.error(f"Failed to reconcile shared LLM token bucket: {e}")
+        self.token_bucket.refill(time.monotonic())
+        self.token_bucket.level = min(self.token_bucket.capacity, self.token_bucket.level + delta)
+        self._wakeup.set()
+
+    def penalize(self, seconds: float):
+        """上游返回429时暂停放行，避免重试把突发继续放大"""
+        self.penalties += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def stats(self) -> Dict:
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "shared": self.redis is not None,
+            "granted": self.granted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "waiting": len(self._waiters),
+            "avg_wait_seconds": self.wait_seconds / self.queued if self.queued else 0.0,
+            "redis_errors": self.redis_errors,
+            "penalties": self.penalties,
+        }
+
+    async def close(self):
+        if self._pump_task is not None:
+            self._pump_task.cancel()
+            await asyncio.gather(self._pump_task, return_exceptions=True)
+        for waiter in self._waiters:
+            waiter.future.cancel()
+        self._waiters.clear()
+
+
+_llm_rate_limiter: Optional[LLMRateLimiter] = None
+
+
+def get_llm_rate_limiter() -> Optional[LLMRateLimiter]:
+    """未开启限流时返回None；独立脚本等没有经过lifespan的场景下按需创建本地限流器"""
+    global _llm_rate_limiter
+    if _llm_rate_limiter is None and settings.LLM_RATE_LIMIT_ENABLED:
+        _llm_rate_limiter = LLMRateLimiter()
+    return _llm_rate_limiter
+
+
+async def setup_llm_rate_limiter(redis: Optional[RedisManager] = None) -> Optional[LLMRateLimiter]:
+    global _llm_rate_limiter
+    if not settings.LLM_RATE_LIMIT_ENABLED:
+        return None
+    _llm_rate_limiter = LLMRateLimiter(redis=redis if settings.LLM_RATE_LIMIT_SHARED else None)
+    app_logger.info(f"LLM rate limiter setup completed (rpm={_llm_rate_limiter.requests_per_minute}, "
+                    f"tpm={_llm_rate_limiter.tokens_per_minute}, shared={settings.LLM_RATE_LIMIT_SHARED})")
+    return _llm_rate_limiter
+
+
+async def close_llm_rate_limiter(app):
+    global _llm_rate_limiter
+    if getattr(app.state, 'llm_rate_limiter', None) is not None:
+        await app.state.llm_rate_limiter.close()
+    _llm_rate_limiter = None
+    app_logger.info("LLM rate limiter closed")
@@ -0,0 +1,213 @@
+# app/llm/response_cache.py
+"""
+出站LLM调用的响应缓存，按endpoint单独开启。
+精确匹配：model + messages + 参数的sha256作为key，响应存Redis并设置TTL；
+语义匹配（可选）：prompt向量存入Milvus，余弦相似度超过阈值时复用命中条目对应的Redis响应，
+Redis中的响应过期后语义条目随之失效。语义匹配只在同一scope_key（如用户+角色）内进行。
+"""
+import hashlib
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.logger import app_logger, async_error_logger
+from app.storage.milvus_manager import MilvusManager
+from app.storage.redis_manager import RedisManager
+
+# 计算key前从消息内容中去掉的易变部分，例如记忆更新prompt里的当前时间
+DEFAULT_IGNORE_PATTERNS = {
+    "memory_update": (r"^时间：.*$",),
+}
+# 响应包含用户私有数据的endpoint：没有scope_key时不做语义匹配，避免不同用户之间复用响应
+USER_SCOPED_ENDPOINTS = {"memory_update"}
+
+
+class CachePolicy:
+    __slots__ = ("endpoint", "ttl", "semantic", "ignore")
+
+    def __init__(self, endpoint: str, ttl: int, semantic: bool = False, ignore: Tuple[str, ...] = ()):
+        self.endpoint = endpoint
+        self.ttl = ttl
+        self.semantic = semantic
+        self.ignore = [re.compile(pattern, re.MULTILINE) for pattern in ignore]
+
+
+def parse_policies(spec: str, semantic_spec: str) -> Dict[str, CachePolicy]:
+    """spec格式：endpoint:ttl,endpoint:ttl；semantic_spec为开启语义匹配的endpoint列表"""
+    semantic = {name.strip() for name in semantic_spec.split(",") if name.strip()}
+    policies = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        endpoint, _, ttl = item.strip().partition(":")
+        policies[endpoint] = CachePolicy(endpoint, int(ttl or settings.LLM_RESPONSE_CACHE_TTL),
+                                         semantic=endpoint in semantic,
+                                         ignore=DEFAULT_IGNORE_PATTERNS.get(endpoint, ()))
+    return policies
+
+
+class _EndpointStats:
+    __slots__ = ("lookups", "exact_hits", "semantic_hits", "stale", "stores", "errors")
+
+    def __init__(self):
+        self.lookups = 0
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.stale = 0
+        self.stores = 0
+        self.errors = 0
+
+    def to_dict(self) -> Dict:
+        hits = self.exact_hits + self.semantic_hits
+        return {
+            "lookups": self.lookups,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "stale": self.stale,
+            "stores": self.stores,
+            "errors": self.errors,
+            "hit_rate": hits / self.lookups if self.lookups else 0.0,
+        }
+
+
+class LLMResponseCache:
+    def __init__(self, redis: RedisManager, milvus: Optional[MilvusManager] = None,
+                 policies: Optional[Dict[str, CachePolicy]] = None, namespace: str = None,
+                 semantic_threshold: float = None):
+        self.redis = redis
+        self.milvus = milvus
+        self.policies = policies if policies is not None else parse_policies(
+            settings.LLM_RESPONSE_CACHE_ENDPOINTS, settings.LLM_RESPONSE_CACHE_SEMANTIC_ENDPOINTS)
+        self.namespace = namespace or settings.LLM_RESPONSE_CACHE_PREFIX
+        self.semantic_collection = settings.LLM_RESPONSE_CACHE_SEMANTIC_COLLECTION
+        self.semantic_threshold = (semantic_threshold if semantic_threshold is not None
+                                   else settings.LLM_RESPONSE_CACHE_SEMANTIC_THRESHOLD)
+        self.endpoint_stats: Dict[str, _EndpointStats] = {}
+
+    def enabled(self, endpoint: str) -> bool:
+        return endpoint in self.policies
+
+    def _normalize(self, policy: CachePolicy, messages: List[Dict]) -> List[Dict]:
+        normalized = []
+        for message in messages:
+            content = message.get("content")
+            if isinstance(content, str):
+                for pattern in policy.ignore:
+                    content = pattern.sub("", content)
+            normalized.append(dict(message, content=content))
+        return normalized
+
+    @staticmethod
+    def _digest(payload) -> str:
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _keys(self, policy: CachePolicy, model: str, messages: List[Dict], params: Dict,
+              scope_key: Optional[str] = None) -> Tuple[str, str, str]:
+        """返回(Redis key, 语义匹配的scope, 用于向量化的文本)"""
+        normalized = self._normalize(policy, messages)
+        digest = self._digest({"model": model, "messages": normalized, "params": params})
+        key = f"{self.namespace}:{policy.endpoint}:{digest}"
+        # 只有scope_key、model、参数、system prompt都相同的请求之间才做语义匹配，向量只针对其余消息
+        system = [m for m in normalized if m.get("role") == "system"]
+        scope = self._digest({"scope_key": scope_key, "model": model, "system": system, "params": params})
+        scope = f"{policy.endpoint}:{scope[:32]}"
+        text = "\n".join(str(m.get("content")) for m in normalized if m.get("role") != "system")
+        return key, scope, text[-settings.LLM_RESPONSE_CACHE_SEMANTIC_MAX_CHARS:]
+
+    @staticmethod
+    def _semantic_allowed(policy: CachePolicy, scope_key: Optional[str]) -> bool:
+        return policy.semantic and (scope_key is not None or policy.endpoint not in USER_SCOPED_ENDPOINTS)
+
+    def _stats(self, endpoint: str) -> _EndpointStats:
+        stats = self.endpoint_stats.get(endpoint)
+        if stats is None:
+            stats = self.endpoint_stats[endpoint] = _EndpointStats()
+        return stats
+
+    async def get(self, endpoint: str, model: str, messages: List[Dict], params: Dict,
+                  scope_key: Optional[str] = None) -> Optional[Dict]:
+        """scope_key标识响应所属的用户/租户，语义匹配只在相同scope_key的条目之间进行"""
+        policy = self.policies.get(endpoint)
+        if policy is None:
+            return None
+        stats = self._stats(endpoint)
+        stats.lookups += 1
+        key, scope, text = self._keys(policy, model, messages, params, scope_key)
+        try:
+            response = await self.redis.get_obj(key)
+            if response is not None:
+                stats.exact_hits += 1
+                return dict(response, cached=True)
+            if self._semantic_allowed(policy, scope_key) and self.milvus is not None and text:
+                return await self._semantic_get(stats, scope, text)
+        except Exception as e:
+            stats.errors += 1
+            await async_error_logger.error(f"LLM response cache lookup failed for {endpoint}: {e}")
+        return None
+
+    async def _semantic_get(self, stats: _EndpointStats, scope: str, text: str) -> Optional[Dict]:
+        docs = await self.milvus.similarity_search(self.semantic_collection, text, 1,
+                                                   self.milvus.tenant_expr({"scope": scope}))
+        # L2距离是平方距离，归一化向量下等于2 * (1 - cos)，换算成余弦相似度再与阈值比较
+        if not docs or 1 - float(docs[0][1]) / 2 < self.semantic_threshold:
+            return None
+        cache_key = docs[0][0].metadata.get("cache_key")
+        response = await self.redis.get_obj(cache_key) if cache_key else None
+        if response is None:
+            # 响应已过期，清理对应的向量条目
+            stats.stale += 1
+            await self.milvus.delete_where(self.semantic_collection, f"cache_key == {json.dumps(cache_key)}")
+            return None
+        stats.semantic_hits += 1
+        return dict(response, cached=True)
+
+    async def set(self, endpoint: str, model: str, messages: List[Dict], params: Dict, response: Dict,
+                  scope_key: Optional[str] = None):
+        policy = self.policies.get(endpoint)
+        if policy is None:
+            return
+        stats = self._stats(endpoint)
+        key, scope, text = self._keys(policy, model, messages, params, scope_key)
+        try:
+            await self.redis.set_obj(key, response, ex=policy.ttl)
+            if self._semantic_allowed(policy, scope_key) and self.milvus is not None and text:
+                await self.milvus.create_or_update_milvus(self.semantic_collection, [text],
+                                                          tenant={"scope": scope, "cache_key": key})
+            stats.stores += 1
+        except Exception as e:
+            stats.errors += 1
+            await async_error_logger.error(f"LLM response cache store failed for {endpoint}: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "endpoints": {name: {"ttl": policy.ttl, "semantic": policy.semantic}
+                          for name, policy in self.policies.items()},
+            "semantic_threshold": self.semantic_threshold,
+            "stats": {name: stats.to_dict() for name, stats in self.endpoint_stats.items()},
+        }
+
+
+_llm_response_cache: Optional[LLMResponseCache] = None
+
+
+def get_llm_response_cache() -> Optional[LLMResponseCache]:
+    """未开启或未经过lifespan初始化时返回None，调用方直接请求模型"""
+    return _llm_response_cache
+
+
+async def setup_llm_response_cache(redis: RedisManager,
+                                   milvus: Optional[MilvusManager] = None) -> Optional[LLMResponseCache]:
+    global _llm_response_cache
+    if not settings.LLM_RESPONSE_CACHE_ENABLED:
+        return None
+    _llm_response_cache = LLMResponseCache(redis, milvus)
+    app_logger.info(f"LLM response cache setup completed (endpoints={list(_llm_response_cache.policies)})")
+    return _llm_response_cache
+
+
+async def close_llm_response_cache(app):
+    global _llm_response_cache
+    _llm_response_cache = None
+    app_logger.info("LLM response cache closed")
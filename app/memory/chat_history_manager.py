@@ -1,17 +1,67 @@
 # app/chat_history/chat_history_manager.py
+import re
 import time
 import json
 import asyncio
-import aiohttp
+from typing import Dict, List, Optional, Set, Tuple
+from app.memory.chat_write_pipeline import ChatWriteProducer
+from app.memory.important_memories import ImportantMemoryStore, memory_texts
 from app.storage.redis_manager import RedisManager
 from abc import ABC, abstractmethod
 from app.storage.milvus_manager import MilvusManager
-from app.prompts.prompts import create_memory_update_prompt
+from app.prompts.prompts import build_memory_update_prompt, memory_prompt_builder
+from app.utils.concurrency import SingleFlight
 from app.utils.helpers import async_retry
-from aiohttp_socks import ProxyConnector
+from app.utils.json_stream import JsonFieldExtractor
+from app.llm.gateway import get_llm_gateway
+from app.llm.rate_limiter import PRIORITY_BACKGROUND, estimate_tokens, get_llm_rate_limiter
+from app.llm.response_cache import get_llm_response_cache
+from app.core.exceptions import ModelError, RateLimitError
 from app.core.config import settings
 from app.core.logger import async_app_logger, async_error_logger
 
+RECENT_DATA_PREFIX = "tw_recent_data_"
+# 流式调用在目标字段完整后提前结束时使用的finish_reason
+FIELD_RESOLVED = "field_resolved"
+RECENT_LIST_PREFIX = "tw_recent_list_"
+RECENT_META_PREFIX = "tw_recent_meta_"
+
+# build_context返回的各来源及其状态
+CONTEXT_SOURCES = ("recent_chat", "important_memories", "long_chat", "social")
+CONTEXT_OK = "ok"
+CONTEXT_TIMEOUT = "timeout"
+CONTEXT_ERROR = "error"
+CONTEXT_SKIPPED = "skipped"
+
+# 重要记忆更新的本地门控：去掉空白、标点、emoji后，只剩寒暄/语气词的对话不触发LLM
+TRIVIAL_STRIP_PATTERN = re.compile(r"[\s\W_\U0001F000-\U0001FAFF\u2600-\u27BF]+")
+TRIVIAL_TURN_PATTERN = re.compile(
+    r"(ok(ay)?|k+|lol|lmao|haha+|hehe+|h+m+|yes|yeah|yep|no|nope|thanks?|thx|ty|bye|hi|hello|hey|gn|gm|"
+    r"嗯+|哦+|噢+|喔+|啊+|哈+|呵+|嘿+|好+|好的|好吧|行|可以|是的?|对+|没有?|谢谢|多谢|晚安|早安?|拜拜|你好|在吗)"
+)
+
+# 仅当blob未被改写时才迁移：旧消息插到list头部（迁移前已写入新布局的消息更新），
+# 已有新元数据时不覆盖，最后删除blob
+# KEYS: blob, list, meta  ARGV: blob快照, max_records, 消息数n, n条消息, 元数据field/value...
+MIGRATE_RECENT_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+local n = tonumber(ARGV[3])
+for i = 3 + n, 4, -1 do
+    redis.call('LPUSH', KEYS[2], ARGV[i])
+end
+local max_records = tonumber(ARGV[2])
+if max_records > 0 then
+    redis.call('LTRIM', KEYS[2], -max_records, -1)
+end
+if #ARGV > 3 + n and redis.call('EXISTS', KEYS[3]) == 0 then
+    redis.call('HSET', KEYS[3], unpack(ARGV, 4 + n))
+end
+redis.call('DEL', KEYS[1])
+return 1
+"""
+
 
 class ChatHistoryStorageBase(ABC):
     @abstractmethod
@@ -40,7 +90,7 @@ class ChatHistoryStorageBase(ABC):
         pass
 
     @abstractmethod
-    async def get_important_memories(self, user_id, character_id):
+    async def get_important_memories(self, user_id, character_id, question=None, k=None):
         pass
 
     @abstractmethod
@@ -49,52 +99,163 @@ class ChatHistoryStorageBase(ABC):
 
 
 class RemoteDBChatHistoryStorage(ChatHistoryStorageBase):
-    def __init__(self, redis_manager: RedisManager, milvus_manager: MilvusManager, max_records: int = 14):
+    def __init__(self, redis_manager: RedisManager, milvus_manager: MilvusManager, max_records: int = 14,
+                 chat_writer: Optional[ChatWriteProducer] = None):
         self.max_records = max_records
         self.redis_manager = redis_manager
         self.milvus_manager = milvus_manager
+        self.chat_writer = chat_writer
+        self.memory_store = ImportantMemoryStore(redis_manager,
+                                                 milvus_manager.embeddings if milvus_manager is not None else None)
+
+    @staticmethod
+    def _recent_keys(suffix: str) -> Tuple[str, str, str]:
+        return f"{RECENT_LIST_PREFIX}{suffix}", f"{RECENT_META_PREFIX}{suffix}", f"{RECENT_DATA_PREFIX}{suffix}"
+
+    async def migrate_recent_blob(self, suffix: str, max_records: Optional[int] = None) -> bool:
+        """把旧版tw_recent_data_* JSON整块数据迁移到list+hash布局，迁移期间blob被改写则重试"""
+        list_key, meta_key, blob_key = self._recent_keys(suffix)
+        for _ in range(3):
+            blob = await self.redis_manager.get(blob_key)
+            if blob is None:
+                return False
+            codec = self.redis_manager.codec
+            data = codec.decode(blob)
+            messages = [codec.encode(msg) for msg in data.pop("chat_history", [])]
+            meta = [item for field, value in data.items() for item in (field, codec.encode(value))]
+            migrated = await self.redis_manager.run_script(
+                MIGRATE_RECENT_SCRIPT,
+                keys=[blob_key, list_key, meta_key],
+                args=[blob, max_records or self.max_records, len(messages), *messages, *meta]
+            )
+            if migrated:
+                await self.redis_manager.invalidate(list_key)
+                return True
+        await async_error_logger.error(f"Failed to migrate recent chat blob {blob_key}: concurrently modified")
+        return False
+
+    async def _load_recent_chat(self, suffix: str, max_records: int) -> Tuple[int, Optional[dict]]:
+        list_key, meta_key, blob_key = self._recent_keys(suffix)
+        messages, meta, legacy = await self.redis_manager.execute_pipeline([
+            ("lrange", list_key, -max_records, -1),
+            ("hgetall", meta_key),
+            ("exists", blob_key),
+        ], raw=True)
+        if legacy and await self.migrate_recent_blob(suffix):
+            messages, meta = await self.redis_manager.execute_pipeline([
+                ("lrange", list_key, -max_records, -1),
+                ("hgetall", meta_key),
+            ], raw=True)
+
+        return max_records, self._decode_recent(messages, meta)
+
+    def _decode_recent(self, messages: List[bytes], meta: Dict[bytes, bytes]) -> Optional[dict]:
+        if not messages and not meta:
+            return None
+        codec = self.redis_manager.codec
+        data = {field.decode("utf-8"): codec.decode(value) for field, value in meta.items()}
+        recent_chat = []
+        for msg in map(codec.decode, messages):
+            recent_chat.append(
+                (msg['timestamp'], msg['role'], msg['content']))
+        data["chat_history"] = recent_chat
+        return data
+
+    async def _load_recent_chat_many(self, suffixes: List[str],
+                                     max_records: int) -> Dict[str, Tuple[int, Optional[dict]]]:
+        commands = []
+        for suffix in suffixes:
+            list_key, meta_key, blob_key = self._recent_keys(suffix)
+            commands += [("lrange", list_key, -max_records, -1), ("hgetall", meta_key), ("exists", blob_key)]
+        results = await self.redis_manager.execute_pipeline(commands, raw=True, raise_on_error=False)
+
+        loaded = {}
+        for i, suffix in enumerate(suffixes):
+            messages, meta, legacy = results[3 * i:3 * i + 3]
+            try:
+                for result in (messages, meta, legacy):
+                    if isinstance(result, Exception):
+                        raise result
+                if legacy:
+                    # 旧格式数据很少，逐个迁移后单独读取
+                    loaded[suffix] = await self._load_recent_chat(suffix, max_records)
+                else:
+                    loaded[suffix] = (max_records, self._decode_recent(messages, meta))
+            except Exception as e:
+                await async_error_logger.error(f"Failed to load recent chat {suffix}: {e}")
+        return loaded
 
     async def get_recent_chat(self, user_id, character_id):
-        key = f"tw_recent_data_{user_id}_{character_id}"
-        data = await self.redis_manager.get(key)
-
-        if data:
-            data = json.loads(data)
-            chat_history = data["chat_history"]
-            recent_messages = chat_history[-self.max_records:]
-            recent_chat = []
-            for msg in recent_messages:
-                recent_chat.append(
-                    (msg['timestamp'], msg['role'], msg['content']))
-            data["chat_history"] = recent_chat
-            return data
-        else:
+        suffix = f"{user_id}_{character_id}"
+        list_key = self._recent_keys(suffix)[0]
+        max_records = self.max_records
+        loaded_records, data = await self.redis_manager.cached(
+            list_key, lambda: self._load_recent_chat(suffix, max_records)
+        )
+        if loaded_records != max_records:
+            loaded_records, data = await self._load_recent_chat(suffix, max_records)
+        if data is None:
             return None
+        # 返回副本，调用方修改不会污染近端缓存
+        return dict(data, chat_history=list(data["chat_history"]))
+
+    async def get_recent_chat_many(self, pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[dict]]:
+        """批量读取多个(user_id, character_id)的recent chat，一次pipeline往返；读取失败的pair不出现在结果中"""
+        max_records = self.max_records
+        suffixes = {self._recent_keys(f"{user_id}_{character_id}")[0]: f"{user_id}_{character_id}"
+                    for user_id, character_id in pairs}
+
+        async def _load(list_keys: List[str]) -> Dict[str, Tuple[int, Optional[dict]]]:
+            loaded = await self._load_recent_chat_many([suffixes[key] for key in list_keys], max_records)
+            return {self._recent_keys(suffix)[0]: value for suffix, value in loaded.items()}
+
+        cached = await self.redis_manager.cached_many(list(suffixes), _load)
+        results = {}
+        for user_id, character_id in pairs:
+            suffix = f"{user_id}_{character_id}"
+            item = cached.get(self._recent_keys(suffix)[0])
+            if item is None:
+                continue
+            loaded_records, data = item
+            if loaded_records != max_records:
+                loaded_records, data = await self._load_recent_chat(suffix, max_records)
+            results[(user_id, character_id)] = (None if data is None
+                                                else dict(data, chat_history=list(data["chat_history"])))
+        return results
 
     async def put_recent_chat(self, user_id, character_id, data,max_records=14):
         self.max_records = max_records
         chat_history = data["chat_history"]
-        key = f"tw_recent_data_{user_id}_{character_id}"
-        old_data = await self.redis_manager.get(key)
-        if old_data:
-            old_data = json.loads(old_data)
-            messages = old_data["chat_history"]
-            new_messages = [{'timestamp': t, 'role': r, 'content': c} for
-                            t, r, c in chat_history]
-            messages.extend(new_messages)
-            if len(messages) > self.max_records:
-                messages = messages[-self.max_records:]
-        else:
-            messages = [{'timestamp': t, 'role': r, 'content': c} for
-                        t, r, c in chat_history]
+        suffix = f"{user_id}_{character_id}"
+        list_key, meta_key, blob_key = self._recent_keys(suffix)
 
-        data["chat_history"] = messages
-        await self.redis_manager.set(key, json.dumps(data))
+        codec = self.redis_manager.codec
+        new_messages = [codec.encode({'timestamp': t, 'role': r, 'content': c}) for
+                        t, r, c in chat_history]
+        meta = {field: codec.encode(value) for field, value in data.items() if field != "chat_history"}
+        # 追加、裁剪和元数据覆盖在同一个MULTI中执行，并发的多轮对话不会互相覆盖
+        commands = [("exists", blob_key)]
+        if new_messages:
+            commands += [("rpush", list_key, *new_messages), ("ltrim", list_key, -self.max_records, -1)]
+        commands.append(("delete", meta_key))
+        if meta:
+            commands.append(("hset", meta_key, None, None, meta))
+        results = await self.redis_manager.execute_pipeline(commands, transaction=True, raw=True)
+        if results[0]:
+            # 旧数据更早，迁移时插到list头部
+            await self.migrate_recent_blob(suffix, self.max_records)
+        await self.redis_manager.invalidate(list_key)
 
         texts = f"\n".join(
             f"chat_time:{t}, role:{r}, content:{c}" for t, r, c in
             chat_history)
-        # 插入永久记忆
+        # 插入永久记忆：开启写入管道时只追加到Redis Stream，由worker异步写入Milvus
+        if self.chat_writer is not None:
+            try:
+                await self.chat_writer.enqueue_chat(user_id, character_id, texts)
+                return
+            except Exception as e:
+                await async_error_logger.error(f"Failed to enqueue chat write, saving inline: {e}")
         await self.milvus_manager.save_chat(user_id, character_id, texts)
 
     async def get_long_memory_chat(self, user_id, character_id, question, k=3, score_threshold=0.6):
@@ -102,8 +263,16 @@ class RemoteDBChatHistoryStorage(ChatHistoryStorageBase):
                                                       score_threshold=score_threshold)
 
     async def rm_recent_chat(self, user_id, character_id):
-        key = f"tw_recent_data_{user_id}_{character_id}"
-        await self.redis_manager.delete(key)
+        keys = self._recent_keys(f"{user_id}_{character_id}")
+        await self.redis_manager.execute_pipeline([("delete", *keys)])
+        await self.redis_manager.invalidate(keys[0])
+
+    async def rm_recent_chat_many(self, pairs: List[Tuple[str, str]]):
+        keys = [key for user_id, character_id in pairs for key in self._recent_keys(f"{user_id}_{character_id}")]
+        if not keys:
+            return
+        await self.redis_manager.execute_pipeline([("delete", *keys)])
+        await self.redis_manager.invalidate(*keys[::3])
 
     async def rm_long_memory_chat(self, user_id, character_id):
         await self.milvus_manager.delete_chat_collection(user_id, character_id)
@@ -111,50 +280,386 @@ class RemoteDBChatHistoryStorage(ChatHistoryStorageBase):
     async def update_important_memories(self, user_id, character_id, character_name, base_prompt, recent_chat_history,
                                         social_network, long_chat_history, question, response_text):
 
-        key = f"tw_important_memories_{user_id}_{character_id}"
-
-        existing_memories = await self.redis_manager.get(key)
-        if existing_memories:
-            sys_prompt, user_prompt = create_memory_update_prompt(existing_memories, character_name, base_prompt,
-                                                                  recent_chat_history,
-                                                                  social_network, long_chat_history, question,
-                                                                  response_text)
-        else:
-            sys_prompt, user_prompt = create_memory_update_prompt("None", character_name, base_prompt,
-                                                                  recent_chat_history,
-                                                                  social_network, long_chat_history, question,
-                                                                  response_text)
-        openai_apikey = settings.EMBEDDING_OPENAI_APIKEY
+        # 只把与本轮问题最相关的记忆交给LLM更新，其余记忆不受影响
+        shown = await self.memory_store.search(user_id, character_id, question)
+        existing_memories = memory_texts(shown)
+        lean = settings.MEMORY_UPDATE_LEAN_OUTPUT
+        sys_prompt, user_prompt, report = build_memory_update_prompt(existing_memories or "None", character_name,
+                                                                     base_prompt, recent_chat_history, social_network,
+                                                                     long_chat_history, question, response_text,
+                                                                     lean=lean)
+        async_app_logger.info(f"user_id:{user_id},character_id:{character_id},memory prompt tokens: "
+                              f"{report['total']}/{report['budget']} "
+                              f"{ {name: section['tokens'] for name, section in report['sections'].items()} }")
         model = "gpt-4o-mini"
         messages = [{"role": "system", "content": sys_prompt}, {"role": "user", "content": user_prompt}]
+        streaming = settings.MEMORY_UPDATE_STREAMING
         try:
-            json_res = await llm_update_memories(openai_apikey, model, messages)
+            start = time.monotonic()
+            json_res = await (llm_stream_memories if streaming else llm_update_memories)(
+                model, messages, cache_scope=f"{user_id}_{character_id}")
+            if not json_res.get("cached"):
+                memory_update_metrics.record(("lean" if lean else "full") + ("+stream" if streaming else ""),
+                                             json_res.get("usage", {}).get("completion_tokens"),
+                                             time.monotonic() - start,
+                                             json_res['choices'][0].get("finish_reason") == FIELD_RESOLVED)
             response_text = json_res['choices'][0]['message']['content']
             new_memories_json = json.loads(response_text)
-            new_memories = new_memories_json.get("updated_important_memories", existing_memories)
+            new_memories = new_memories_json.get("updated_important_memories")
             async_app_logger.info(
                 f"user_id:{user_id},character_id:{character_id},Updated important memories: {new_memories}")
         except Exception as e:
             await async_error_logger.error(f"Error in updating important memories: {str(e)}")
-            new_memories = existing_memories
-        await self.redis_manager.set(key, str(new_memories))
+            return
+        if isinstance(new_memories, list):
+            await self.memory_store.apply_update(user_id, character_id, shown, new_memories)
 
-    async def get_important_memories(self, user_id, character_id):
-        key = f"tw_important_memories_{user_id}_{character_id}"
-        return await self.redis_manager.get(key)
+    async def get_important_memories(self, user_id, character_id, question=None, k=None):
+        """返回记忆文本的JSON数组；传入question时只取最相关的k条，否则按重要度取前k条"""
+        return memory_texts(await self.memory_store.search(user_id, character_id, question, k))
 
     async def rm_importance_memories(self, user_id, character_id):
-        key = f"tw_important_memories_{user_id}_{character_id}"
-        await self.redis_manager.delete(key)
+        await self.memory_store.delete(user_id, character_id)
+
+    async def get_important_memories_many(self, pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[str]]:
+        """批量读取important memories，一次pipeline往返；读取失败的pair不出现在结果中"""
+        loaded = await self.memory_store.load_many(pairs)
+        return {pair: memory_texts(records[:settings.MEMORY_RECORDS_TOP_K]) for pair, records in loaded.items()}
+
+    async def rm_importance_memories_many(self, pairs: List[Tuple[str, str]]):
+        await self.memory_store.delete_many(pairs)
+
+    async def prefetch(self, user_id, character_id) -> Dict[str, bool]:
+        """
+        预热会话：挂载并加载chat/social collection，把recent chat和重要记忆读进近端缓存。
+        返回各项是否成功；进行中的读取和打开会被之后的请求复用
+        """
+        chat_collection, _ = self.milvus_manager.chat_target(user_id, character_id)
+        social_collection, _ = self.milvus_manager.social_target(character_id)
+        steps = {
+            "recent_chat": self.get_recent_chat(user_id, character_id),
+            "important_memories": self.memory_store.load(user_id, character_id),
+            "chat_collection": self.milvus_manager.warm_collection(chat_collection),
+            "social_collection": self.milvus_manager.warm_collection(social_collection),
+        }
+        results = await asyncio.gather(*steps.values(), return_exceptions=True)
+        warmed = {}
+        for name, result in zip(steps, results):
+            warmed[name] = not isinstance(result, BaseException)
+            if not warmed[name]:
+                await async_error_logger.error(f"user_id:{user_id},character_id:{character_id},"
+                                               f"failed to prefetch {name}: {result}")
+        return warmed
+
+    async def build_context(self, user_id, character_id, question, deadline: Optional[float] = None) -> Dict:
+        """
+        并发读取recent chat、重要记忆、长期对话和社交资料，question只向量化一次。
+        最多等待deadline秒，返回已到达的结果：status为各来源的ok/timeout/error/skipped，
+        未到达的来源值为None；latency为各来源耗时，超时的来源记为放弃时的耗时
+        """
+        deadline = settings.CHAT_CONTEXT_DEADLINE if deadline is None else deadline
+        start = time.monotonic()
+        latency: Dict[str, float] = {}
+        embedding = (asyncio.ensure_future(self.milvus_manager.embeddings.aembed_query(question))
+                     if question and self.milvus_manager is not None else None)
+
+        async def _vector() -> List[float]:
+            # shield：某个来源被取消时不影响其他来源共用的embedding
+            vector = await asyncio.shield(embedding)
+            latency.setdefault("embedding", time.monotonic() - start)
+            return vector
+
+        async def _memories() -> Optional[str]:
+            top_k = settings.MEMORY_RECORDS_TOP_K
+            records = await self.memory_store.load(user_id, character_id)
+            if embedding is None or len(records) <= top_k:
+                return memory_texts(records[:top_k])
+            try:
+                vector = await _vector()
+            except Exception:
+                # embedding失败时退化为按重要度取记忆
+                return memory_texts(records[:top_k])
+            return memory_texts(await self.memory_store.search(user_id, character_id, question, top_k,
+                                                               query_vector=vector))
+
+        async def _long_chat() -> List[str]:
+            return await self.milvus_manager.search_chats(user_id, character_id, question,
+                                                          k=settings.CHAT_CONTEXT_LONG_CHAT_K,
+                                                          score_threshold=settings.CHAT_CONTEXT_SCORE_THRESHOLD,
+                                                          vector=await _vector())
+
+        async def _social() -> List[str]:
+            return await self.milvus_manager.search_social(character_id, question,
+                                                           k=settings.CHAT_CONTEXT_SOCIAL_K,
+                                                           score_threshold=settings.CHAT_CONTEXT_SCORE_THRESHOLD,
+                                                           vector=await _vector())
+
+        async def _timed(source: str, coro):
+            try:
+                result = await coro
+            except Exception:
+                latency[source] = time.monotonic() - start
+                raise
+            latency[source] = time.monotonic() - start
+            return result
+
+        lookups = {"recent_chat": self.get_recent_chat(user_id, character_id), "important_memories": _memories()}
+        if embedding is not None:
+            lookups.update(long_chat=_long_chat(), social=_social())
+        tasks = {asyncio.ensure_future(_timed(source, coro)): source for source, coro in lookups.items()}
+        _, pending = await asyncio.wait(tasks, timeout=max(deadline, 0))
+        elapsed = time.monotonic() - start
+        for task in pending:
+            task.cancel()
+        if embedding is not None:
+            if not embedding.done():
+                embedding.cancel()
+            elif not embedding.cancelled():
+                embedding.exception()
+
+        context = dict.fromkeys(CONTEXT_SOURCES)
+        status = dict.fromkeys(CONTEXT_SOURCES, CONTEXT_SKIPPED)
+        for task, source in tasks.items():
+            if task in pending:
+                status[source] = CONTEXT_TIMEOUT
+                latency[source] = elapsed
+            elif task.exception() is not None:
+                status[source] = CONTEXT_ERROR
+                await async_error_logger.error(f"user_id:{user_id},character_id:{character_id},"
+                                               f"failed to load {source} for context: {task.exception()}")
+            else:
+                status[source] = CONTEXT_OK
+                context[source] = task.result()
+        context_metrics.record(status, latency)
+        return dict(context, status=status, latency=latency, elapsed=elapsed)
+
+
+class MemoryUpdateMetrics:
+    """
+    按输出模式（full/lean，是否流式）统计记忆更新调用的输出token数和拿到结果的耗时，
+    与full模式的均值对比得出各模式节省的token和时间
+    """
+    BASELINE = "full"
+
+    def __init__(self):
+        self.modes: Dict[str, Dict[str, float]] = {}
+
+    def record(self, mode: str, output_tokens: Optional[int], seconds: float, resolved_early: bool = False):
+        stats = self.modes.setdefault(mode, {"calls": 0, "token_samples": 0, "output_tokens": 0,
+                                             "seconds": 0.0, "resolved_early": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["resolved_early"] += resolved_early
+        if output_tokens is not None:
+            stats["token_samples"] += 1
+            stats["output_tokens"] += output_tokens
+
+    def _averages(self, stats: Dict[str, float]) -> Tuple[Optional[float], float]:
+        tokens = stats["output_tokens"] / stats["token_samples"] if stats["token_samples"] else None
+        return tokens, stats["seconds"] / stats["calls"]
+
+    def stats(self) -> Dict:
+        baseline = self.modes.get(self.BASELINE)
+        base_tokens, base_seconds = self._averages(baseline) if baseline else (None, None)
+        result = {}
+        for mode, stats in self.modes.items():
+            tokens, seconds = self._averages(stats)
+            result[mode] = {
+                "calls": stats["calls"],
+                "resolved_early": stats["resolved_early"],
+                "avg_output_tokens": tokens,
+                "avg_time_to_result": seconds,
+                "output_tokens_saved": (base_tokens - tokens
+                                        if mode != self.BASELINE and None not in (base_tokens, tokens) else None),
+                "time_to_result_saved": (base_seconds - seconds
+                                         if mode != self.BASELINE and base_seconds is not None else None),
+            }
+        return result
+
+
+memory_update_metrics = MemoryUpdateMetrics()
+
+
+class ContextMetrics:
+    """build_context各来源的状态计数和平均耗时"""
+
+    def __init__(self):
+        self.calls = 0
+        self.sources: Dict[str, Dict[str, float]] = {}
+
+    def record(self, status: Dict[str, str], latency: Dict[str, float]):
+        self.calls += 1
+        for source, value in status.items():
+            stats = self.sources.setdefault(source, {CONTEXT_OK: 0, CONTEXT_TIMEOUT: 0, CONTEXT_ERROR: 0,
+                                                     CONTEXT_SKIPPED: 0, "seconds": 0.0, "samples": 0})
+            stats[value] += 1
+            if source in latency:
+                stats["seconds"] += latency[source]
+                stats["samples"] += 1
+
+    def stats(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "sources": {
+                source: dict({key: value for key, value in stats.items() if key not in ("seconds", "samples")},
+                             avg_latency=stats["seconds"] / stats["samples"] if stats["samples"] else None)
+                for source, stats in self.sources.items()
+            },
+        }
+
+
+context_metrics = ContextMetrics()
+
+
+class _PendingMemoryUpdate:
+    __slots__ = ("turns", "context", "first_at", "timer")
+
+    def __init__(self):
+        self.turns: List[Tuple[str, str]] = []
+        self.context: Dict = {}
+        self.first_at = time.monotonic()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MemoryUpdateScheduler:
+    """
+    合并同一(user_id, character_id)短时间内的多轮对话，只调用一次LLM更新重要记忆。
+    debounce窗口内没有新对话、累计轮数达到阈值或等待超过max_wait时触发更新；
+    寒暄、语气词之类的琐碎对话在本地直接跳过。
+    """
+
+    def __init__(self, storage: "RemoteDBChatHistoryStorage", debounce: float = None, max_turns: int = None,
+                 max_wait: float = None, min_chars: int = None, max_concurrency: int = None):
+        self.storage = storage
+        self.debounce = debounce if debounce is not None else settings.MEMORY_UPDATE_DEBOUNCE_SECONDS
+        self.max_turns = max_turns or settings.MEMORY_UPDATE_MAX_TURNS
+        self.max_wait = max_wait if max_wait is not None else settings.MEMORY_UPDATE_MAX_WAIT_SECONDS
+        self.min_chars = min_chars if min_chars is not None else settings.MEMORY_UPDATE_MIN_CHARS
+        self.semaphore = asyncio.Semaphore(max_concurrency or settings.MEMORY_UPDATE_MAX_CONCURRENCY)
+        self.pending: Dict[Tuple[str, str], _PendingMemoryUpdate] = {}
+        # 同一key的更新串行执行，避免两次读改写互相覆盖
+        self.running: Dict[Tuple[str, str], asyncio.Task] = {}
+
+        self.submitted = 0
+        self.skipped_trivial = 0
+        self.skipped_duplicate = 0
+        self.coalesced = 0
+        self.llm_updates = 0
+        self.failures = 0
+
+    def is_trivial(self, question: str) -> bool:
+        text = TRIVIAL_STRIP_PATTERN.sub("", question or "").lower()
+        return len(text) < self.min_chars or TRIVIAL_TURN_PATTERN.fullmatch(text) is not None
+
+    def submit(self, user_id, character_id, character_name, base_prompt, recent_chat_history, social_network,
+               long_chat_history, question, response_text):
+        self.submitted += 1
+        if self.is_trivial(question):
+            self.skipped_trivial += 1
+            return
+
+        key = (user_id, character_id)
+        pending = self.pending.get(key)
+        if pending is None:
+            pending = self.pending[key] = _PendingMemoryUpdate()
+        elif pending.turns and pending.turns[-1] == (question, response_text):
+            self.skipped_duplicate += 1
+            return
+        else:
+            self.coalesced += 1
+
+        pending.turns.append((question, response_text))
+        # 上下文以最新一轮为准
+        pending.context = dict(character_name=character_name, base_prompt=base_prompt,
+                               recent_chat_history=recent_chat_history, social_network=social_network,
+                               long_chat_history=long_chat_history)
+        if pending.timer is not None:
+            pending.timer.cancel()
+            pending.timer = None
+
+        remaining = pending.first_at + self.max_wait - time.monotonic()
+        if len(pending.turns) >= self.max_turns or remaining <= 0:
+            self._flush(key)
+        else:
+            pending.timer = asyncio.get_running_loop().call_later(min(self.debounce, remaining), self._flush, key)
+
+    def _flush(self, key: Tuple[str, str]):
+        pending = self.pending.pop(key, None)
+        if pending is None:
+            return
+        if pending.timer is not None:
+            pending.timer.cancel()
+        previous = self.running.get(key)
+        task = asyncio.create_task(self._run(key, pending, previous))
+        self.running[key] = task
+        task.add_done_callback(lambda t: self.running.pop(key, None) if self.running.get(key) is t else None)
+
+    async def _run(self, key: Tuple[str, str], pending: _PendingMemoryUpdate, previous: Optional[asyncio.Task]):
+        if previous is not None:
+            await asyncio.gather(previous, return_exceptions=True)
+        context = pending.context
+        # 多轮合并成一段对话记录，交给同一个prompt模板
+        *earlier, (question, response_text) = pending.turns
+        if earlier:
+            parts = [f"{earlier_question}\n{context['character_name']}：{earlier_response}"
+                     for earlier_question, earlier_response in earlier]
+            question = "\n用户：".join(parts + [question])
+
+        async with self.semaphore:
+            try:
+                self.llm_updates += 1
+                await self.storage.update_important_memories(
+                    key[0], key[1], context["character_name"], context["base_prompt"],
+                    context["recent_chat_history"], context["social_network"], context["long_chat_history"],
+                    question, response_text
+                )
+            except Exception as e:
+                self.failures += 1
+                await async_error_logger.error(f"Scheduled memory update for {key} failed: {e}")
+
+    async def close(self):
+        # 关闭前把还在等待的批次全部触发并等待完成
+        for key in list(self.pending):
+            self._flush(key)
+        if self.running:
+            await asyncio.gather(*self.running.values(), return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "submitted": self.submitted,
+            "skipped_trivial": self.skipped_trivial,
+            "skipped_duplicate": self.skipped_duplicate,
+            "coalesced": self.coalesced,
+            "llm_updates": self.llm_updates,
+            "failures": self.failures,
+            "pending": len(self.pending),
+            "running": len(self.running),
+        }
 
 
 class ChatHistory:
-    def __init__(self, redis_manager: RedisManager, milvus_manager: MilvusManager):
-        self.storage = RemoteDBChatHistoryStorage(redis_manager, milvus_manager)
+    def __init__(self, redis_manager: RedisManager, milvus_manager: MilvusManager,
+                 chat_writer: Optional[ChatWriteProducer] = None):
+        self.storage = RemoteDBChatHistoryStorage(redis_manager, milvus_manager, chat_writer=chat_writer)
+        self.memory_scheduler = (MemoryUpdateScheduler(self.storage)
+                                 if settings.MEMORY_UPDATE_SCHEDULER_ENABLED else None)
+        self.prefetch_flight = SingleFlight()
+        self.prefetch_tasks: Set[asyncio.Task] = set()
+
+    def prefetch(self, user_id, character_id) -> asyncio.Task:
+        """会话建立或websocket连接时调用，后台预热不阻塞调用方；同一会话正在进行的预热不重复发起"""
+        task = asyncio.ensure_future(self.prefetch_flight.do(
+            (user_id, character_id), lambda: self.storage.prefetch(user_id, character_id)))
+        self.prefetch_tasks.add(task)
+        task.add_done_callback(self.prefetch_tasks.discard)
+        return task
 
     async def get_recent_chat(self, user_id, character_id):
         return await self.storage.get_recent_chat(user_id, character_id)
 
+    async def get_recent_chat_many(self, pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[dict]]:
+        return await self.storage.get_recent_chat_many(pairs)
+
     async def put_recent_chat(self, user_id, character_id, data, max_records):
         await self.storage.put_recent_chat(user_id, character_id, data, max_records)
 
@@ -164,62 +669,168 @@ class ChatHistory:
     async def rm_recent_chat(self, user_id, character_id):
         await self.storage.rm_recent_chat(user_id, character_id)
 
+    async def rm_recent_chat_many(self, pairs: List[Tuple[str, str]]):
+        await self.storage.rm_recent_chat_many(pairs)
+
     async def rm_long_memory_chat(self, user_id, character_id):
         await self.storage.rm_long_memory_chat(user_id, character_id)
 
     async def update_important_memories(self, user_id, character_id, character_name, base_prompt,
                                         recent_chat_history, social_network,
                                         long_chat_history, question, response_text):
+        if self.memory_scheduler is not None:
+            # 只登记本轮对话，由调度器合并后异步更新
+            self.memory_scheduler.submit(user_id, character_id, character_name, base_prompt,
+                                         recent_chat_history, social_network,
+                                         long_chat_history, question, response_text)
+            return
         await self.storage.update_important_memories(user_id, character_id, character_name, base_prompt,
                                                      recent_chat_history, social_network,
                                                      long_chat_history, question, response_text)
 
-    async def get_important_memories(self, user_id, character_id):
-        return await self.storage.get_important_memories(user_id, character_id)
+    async def get_important_memories(self, user_id, character_id, question=None, k=None):
+        return await self.storage.get_important_memories(user_id, character_id, question, k)
+
+    async def get_important_memories_many(self, pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], Optional[str]]:
+        return await self.storage.get_important_memories_many(pairs)
 
     async def rm_importance_memories(self, user_id, character_id):
         await self.storage.rm_importance_memories(user_id, character_id)
 
-
-@async_retry(retries=3, delay=1)
-async def llm_update_memories(openai_apikey, model, messages, temperature=0, max_tokens=4000, response_format=None):
+    async def rm_importance_memories_many(self, pairs: List[Tuple[str, str]]):
+        await self.storage.rm_importance_memories_many(pairs)
+
+    async def build_context(self, user_id, character_id, question, deadline: Optional[float] = None) -> Dict:
+        return await self.storage.build_context(user_id, character_id, question, deadline)
+
+    def stats(self) -> Dict:
+        return {
+            "memory_scheduler": self.memory_scheduler.stats() if self.memory_scheduler else None,
+            "memory_prompt": memory_prompt_builder.stats(),
+            "memory_update_calls": memory_update_metrics.stats(),
+            "context": context_metrics.stats(),
+            "prefetch": {"executed": self.prefetch_flight.executed, "shared": self.prefetch_flight.shared,
+                         "in_flight": len(self.prefetch_flight)},
+            "important_memories": self.storage.memory_store.stats(),
+            "llm_response_cache": get_llm_response_cache().stats() if get_llm_response_cache() else None,
+        }
+
+    async def close(self):
+        for task in list(self.prefetch_tasks):
+            task.cancel()
+        if self.memory_scheduler is not None:
+            await self.memory_scheduler.close()
+
+
+@async_retry(retries=3, delay=1, no_retry=(RateLimitError,))
+async def llm_update_memories(model, messages, temperature=0, max_tokens=4000, response_format=None,
+                              priority=PRIORITY_BACKGROUND, cache_endpoint="memory_update", cache_scope=None):
+    """
+    model为OpenAI使用的模型，其他provider使用LLM_GATEWAY_MODELS中配置的模型；
+    cache_scope为响应所属的用户/角色，语义缓存只在相同cache_scope内匹配
+    """
     if response_format is None:
         response_format = {"type": "json_object"}
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {openai_apikey}"
-    }
-
-    data = {
-        "model": model,
-        "messages": messages,
+    params = {
         "temperature": temperature,
         "max_tokens": max_tokens
     }
-
     if response_format:
-        data["response_format"] = response_format
+        params["response_format"] = response_format
 
-    base_url = "https://api.openai.com/v1/chat/completions"
+    cache = get_llm_response_cache()
+    if cache is not None:
+        cached = await cache.get(cache_endpoint, model, messages, params, cache_scope)
+        if cached is not None:
+            return cached
 
+    limiter = get_llm_rate_limiter()
+    reserved = await limiter.acquire(estimate_tokens(messages, max_tokens), priority) if limiter else 0
     try:
-        connector = ProxyConnector.from_url(settings.PROXY_URL) if settings.IS_USE_PROXY else None
-
-        async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=40)) as session:
-            async with session.post(base_url, headers=headers, json=data, timeout=30) as response:
-                if response.status == 200:
-                    return await response.json()
-                else:
-                    error_content = await response.text()
-                    error_msg = f"Error in API call: Status {response.status}, Content: {error_content}"
-                    await async_error_logger.error(error_msg)
-                    raise Exception(error_msg)
-    except asyncio.TimeoutError:
-        await async_error_logger.error("Request timed out")
+        json_res = await get_llm_gateway().chat(messages, params, models={"openai": model})
+    except RateLimitError as e:
+        if limiter:
+            await limiter.reconcile(reserved, 0)
+            limiter.penalize(e.details.get("retry_after") or settings.LLM_RATE_LIMIT_429_PAUSE)
+        await async_error_logger.error(f"Error in API call: {str(e)}")
+        raise
+    except Exception as e:
+        if limiter:
+            await limiter.reconcile(reserved, 0)
+        await async_error_logger.error(f"Error in API call: {str(e)}")
         raise
-    except aiohttp.ClientError as e:
-        await async_error_logger.error(f"aiohttp client error: {str(e)}")
+    if limiter:
+        await limiter.reconcile(reserved, json_res.get("usage", {}).get("total_tokens", reserved))
+    if cache is not None and json_res.get("choices"):
+        await cache.set(cache_endpoint, model, messages, params, json_res, cache_scope)
+    return json_res
+
+
+@async_retry(retries=3, delay=1, no_retry=(RateLimitError,))
+async def llm_stream_memories(model, messages, temperature=0, max_tokens=4000, response_format=None,
+                              priority=PRIORITY_BACKGROUND, cache_endpoint="memory_update",
+                              field="updated_important_memories", cache_scope=None):
+    """
+    流式调用，field的值一完整就关闭连接，不再等待其余输出。
+    返回与llm_update_memories相同结构的结果，content中只包含field
+    """
+    if response_format is None:
+        response_format = {"type": "json_object"}
+    params = {
+        "temperature": temperature,
+        "max_tokens": max_tokens
+    }
+    if response_format:
+        params["response_format"] = response_format
+
+    cache = get_llm_response_cache()
+    if cache is not None:
+        cached = await cache.get(cache_endpoint, model, messages, params, cache_scope)
+        if cached is not None:
+            return cached
+
+    limiter = get_llm_rate_limiter()
+    reserved = await limiter.acquire(estimate_tokens(messages, max_tokens), priority) if limiter else 0
+    extractor = JsonFieldExtractor(field)
+    received = []
+    resolved, value = False, None
+    stream = get_llm_gateway().stream_chat(messages, params, models={"openai": model})
+    try:
+        async for delta in stream:
+            received.append(delta)
+            resolved, value = extractor.feed(delta)
+            if resolved:
+                break
+    except RateLimitError as e:
+        if limiter:
+            await limiter.reconcile(reserved, 0)
+            limiter.penalize(e.details.get("retry_after") or settings.LLM_RATE_LIMIT_429_PAUSE)
+        await async_error_logger.error(f"Error in API call: {str(e)}")
         raise
     except Exception as e:
-        await async_error_logger.exception(f"Error in API call: {str(e)}")
+        if limiter:
+            await limiter.reconcile(reserved, 0)
+        await async_error_logger.error(f"Error in API call: {str(e)}")
         raise
+    finally:
+        await stream.aclose()
+
+    text = "".join(received)
+    output_tokens = memory_prompt_builder.counter.count(text)
+    if limiter:
+        await limiter.reconcile(reserved, estimate_tokens(messages) + output_tokens)
+    if not resolved:
+        # 没能增量取到字段（如输出被截断或格式不符）时按完整文本解析
+        try:
+            value = json.loads(text).get(field)
+        except (ValueError, AttributeError) as e:
+            raise ModelError(f"Invalid streamed JSON response: {e}", details={"received_chars": len(text)})
+    json_res = {
+        "choices": [{"index": 0, "message": {"role": "assistant",
+                                             "content": json.dumps({field: value}, ensure_ascii=False)},
+                     "finish_reason": FIELD_RESOLVED if resolved else "stop"}],
+        "usage": {"completion_tokens": output_tokens},
+    }
+    if cache is not None:
+        await cache.set(cache_endpoint, model, messages, params, json_res, cache_scope)
+    return json_res
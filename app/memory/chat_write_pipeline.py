@@ -0,0 +1,220 @@
+# app/memory/chat_write_pipeline.py
+"""
+聊天记录写入Milvus的持久化异步管道。
+请求路径只往Redis Stream追加一条事件；worker通过消费组读取，按collection批量写入后ack。
+未ack的事件在worker重启/崩溃后由XAUTOCLAIM接管，超过最大投递次数的事件转入死信stream。
+"""
+import asyncio
+import os
+import socket
+import time
+from typing import Dict, List, Optional, Tuple
+
+from app.core.config import settings
+from app.core.logger import app_logger, async_app_logger, async_error_logger
+from app.storage.milvus_manager import MilvusManager
+from app.storage.redis_manager import RedisManager
+
+EVENT_TYPE_CHAT = "chat"
+
+
+class ChatWriteProducer:
+    def __init__(self, redis: RedisManager, stream: str = None, maxlen: Optional[int] = None):
+        self.redis = redis
+        self.stream = stream or settings.CHAT_WRITE_STREAM
+        self.maxlen = maxlen if maxlen is not None else settings.CHAT_WRITE_STREAM_MAXLEN
+        self.enqueued = 0
+
+    async def enqueue_chat(self, user_id, character_id, chat_history: str) -> str:
+        event = {
+            "type": EVENT_TYPE_CHAT,
+            "user_id": str(user_id),
+            "character_id": str(character_id),
+            "text": chat_history,
+            "ts": str(time.time()),
+        }
+        event_id = await self.redis.xadd(self.stream, event, maxlen=self.maxlen or None)
+        self.enqueued += 1
+        return event_id
+
+
+class ChatWriteWorker:
+    def __init__(self, redis: RedisManager, milvus_manager: MilvusManager, consumer: str, stream: str = None,
+                 group: str = None, dlq_stream: str = None, batch_size: int = None, block_ms: int = None,
+                 claim_idle_ms: int = None, max_deliveries: int = None):
+        self.redis = redis
+        self.milvus_manager = milvus_manager
+        self.consumer = consumer
+        self.stream = stream or settings.CHAT_WRITE_STREAM
+        self.group = group or settings.CHAT_WRITE_GROUP
+        self.dlq_stream = dlq_stream or settings.CHAT_WRITE_DLQ_STREAM
+        self.batch_size = batch_size or settings.CHAT_WRITE_BATCH_SIZE
+        self.block_ms = block_ms or settings.CHAT_WRITE_BLOCK_MS
+        self.claim_idle_ms = claim_idle_ms or settings.CHAT_WRITE_CLAIM_IDLE_MS
+        self.max_deliveries = max_deliveries or settings.CHAT_WRITE_MAX_DELIVERIES
+
+        self._stopping = False
+        self._claim_cursor = "0-0"
+        self._next_claim = 0.0
+
+        self.processed = 0
+        self.batches = 0
+        self.milvus_writes = 0
+        self.failed = 0
+        self.claimed = 0
+        self.dead_lettered = 0
+        self.last_lag_seconds = 0.0
+
+    async def run(self):
+        await self.redis.ensure_group(self.stream, self.group)
+        await async_app_logger.info(f"Chat write worker {self.consumer} started on {self.stream}/{self.group}")
+        while not self._stopping:
+            try:
+                messages = await self._claim_stale()
+                if not messages:
+                    res = await self.redis.xreadgroup(self.group, self.consumer, {self.stream: ">"},
+                                                      count=self.batch_size, block=self.block_ms)
+                    messages = res[0][1] if res else []
+                if messages:
+                    await self.process(messages)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await async_error_logger.error(f"Chat write worker {self.consumer} loop error: {e}")
+                await asyncio.sleep(1)
+        await async_app_logger.info(f"Chat write worker {self.consumer} stopped")
+
+    def stop(self):
+        self._stopping = True
+
+    async def _claim_stale(self) -> List[Tuple[str, Dict]]:
+        # 定期接管其他消费者（已崩溃或卡住）长时间未ack的事件
+        now = time.monotonic()
+        if now < self._next_claim:
+            return []
+        next_id, messages = await self.redis.xautoclaim(self.stream, self.group, self.consumer, self.claim_idle_ms,
+                                                        start_id=self._claim_cursor, count=self.batch_size)
+        self._claim_cursor = next_id
+        if next_id == "0-0" or not messages:
+            # 本轮扫描结束，等一个空闲周期后再扫
+            self._next_claim = now + self.claim_idle_ms / 2000
+        if not messages:
+            return []
+
+        self.claimed += len(messages)
+        pending = await self.redis.execute_pipeline([
+            ("xpending_range", self.stream, self.group, message_id, message_id, 1) for message_id, _ in messages
+        ])
+        deliveries = {entry["message_id"]: entry["times_delivered"] for entries in pending for entry in entries}
+        poisoned = [(message_id, fields) for message_id, fields in messages
+                    if deliveries.get(message_id, 0) > self.max_deliveries]
+        for message_id, fields in poisoned:
+            await self._dead_letter(message_id, fields, f"exceeded {self.max_deliveries} deliveries",
+                                    deliveries[message_id])
+        poisoned_ids = {message_id for message_id, _ in poisoned}
+        return [(message_id, fields) for message_id, fields in messages if message_id not in poisoned_ids]
+
+    async def process(self, messages: List[Tuple[str, Dict]]):
+        self.batches += 1
+        groups: Dict[str, List[Tuple[str, Tuple[str, str, str]]]] = {}
+        for message_id, fields in messages:
+            if fields.get("type") != EVENT_TYPE_CHAT or not fields.get("user_id") or not fields.get("character_id"):
+                await self._dead_letter(message_id, fields, "malformed event")
+                continue
+            chat = (fields["user_id"], fields["character_id"], fields.get("text", ""))
+            collection_name, _ = self.milvus_manager.chat_target(chat[0], chat[1])
+            groups.setdefault(collection_name, []).append((message_id, chat))
+            try:
+                self.last_lag_seconds = max(0.0, time.time() - float(fields.get("ts", 0)))
+            except ValueError:
+                pass
+
+        for collection_name, items in groups.items():
+            try:
+                self.milvus_writes += 1
+                await self.milvus_manager.save_chat_batch([chat for _, chat in items])
+                await self._ack([message_id for message_id, _ in items])
+            except Exception as e:
+                await async_error_logger.error(f"Batched chat write to {collection_name} failed, "
+                                               f"retrying {len(items)} events one by one: {e}")
+                await self._process_one_by_one(items)
+
+    async def _process_one_by_one(self, items: List[Tuple[str, Tuple[str, str, str]]]):
+        # 逐条重试，把失败隔离到单个事件；失败的事件保持pending，等待下次接管重试
+        for message_id, chat in items:
+            try:
+                self.milvus_writes += 1
+                await self.milvus_manager.save_chat_batch([chat])
+                await self._ack([message_id])
+            except Exception as e:
+                self.failed += 1
+                await async_error_logger.error(f"Chat write event {message_id} failed: {e}")
+
+    async def _ack(self, message_ids: List[str]):
+        await self.redis.xack(self.stream, self.group, *message_ids)
+        self.processed += len(message_ids)
+
+    async def _dead_letter(self, message_id: str, fields: Dict, reason: str, deliveries: int = 0):
+        await self.redis.xadd(self.dlq_stream, dict(fields, source_id=message_id, reason=reason,
+                                                    deliveries=str(deliveries), failed_at=str(time.time())))
+        await self.redis.xack(self.stream, self.group, message_id)
+        self.dead_lettered += 1
+        await async_error_logger.error(f"Chat write event {message_id} moved to {self.dlq_stream}: {reason}")
+
+    def stats(self) -> Dict:
+        return {
+            "consumer": self.consumer,
+            "processed": self.processed,
+            "batches": self.batches,
+            "milvus_writes": self.milvus_writes,
+            "failed": self.failed,
+            "claimed": self.claimed,
+            "dead_lettered": self.dead_lettered,
+            "last_lag_seconds": self.last_lag_seconds,
+        }
+
+
+class ChatWriteWorkerPool:
+    def __init__(self, workers: List[ChatWriteWorker]):
+        self.workers = workers
+        self.tasks: List[asyncio.Task] = []
+
+    def start(self):
+        self.tasks = [asyncio.create_task(worker.run()) for worker in self.workers]
+
+    async def stop(self, timeout: float = None):
+        for worker in self.workers:
+            worker.stop()
+        if not self.tasks:
+            return
+        # 等待当前批次写完；超时则取消，未ack的事件会在重启后被重新投递
+        timeout = timeout if timeout is not None else settings.CHAT_WRITE_BLOCK_MS / 1000 + 10
+        _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self) -> List[Dict]:
+        return [worker.stats() for worker in self.workers]
+
+
+def default_consumer_name(index: int = 0) -> str:
+    return f"{socket.gethostname()}-{os.getpid()}-{index}"
+
+
+async def setup_chat_write_workers(redis: RedisManager, milvus_manager: MilvusManager,
+                                   count: int = None) -> ChatWriteWorkerPool:
+    count = count or settings.CHAT_WRITE_WORKERS
+    await redis.ensure_group(settings.CHAT_WRITE_STREAM, settings.CHAT_WRITE_GROUP)
+    pool = ChatWriteWorkerPool([
+        ChatWriteWorker(redis, milvus_manager, default_consumer_name(i)) for i in range(count)
+    ])
+    pool.start()
+    app_logger.info(f"Chat write workers started: {count}")
+    return pool
+
+
+async def close_chat_write_workers(app):
+    if getattr(app.state, 'chat_write_workers', None) is not None:
+        await app.state.chat_write_workers.stop()
+    await async_app_logger.info("Chat write workers stopped")
@@ -0,0 +1,249 @@
+# app/memory/important_memories.py
+"""
+结构化的重要记忆：每条记忆一条记录（id、文本、时间戳、重要度），存在Redis hash中，
+向量单独存一个hash（float32字节），近端缓存只缓存不含向量的记录。
+只把与当前问题最相关的top-k条记忆放进prompt；旧版str(list)整块数据在读取时懒迁移。
+"""
+import hashlib
+import json
+import time
+from array import array
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from app.core.config import settings
+from app.core.logger import async_error_logger
+from app.storage.redis_manager import RedisManager
+
+LEGACY_MEMORY_PREFIX = "tw_important_memories_"
+# 新key不能以旧前缀开头，否则user_id为rec/vec的旧数据会和新记录撞key
+MEMORY_RECORDS_PREFIX = "tw_imem_rec:"
+MEMORY_VECTORS_PREFIX = "tw_imem_vec:"
+
+
+def memory_id(text: str) -> str:
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16]
+
+
+def memory_texts(records: Iterable[Dict]) -> Optional[str]:
+    """拼进prompt的文本：JSON数组，没有记忆时返回None"""
+    texts = [record["text"] for record in records]
+    return json.dumps(texts, ensure_ascii=False) if texts else None
+
+
+class ImportantMemoryStore:
+    def __init__(self, redis_manager: RedisManager, embeddings: Optional[Embeddings] = None):
+        self.redis_manager = redis_manager
+        self.embeddings = embeddings
+
+        self.searches = 0
+        self.vector_searches = 0
+        self.migrated = 0
+        self.embedded = 0
+
+    @staticmethod
+    def suffix_keys(suffix: str) -> Tuple[str, str, str]:
+        return f"{MEMORY_RECORDS_PREFIX}{suffix}", f"{MEMORY_VECTORS_PREFIX}{suffix}", f"{LEGACY_MEMORY_PREFIX}{suffix}"
+
+    def keys(self, user_id, character_id) -> Tuple[str, str, str]:
+        return self.suffix_keys(f"{user_id}_{character_id}")
+
+    def _decode_records(self, raw: Dict) -> List[Dict]:
+        codec = self.redis_manager.codec
+        records = [codec.decode(value) for value in (raw or {}).values()]
+        records.sort(key=lambda record: (-record["importance"], -record["updated_at"]))
+        return records
+
+    async def _embed(self, texts: List[str]) -> List[Optional[bytes]]:
+        if not texts or self.embeddings is None:
+            return [None] * len(texts)
+        try:
+            vectors = await self.embeddings.aembed_documents(texts)
+        except Exception as e:
+            await async_error_logger.error(f"Failed to embed important memories: {e}")
+            return [None] * len(texts)
+        self.embedded += len(texts)
+        return [array("f", vector).tobytes() for vector in vectors]
+
+    def _new_record(self, text: str, importance: float = None, now: float = None) -> Dict:
+        now = now or time.time()
+        return {
+            "id": memory_id(text),
+            "text": text,
+            "created_at": now,
+            "updated_at": now,
+            "importance": settings.MEMORY_IMPORTANCE_DEFAULT if importance is None else importance,
+        }
+
+    def _write_commands(self, records_key: str, vectors_key: str, upserts: List[Dict],
+                        vectors: List[Optional[bytes]], removed: Iterable[str]) -> List[Tuple]:
+        codec = self.redis_manager.codec
+        commands = []
+        removed = list(removed)
+        if removed:
+            commands += [("hdel", records_key, *removed), ("hdel", vectors_key, *removed)]
+        if upserts:
+            commands.append(("hset", records_key, None, None,
+                             {record["id"]: codec.encode(record) for record in upserts}))
+        vector_map = {record["id"]: vector for record, vector in zip(upserts, vectors) if vector is not None}
+        if vector_map:
+            commands.append(("hset", vectors_key, None, None, vector_map))
+        return commands
+
+    async def migrate(self, suffix: str) -> bool:
+        """把旧版tw_important_memories_{suffix}（str(list)或codec编码的list）转成记录，重复执行结果相同"""
+        records_key, vectors_key, legacy_key = self.suffix_keys(suffix)
+        legacy = await self.redis_manager.get_obj(legacy_key)
+        if legacy is None:
+            return False
+        if isinstance(legacy, str):
+            legacy = [legacy]
+        now = time.time()
+        texts = list(dict.fromkeys(str(item).strip() for item in legacy if str(item).strip()))
+        # 旧列表越靠前越早写入，按顺序给出递减的时间戳，保持原有顺序
+        records = [self._new_record(text, now=now - i) for i, text in enumerate(texts)]
+        vectors = await self._embed(texts)
+        commands = self._write_commands(records_key, vectors_key, records, vectors, ())
+        commands.append(("delete", legacy_key))
+        await self.redis_manager.execute_pipeline(commands, transaction=True, raw=True)
+        await self.redis_manager.invalidate(records_key, legacy_key)
+        self.migrated += 1
+        return True
+
+    async def _load_raw(self, user_id, character_id) -> List[Dict]:
+        records_key, _, _ = self.keys(user_id, character_id)
+        raw, = await self.redis_manager.execute_pipeline([("hgetall", records_key)], raw=True)
+        if not raw and await self.migrate(f"{user_id}_{character_id}"):
+            raw, = await self.redis_manager.execute_pipeline([("hgetall", records_key)], raw=True)
+        return self._decode_records(raw)
+
+    async def load(self, user_id, character_id) -> List[Dict]:
+        """全部记录，按重要度、更新时间倒序"""
+        records_key, _, _ = self.keys(user_id, character_id)
+        return await self.redis_manager.cached(records_key, lambda: self._load_raw(user_id, character_id))
+
+    async def load_many(self, pairs: List[Tuple[str, str]]) -> Dict[Tuple[str, str], List[Dict]]:
+        keys = {self.keys(user_id, character_id)[0]: (user_id, character_id) for user_id, character_id in pairs}
+
+        async def _load(missing: List[str]) -> Dict[str, Any]:
+            values = await self.redis_manager.execute_pipeline([("hgetall", key) for key in missing], raw=True,
+                                                               raise_on_error=False)
+            loaded = {}
+            for key, value in zip(missing, values):
+                try:
+                    if isinstance(value, Exception):
+                        raise value
+                    # 还是旧格式的key逐个迁移，数量很少
+                    loaded[key] = self._decode_records(value) if value else await self._load_raw(*keys[key])
+                except Exception as e:
+                    await async_error_logger.error(f"Failed to load important memories {key}: {e}")
+            return loaded
+
+        cached = await self.redis_manager.cached_many(list(keys), _load)
+        return {keys[key]: records for key, records in cached.items()}
+
+    async def search(self, user_id, character_id, question: Optional[str], k: int = None,
+                     query_vector: Optional[List[float]] = None) -> List[Dict]:
+        """
+        与question最相关的k条记忆：余弦相似度 + 重要度加权；记忆数不超过k或没有问题时按重要度返回。
+        query_vector为已算好的question向量，传入时不再重复embedding
+        """
+        k = k or settings.MEMORY_RECORDS_TOP_K
+        self.searches += 1
+        records = await self.load(user_id, character_id)
+        if len(records) <= k or not question or self.embeddings is None:
+            return records[:k]
+
+        self.vector_searches += 1
+        _, vectors_key, _ = self.keys(user_id, character_id)
+        ids = [record["id"] for record in records]
+        stored, = await self.redis_manager.execute_pipeline([("hmget", vectors_key, ids)], raw=True)
+        missing = [i for i, vector in enumerate(stored) if vector is None]
+        if missing:
+            # 迁移时没有embedding的记录在这里补齐
+            filled = await self._embed([records[i]["text"] for i in missing])
+            for i, vector in zip(missing, filled):
+                stored[i] = vector
+            updates = {ids[i]: stored[i] for i in missing if stored[i] is not None}
+            if updates:
+                await self.redis_manager.execute_pipeline([("hset", vectors_key, None, None, updates)], raw=True)
+
+        if query_vector is None:
+            query_vector = await self.embeddings.aembed_query(question)
+        query = np.array(query_vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        weight = settings.MEMORY_IMPORTANCE_WEIGHT
+        scored = []
+        for record, vector in zip(records, stored):
+            similarity = 0.0
+            if vector is not None:
+                vector = np.frombuffer(vector, dtype=np.float32)
+                similarity = float(vector @ query) / (float(np.linalg.norm(vector)) or 1.0)
+            scored.append((similarity + weight * record["importance"], record))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return [record for _, record in scored[:k]]
+
+    async def apply_update(self, user_id, character_id, shown: List[Dict], updated: List[Any]):
+        """
+        shown为放进prompt的记忆，updated为LLM返回的更新后列表。
+        只有shown中的记忆会被替换或删除，没放进prompt的记忆保持不变；
+        原样保留的记忆提高重要度，总数超过上限时淘汰重要度最低、最久未更新的
+        """
+        records_key, vectors_key, legacy_key = self.keys(user_id, character_id)
+        now = time.time()
+        previous = {record["text"]: record for record in shown}
+        upserts, new_records = [], []
+        for item in updated or []:
+            text = item.get("text") if isinstance(item, dict) else item
+            if not isinstance(text, str) or not text.strip():
+                continue
+            text = text.strip()
+            importance = item.get("importance") if isinstance(item, dict) else None
+            record = previous.pop(text, None)
+            if record is not None:
+                reinforced = min(1.0, record["importance"] + settings.MEMORY_IMPORTANCE_REINFORCE)
+                upserts.append(dict(record, updated_at=now,
+                                    importance=reinforced if importance is None else float(importance)))
+            elif all(text != r["text"] for r in new_records):
+                new_records.append(self._new_record(text, None if importance is None else float(importance), now))
+        removed = {record["id"] for record in previous.values()}
+
+        current = {record["id"]: record for record in await self._load_raw(user_id, character_id)}
+        for record_id in removed:
+            current.pop(record_id, None)
+        current.update((record["id"], record) for record in upserts + new_records)
+        overflow = len(current) - settings.MEMORY_RECORDS_MAX
+        if overflow > 0:
+            evicted = sorted(current.values(), key=lambda r: (r["importance"], r["updated_at"]))[:overflow]
+            evicted_ids = {record["id"] for record in evicted}
+            removed |= evicted_ids
+            upserts = [record for record in upserts if record["id"] not in evicted_ids]
+            new_records = [record for record in new_records if record["id"] not in evicted_ids]
+        # 新记忆和被删除的旧记忆可能是同一段文本，以写入为准
+        removed -= {record["id"] for record in upserts + new_records}
+
+        vectors = [None] * len(upserts) + await self._embed([record["text"] for record in new_records])
+        commands = self._write_commands(records_key, vectors_key, upserts + new_records, vectors, removed)
+        if commands:
+            await self.redis_manager.execute_pipeline(commands, transaction=True, raw=True)
+        await self.redis_manager.invalidate(records_key)
+
+    async def delete(self, user_id, character_id):
+        await self.delete_many([(user_id, character_id)])
+
+    async def delete_many(self, pairs: List[Tuple[str, str]]):
+        keys = [key for user_id, character_id in pairs for key in self.keys(user_id, character_id)]
+        if not keys:
+            return
+        await self.redis_manager.execute_pipeline([("delete", *keys)])
+        await self.redis_manager.invalidate(*keys)
+
+    def stats(self) -> Dict:
+        return {
+            "searches": self.searches,
+            "vector_searches": self.vector_searches,
+            "migrated": self.migrated,
+            "embedded": self.embedded,
+        }
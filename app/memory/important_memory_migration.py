@@ -0,0 +1,60 @@
+# app/memory/important_memory_migration.py
+"""
+把旧版tw_important_memories_* 列表数据一次性迁移为结构化记录。
+读取路径遇到旧数据时也会懒迁移，这个脚本用于上线后批量清理存量key；
+默认只迁移文本，向量在首次检索时补齐，加--embed时同时生成向量。
+
+python -m app.memory.important_memory_migration [--embed] [--dry-run]
+"""
+import argparse
+import asyncio
+from typing import Dict, Optional
+
+from app.core.config import settings
+from app.core.logger import async_app_logger, async_error_logger
+from app.memory.important_memories import LEGACY_MEMORY_PREFIX, ImportantMemoryStore
+from app.storage.milvus_manager import MilvusManager, setup_milvus
+from app.storage.redis_manager import RedisManager, setup_redis
+
+
+async def migrate_important_memories(redis_manager: RedisManager, milvus_manager: Optional[MilvusManager] = None,
+                                     dry_run: bool = False) -> Dict[str, int]:
+    store = ImportantMemoryStore(redis_manager, milvus_manager.embeddings if milvus_manager is not None else None)
+    summary = {"migrated": 0, "skipped": 0, "failed": 0}
+    async for key in redis_manager.scan_keys(f"{LEGACY_MEMORY_PREFIX}*"):
+        if dry_run:
+            summary["migrated"] += 1
+            continue
+        try:
+            if await store.migrate(key[len(LEGACY_MEMORY_PREFIX):]):
+                summary["migrated"] += 1
+            else:
+                summary["skipped"] += 1
+        except Exception as e:
+            summary["failed"] += 1
+            await async_error_logger.error(f"Failed to migrate {key}: {e}")
+    await async_app_logger.info(f"Important memory migration finished: {summary}")
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Migrate tw_important_memories_* lists into structured records")
+    parser.add_argument("--embed", action="store_true", help="embed memories during migration")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    redis_manager = await setup_redis()
+    milvus_manager = None
+    if args.embed:
+        milvus_manager = await setup_milvus(settings.OPENAI_APIKEY, redis=redis_manager,
+                                            host=settings.MILVUS_HOST, port=settings.MILVUS_PORT)
+    try:
+        print(await migrate_important_memories(redis_manager, milvus_manager, args.dry_run))
+    finally:
+        if milvus_manager is not None:
+            await milvus_manager.close()
+        await redis_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,53 @@
+# app/memory/recent_chat_migration.py
+"""
+把旧版tw_recent_data_* JSON整块存储一次性迁移到list+hash布局。
+读写路径遇到旧数据时也会懒迁移，这个脚本用于上线后批量清理存量key。
+
+python -m app.memory.recent_chat_migration [--max-records 14] [--dry-run]
+"""
+import argparse
+import asyncio
+from typing import Dict
+
+from app.core.logger import async_app_logger, async_error_logger
+from app.memory.chat_history_manager import RECENT_DATA_PREFIX, RemoteDBChatHistoryStorage
+from app.storage.redis_manager import RedisManager, setup_redis
+
+
+async def migrate_recent_chats(redis_manager: RedisManager, max_records: int = 14,
+                               dry_run: bool = False) -> Dict[str, int]:
+    # 迁移只涉及Redis，不需要Milvus
+    storage = RemoteDBChatHistoryStorage(redis_manager, None, max_records=max_records)
+    summary = {"migrated": 0, "skipped": 0, "failed": 0}
+    async for key in redis_manager.scan_keys(f"{RECENT_DATA_PREFIX}*"):
+        suffix = key[len(RECENT_DATA_PREFIX):]
+        if dry_run:
+            summary["migrated"] += 1
+            continue
+        try:
+            if await storage.migrate_recent_blob(suffix, max_records):
+                summary["migrated"] += 1
+            else:
+                summary["skipped"] += 1
+        except Exception as e:
+            summary["failed"] += 1
+            await async_error_logger.error(f"Failed to migrate {key}: {e}")
+    await async_app_logger.info(f"Recent chat migration finished: {summary}")
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Migrate tw_recent_data_* blobs into list+hash layout")
+    parser.add_argument("--max-records", type=int, default=14)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    redis_manager = await setup_redis()
+    try:
+        print(await migrate_recent_chats(redis_manager, args.max_records, args.dry_run))
+    finally:
+        await redis_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,194 @@
+# app/prompts/prompt_builder.py
+"""
+按token预算拼装prompt：每个段落单独计数，总量超出预算时从优先级最低的段落开始截断，
+整行截断并标注省略的行数，单行过长时再按token截断。每次调用返回各段落的token用量报告。
+"""
+from typing import Dict, List, Optional, Tuple
+
+import tiktoken
+
+from app.core.config import settings
+from app.core.logger import app_logger
+
+
+class TokenCounter:
+    """使用tiktoken计数；编码表加载失败（如离线环境下载不到）时退回字符估算"""
+
+    def __init__(self, encoding_name: str = None):
+        self.encoding_name = encoding_name or settings.PROMPT_TOKENIZER_ENCODING
+        self._encoding = None
+        self._loaded = False
+
+    @property
+    def encoding(self):
+        if not self._loaded:
+            self._loaded = True
+            try:
+                self._encoding = tiktoken.get_encoding(self.encoding_name)
+            except Exception as e:
+                app_logger.warning(f"tiktoken encoding {self.encoding_name} unavailable, estimating tokens: {e}")
+        return self._encoding
+
+    @property
+    def exact(self) -> bool:
+        return self.encoding is not None
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        # ASCII约4字符一个token，中日韩等字符约一字一个token
+        ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+        return (ascii_chars + 3) // 4 + (len(text) - ascii_chars)
+
+    def truncate(self, text: str, max_tokens: int, keep: str = "head") -> str:
+        """截断到max_tokens以内，keep=head保留开头，keep=tail保留结尾"""
+        if max_tokens <= 0:
+            return ""
+        if self.encoding is not None:
+            tokens = self.encoding.encode(text, disallowed_special=())
+            if len(tokens) <= max_tokens:
+                return text
+            tokens = tokens[:max_tokens] if keep == "head" else tokens[-max_tokens:]
+            return self.encoding.decode(tokens)
+        # 估算模式下按字符二分，找到不超过预算的最长前缀/后缀
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            part = text[:mid] if keep == "head" else text[-mid:]
+            if self.count(part) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low] if keep == "head" else text[len(text) - low:]
+
+
+class PromptSection:
+    """
+    priority越小越重要，超预算时先截断priority大的段落；
+    min_tokens为None表示不可截断，keep决定保留开头（检索结果按相关性排序）还是结尾（对话记录最新的在后）
+    """
+    __slots__ = ("name", "text", "priority", "min_tokens", "max_tokens", "keep", "empty")
+
+    def __init__(self, name: str, text: str, priority: int, min_tokens: Optional[int] = 0,
+                 max_tokens: Optional[int] = None, keep: str = "head", empty: str = "无"):
+        self.name = name
+        self.text = text if isinstance(text, str) else str(text)
+        self.priority = priority
+        self.min_tokens = min_tokens
+        self.max_tokens = max_tokens
+        self.keep = keep
+        self.empty = empty
+
+
+class PromptBuilder:
+    def __init__(self, budget: int = None, counter: TokenCounter = None):
+        self.budget = budget or settings.MEMORY_PROMPT_TOKEN_BUDGET
+        self.counter = counter or TokenCounter()
+
+        self.calls = 0
+        self.over_budget_calls = 0
+        self.tokens_total = 0
+        self.tokens_saved = 0
+        self.section_tokens: Dict[str, int] = {}
+        self.section_truncations: Dict[str, int] = {}
+        self._fixed_tokens: Dict[str, int] = {}
+
+    def fixed_tokens(self, text: str) -> int:
+        """模板里不变的部分（稳定前缀等）只计数一次"""
+        tokens = self._fixed_tokens.get(text)
+        if tokens is None:
+            tokens = self._fixed_tokens[text] = self.counter.count(text)
+        return tokens
+
+    def _shrink(self, section: PromptSection, text: str, max_tokens: int) -> str:
+        """整行截断并写明省略了多少行，剩一行仍超出时按token截断"""
+        lines = text.split("\n")
+        if len(lines) > 1:
+            kept: List[str] = []
+            used = 0
+            ordered = lines if section.keep == "head" else list(reversed(lines))
+            for line in ordered:
+                line_tokens = self.counter.count(line) + 1
+                if used + line_tokens > max_tokens:
+                    break
+                kept.append(line)
+                used += line_tokens
+            omitted = len(lines) - len(kept)
+            if kept and omitted:
+                marker = f"（已省略{omitted}行）"
+                while kept and used + self.counter.count(marker) + 1 > max_tokens:
+                    used -= self.counter.count(kept.pop()) + 1
+                    marker = f"（已省略{len(lines) - len(kept)}行）"
+                if kept:
+                    if section.keep == "head":
+                        return "\n".join(kept + [marker])
+                    return "\n".join([marker] + list(reversed(kept)))
+        return self.counter.truncate(text, max_tokens, section.keep)
+
+    def fit(self, sections: List[PromptSection], reserved_tokens: int = 0) -> Tuple[Dict[str, str], Dict]:
+        """
+        reserved_tokens为模板固定部分占用的token数。
+        返回段落名到最终文本的映射，以及本次调用的token报告
+        """
+        texts: Dict[str, str] = {}
+        tokens: Dict[str, int] = {}
+        original: Dict[str, int] = {}
+        for section in sections:
+            text = section.text.strip() or section.empty
+            original[section.name] = self.counter.count(text)
+            if section.max_tokens is not None and original[section.name] > section.max_tokens:
+                text = self._shrink(section, text, section.max_tokens)
+            texts[section.name] = text
+            tokens[section.name] = self.counter.count(text)
+
+        overflow = reserved_tokens + sum(tokens.values()) - self.budget
+        for section in sorted(sections, key=lambda s: s.priority, reverse=True):
+            if overflow <= 0:
+                break
+            if section.min_tokens is None or tokens[section.name] <= section.min_tokens:
+                continue
+            target = max(section.min_tokens, tokens[section.name] - overflow)
+            text = self._shrink(section, texts[section.name], target) if target else ""
+            texts[section.name] = text or section.empty
+            new_tokens = self.counter.count(texts[section.name])
+            overflow -= tokens[section.name] - new_tokens
+            tokens[section.name] = new_tokens
+
+        total = reserved_tokens + sum(tokens.values())
+        report = {
+            "budget": self.budget,
+            "total": total,
+            "reserved": reserved_tokens,
+            "exact": self.counter.exact,
+            "sections": {
+                name: {"tokens": tokens[name], "original": original[name], "truncated": tokens[name] < original[name]}
+                for name in texts
+            },
+        }
+        self._record(report)
+        return texts, report
+
+    def _record(self, report: Dict):
+        self.calls += 1
+        self.tokens_total += report["total"]
+        if report["total"] > self.budget:
+            self.over_budget_calls += 1
+        for name, section in report["sections"].items():
+            self.section_tokens[name] = self.section_tokens.get(name, 0) + section["tokens"]
+            if section["truncated"]:
+                self.section_truncations[name] = self.section_truncations.get(name, 0) + 1
+                self.tokens_saved += section["original"] - section["tokens"]
+
+    def stats(self) -> Dict:
+        return {
+            "budget": self.budget,
+            "exact_tokenizer": self.counter.exact,
+            "calls": self.calls,
+            "over_budget_calls": self.over_budget_calls,
+            "avg_tokens": self.tokens_total / self.calls if self.calls else 0.0,
+            "tokens_saved": self.tokens_saved,
+            "avg_section_tokens": {name: total / self.calls for name, total in self.section_tokens.items()},
+            "section_truncations": dict(self.section_truncations),
+        }
@@ -1,25 +1,9 @@
-from typing import Tuple
 import time
+from typing import Dict, Tuple
 
+from app.prompts.prompt_builder import PromptBuilder, PromptSection
 
-
-def create_memory_update_prompt(
-        previous_important_memories: str,
-        character_name: str,
-        base_prompt: str,
-        recent_chat_history: str,
-        social_network: str,
-        long_chat_history: str,
-        question: str,
-        response_text: str
-) -> Tuple[str, str]:
-    system_prompt = f"""
-你是一个专门用于更新AI角色重要记忆的助手。你的任务是分析对话内容，提取重要信息，并更新AI角色的重要记忆列表。请严格按照给定的步骤进行分析和更新，确保输出格式符合要求。
-
-AI角色名称：{character_name}
-
-AI角色设定：
-{base_prompt}
+_MEMORY_UPDATE_RULES = """你是一个专门用于更新AI角色重要记忆的助手。你的任务是分析对话内容，提取重要信息，并更新AI角色的重要记忆列表。请严格按照给定的步骤进行分析和更新，确保输出格式符合要求。
 
 评估重要性的标准：
 1. 用户的个人信息与特殊事件。
@@ -29,35 +13,6 @@ AI角色设定：
 6. 问题的相关性资料，要提取信息后保存记忆。
 
 请确保你的分析和更新过程考虑到这些因素。最终根据要求json格式输出
-"""
-
-    user_prompt = f"""
-请根据以下信息更新{character_name}的重要记忆列表：
-
-之前的重要记忆：
-```json
-{previous_important_memories}
-```
-
-近期对话历史：
-```
-{recent_chat_history}
-```
-
-{character_name}的对【最新对话】可能有用的相关性资料：
-```
-{social_network}
-```
-
-{character_name}的对【最新对话】可能相关的对话历史：
-```
-{long_chat_history}
-```
-
-【最新对话】：
-时间：{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}
-用户：{question}
-{character_name}：{response_text}
 
 请按照以下步骤更新重要记忆：
 
@@ -71,30 +26,32 @@ AI角色设定：
 8. 如果列表过长，删除或概括不太重要的旧记忆。
 9. 确保更新后的重要记忆列表不超过15条。
 
-请用以下JSON格式输出结果：
+"""
 
-{{
+_MEMORY_UPDATE_FORMAT = """请用以下JSON格式输出结果：
+
+{
     "thought_process": [
-        {{
+        {
             "step": 1,
             "analysis": "分析最新对话的结果"
-        }},
-        {{
+        },
+        {
             "step": 2,
             "evaluation": "评估重要信息的结果"
-        }},
-        {{
+        },
+        {
             "step": 3,
             "addition": "添加新信息的过程"
-        }},
-        {{
+        },
+        {
             "step": 4,
             "merge_update": "合并或更新信息的过程"
-        }},
-        {{
+        },
+        {
             "step": 5,
             "optimize": "删除或概括旧记忆的过程"
-        }}
+        }
     ],
     "updated_important_memories": [
         "更新后的重要记忆1",
@@ -104,9 +61,11 @@ AI角色设定：
         "更新后的重要记忆5",
         ...
     ]
-}}
+}
+
+"""
 
-示例输入和输出：
+_MEMORY_UPDATE_EXAMPLE_INPUT = """示例输入和输出：
 
 输入：
 当前重要记忆：
@@ -119,33 +78,35 @@ AI角色设定：
 最新对话：
 时间：2023-05-20 15:30:45
 用户：我今天在公司获得了一个大项目！
-{character_name}：太棒了！恭喜你获得大项目，这对你的职业发展一定很重要。能告诉我这个项目是关于什么的吗？
+AI角色：太棒了！恭喜你获得大项目，这对你的职业发展一定很重要。能告诉我这个项目是关于什么的吗？
 用户：是一个人工智能相关的项目，可能会耽误我的日本旅行计划。
-{character_name}：我明白了。这个AI项目听起来很exciting，但可能会影响到你的旅行计划。你有考虑过如何平衡工作和旅行吗？
+AI角色：我明白了。这个AI项目听起来很exciting，但可能会影响到你的旅行计划。你有考虑过如何平衡工作和旅行吗？
 
-示例输出：
-{{
+"""
+
+_MEMORY_UPDATE_EXAMPLE_OUTPUT = """示例输出：
+{
     "thought_process": [
-        {{
+        {
             "step": 1,
             "analysis": "用户获得了一个重要的AI项目，可能影响其日本旅行计划"
-        }},
-        {{
+        },
+        {
             "step": 2,
             "evaluation": "新项目信息很重要，显示了用户职业发展的重要里程碑。旅行计划可能改变也是重要信息"
-        }},
-        {{
+        },
+        {
             "step": 3,
             "addition": "添加'用户在公司获得了一个重要的人工智能项目'到重要记忆列表"
-        }},
-        {{
+        },
+        {
             "step": 4,
             "merge_update": "更新'用户计划在下个月去日本旅行'为'用户的日本旅行计划可能因工作项目而改变'"
-        }},
-        {{
+        },
+        {
             "step": 5,
             "optimize": "由于没有超过5条记忆，无需删除或概括"
-        }}
+        }
     ],
     "updated_important_memories": [
         "用户喜欢运动，特别是篮球",
@@ -154,9 +115,129 @@ AI角色设定：
         "用户的日本旅行计划可能因工作项目而改变",
         "用户对人工智能领域有职业兴趣"
     ]
-}}
+}
+"""
+
+# 精简模式不要求输出thought_process，减少输出token和等待时间
+_MEMORY_UPDATE_LEAN_FORMAT = """请用以下JSON格式输出结果，只输出更新后的重要记忆列表，不要输出分析过程：
+
+{
+    "updated_important_memories": [
+        "更新后的重要记忆1",
+        "更新后的重要记忆2",
+        ...
+    ]
+}
+
+"""
+
+_MEMORY_UPDATE_LEAN_EXAMPLE_OUTPUT = """示例输出：
+{
+    "updated_important_memories": [
+        "用户喜欢运动，特别是篮球",
+        "用户在科技公司工作",
+        "用户在公司获得了一个重要的人工智能项目",
+        "用户的日本旅行计划可能因工作项目而改变",
+        "用户对人工智能领域有职业兴趣"
+    ]
+}
+"""
+
+# 不随角色和对话变化的指令放在system prompt最前面，作为稳定前缀命中服务端的prompt缓存
+MEMORY_UPDATE_INSTRUCTIONS = (_MEMORY_UPDATE_RULES + _MEMORY_UPDATE_FORMAT + _MEMORY_UPDATE_EXAMPLE_INPUT
+                              + _MEMORY_UPDATE_EXAMPLE_OUTPUT)
+MEMORY_UPDATE_INSTRUCTIONS_LEAN = (_MEMORY_UPDATE_RULES + _MEMORY_UPDATE_LEAN_FORMAT + _MEMORY_UPDATE_EXAMPLE_INPUT
+                                   + _MEMORY_UPDATE_LEAN_EXAMPLE_OUTPUT)
+
+MEMORY_UPDATE_SYSTEM_TEMPLATE = """
+AI角色名称：{character_name}
+
+AI角色设定：
+{base_prompt}
+"""
+
+MEMORY_UPDATE_USER_TEMPLATE = """
+请根据以下信息更新{character_name}的重要记忆列表：
+
+之前的重要记忆：
+```json
+{previous_important_memories}
+```
+
+近期对话历史：
+```
+{recent_chat_history}
+```
+
+{character_name}的对【最新对话】可能有用的相关性资料：
+```
+{social_network}
+```
+
+{character_name}的对【最新对话】可能相关的对话历史：
+```
+{long_chat_history}
+```
+
+【最新对话】：
+时间：{now}
+{latest_turn}
 
 现在，请根据给定的信息，按照上述格式更新{character_name}的重要记忆列表。
 """
 
-    return system_prompt, user_prompt
\ No newline at end of file
+memory_prompt_builder = PromptBuilder()
+
+
+def build_memory_update_prompt(
+        previous_important_memories: str,
+        character_name: str,
+        base_prompt: str,
+        recent_chat_history: str,
+        social_network: str,
+        long_chat_history: str,
+        question: str,
+        response_text: str,
+        builder: PromptBuilder = None,
+        lean: bool = False
+) -> Tuple[str, str, Dict]:
+    """返回(system_prompt, user_prompt, token报告)，可变段落按预算截断；lean为True时输出不含thought_process"""
+    builder = builder or memory_prompt_builder
+    instructions = MEMORY_UPDATE_INSTRUCTIONS_LEAN if lean else MEMORY_UPDATE_INSTRUCTIONS
+    sections = [
+        # 旧记忆是本次更新的基础，不截断
+        PromptSection("previous_important_memories", previous_important_memories or "None", 0, min_tokens=None),
+        PromptSection("latest_turn", f"用户：{question}\n{character_name}：{response_text}", 1, min_tokens=512,
+                      keep="tail"),
+        PromptSection("base_prompt", base_prompt, 2, min_tokens=256),
+        PromptSection("recent_chat_history", recent_chat_history, 3, keep="tail"),
+        PromptSection("social_network", social_network, 4),
+        PromptSection("long_chat_history", long_chat_history, 5),
+    ]
+    reserved = (builder.fixed_tokens(instructions) + builder.fixed_tokens(MEMORY_UPDATE_SYSTEM_TEMPLATE)
+                + builder.fixed_tokens(MEMORY_UPDATE_USER_TEMPLATE) + 4 * builder.counter.count(character_name) + 16)
+    texts, report = builder.fit(sections, reserved_tokens=reserved)
+    now = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+    system_prompt = instructions + MEMORY_UPDATE_SYSTEM_TEMPLATE.format(
+        character_name=character_name, base_prompt=texts["base_prompt"])
+    user_prompt = MEMORY_UPDATE_USER_TEMPLATE.format(character_name=character_name, now=now, **{
+        name: text for name, text in texts.items() if name != "base_prompt"
+    })
+    return system_prompt, user_prompt, report
+
+
+def create_memory_update_prompt(
+        previous_important_memories: str,
+        character_name: str,
+        base_prompt: str,
+        recent_chat_history: str,
+        social_network: str,
+        long_chat_history: str,
+        question: str,
+        response_text: str
+) -> Tuple[str, str]:
+    system_prompt, user_prompt, _ = build_memory_update_prompt(
+        previous_important_memories, character_name, base_prompt, recent_chat_history,
+        social_network, long_chat_history, question, response_text
+    )
+    return system_prompt, user_prompt
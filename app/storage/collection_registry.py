@@ -0,0 +1,280 @@
+# app/storage/collection_registry.py
+"""
+Milvus collection注册表：Redis hash {collection名: JSON元数据}（created_at、doc_count、schema_version、
+当前版本等），最后访问时间单独存一个hash。新增/删除会写入changelog（zset，score为递增序号），
+各worker本地保存全部名字的Bloom filter和元数据LRU缓存，按changelog增量刷新。
+读路径只看本地视图，Bloom filter判定不存在的collection直接返回，不访问Redis，
+其他worker新建的名字最多延迟一个刷新间隔可见；创建、切换版本、删除等写路径直接读写Redis。
+"""
+import asyncio
+import json
+import time
+from typing import Dict, Optional
+
+from app.core.config import settings
+from app.core.logger import app_logger, async_error_logger
+from app.storage.redis_manager import RedisManager
+from app.utils.bloom import BloomFilter
+from app.utils.cache import LRUCache
+
+_MISSING = object()
+
+# 记录一次变更：序号递增，changelog超过上限时裁掉最旧的，并记下被裁掉的最大序号
+_BUMP_LUA = """
+local function bump(name, log_max)
+    local seq = redis.call('INCR', KEYS[2])
+    redis.call('ZADD', KEYS[3], seq, name)
+    local excess = redis.call('ZCARD', KEYS[3]) - log_max
+    if excess > 0 then
+        local removed = redis.call('ZRANGE', KEYS[3], 0, excess - 1, 'WITHSCORES')
+        redis.call('SET', KEYS[4], removed[#removed])
+        redis.call('ZREMRANGEBYRANK', KEYS[3], 0, excess - 1)
+    end
+end
+"""
+
+# KEYS: hash, seq, log, trimmed  ARGV: name, 字段JSON, doc_count增量, 当前时间, log上限, 是否记录变更
+UPDATE_SCRIPT = _BUMP_LUA + """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+local meta = current and cjson.decode(current) or {}
+for field, value in pairs(cjson.decode(ARGV[2])) do
+    meta[field] = value
+end
+local now = tonumber(ARGV[4])
+if not meta.created_at then
+    meta.created_at = now
+end
+meta.updated_at = now
+meta.doc_count = math.max(0, (meta.doc_count or 0) + tonumber(ARGV[3]))
+local encoded = cjson.encode(meta)
+redis.call('HSET', KEYS[1], ARGV[1], encoded)
+if not current or ARGV[6] == '1' then
+    bump(ARGV[1], tonumber(ARGV[5]))
+end
+return encoded
+"""
+
+# 只在未注册时写入，已注册时原样返回；不写physical，避免覆盖其他worker切换后的alias指向
+# KEYS: hash, seq, log, trimmed  ARGV: name, 字段JSON, 当前时间, log上限
+REGISTER_SCRIPT = _BUMP_LUA + """
+local current = redis.call('HGET', KEYS[1], ARGV[1])
+if current then
+    return current
+end
+local meta = cjson.decode(ARGV[2])
+meta.physical = nil
+meta.created_at = tonumber(ARGV[3])
+meta.updated_at = meta.created_at
+meta.doc_count = 0
+local encoded = cjson.encode(meta)
+redis.call('HSET', KEYS[1], ARGV[1], encoded)
+bump(ARGV[1], tonumber(ARGV[4]))
+return encoded
+"""
+
+# KEYS: hash, seq, log, trimmed, access  ARGV: name, log上限
+DELETE_SCRIPT = _BUMP_LUA + """
+redis.call('HDEL', KEYS[5], ARGV[1])
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 1 then
+    bump(ARGV[1], tonumber(ARGV[2]))
+end
+return 1
+"""
+
+
+class CollectionRegistry:
+    def __init__(self, redis_manager: RedisManager, key: str = None):
+        self.redis = redis_manager
+        self.key = key or settings.MILVUS_REGISTRY_KEY
+        self.seq_key = f"{self.key}:seq"
+        self.log_key = f"{self.key}:log"
+        self.trimmed_key = f"{self.key}:trimmed"
+        self.access_key = f"{self.key}:access"
+        self.bootstrap_key = f"{self.key}:bootstrapped"
+
+        self.bloom = BloomFilter(settings.MILVUS_REGISTRY_BLOOM_CAPACITY, settings.MILVUS_REGISTRY_BLOOM_ERROR_RATE)
+        self.meta = LRUCache(settings.MILVUS_REGISTRY_CACHE_SIZE)
+        self.touched = LRUCache(settings.MILVUS_REGISTRY_CACHE_SIZE)
+        self.accessed: Dict[str, float] = {}
+        self.seq = 0
+        # 未完成全量加载前Bloom filter不可信，所有查询都走Redis
+        self.loaded = False
+        self.loaded_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+        self.negative_hits = 0
+        self.cache_hits = 0
+        self.redis_lookups = 0
+        self.refreshes = 0
+        self.full_loads = 0
+
+    async def load(self):
+        """全量加载名字；先读序号再扫描，扫描期间的变更由下一次增量刷新补上"""
+        async with self.redis.get_connection() as conn:
+            seq = int(await conn.get(self.seq_key) or 0)
+            names = [name async for name, _ in conn.hscan_iter(self.key, count=1000)]
+        bloom = BloomFilter(max(settings.MILVUS_REGISTRY_BLOOM_CAPACITY, 2 * len(names)),
+                            settings.MILVUS_REGISTRY_BLOOM_ERROR_RATE)
+        for name in names:
+            bloom.add(name)
+        self.bloom, self.seq = bloom, seq
+        self.meta.clear()
+        self.loaded = True
+        self.loaded_at = time.monotonic()
+        self.full_loads += 1
+
+    async def refresh(self):
+        """按changelog增量刷新：变更过的名字加入Bloom filter并丢弃本地元数据"""
+        trimmed, changes = await self.redis.execute_pipeline([
+            ("get", self.trimmed_key),
+            ("zrangebyscore", self.log_key, f"({self.seq}", "+inf", None, None, True),
+        ])
+        if trimmed is not None and int(float(trimmed)) > self.seq:
+            # 落后太多，中间的变更已被裁掉，重新全量加载
+            await self.load()
+            return
+        for name, score in changes:
+            self.bloom.add(name)
+            self.meta.pop(name)
+            self.seq = max(self.seq, int(score))
+        self.refreshes += 1
+
+    async def get(self, name: str) -> Optional[Dict]:
+        """collection元数据，不存在时返回None"""
+        if self.loaded and name not in self.bloom:
+            self.negative_hits += 1
+            return None
+        meta = self.meta.get(name, _MISSING)
+        if meta is not _MISSING:
+            self.cache_hits += 1
+            return dict(meta) if meta is not None else None
+        return await self.fetch(name)
+
+    async def fetch(self, name: str) -> Optional[Dict]:
+        """跳过本地视图直接读Redis，结果写回本地缓存"""
+        self.redis_lookups += 1
+        raw, = await self.redis.execute_pipeline([("hget", self.key, name)])
+        meta = json.loads(raw) if raw else None
+        if meta is not None:
+            self.bloom.add(name)
+        self.meta.set(name, meta)
+        return dict(meta) if meta is not None else None
+
+    async def exists(self, name: str) -> bool:
+        return await self.get(name) is not None
+
+    async def describe(self, name: str) -> Optional[Dict]:
+        """元数据加上最后访问时间，用于排查"""
+        raw, last_access = await self.redis.execute_pipeline([("hget", self.key, name),
+                                                              ("hget", self.access_key, name)])
+        if not raw:
+            return None
+        return dict(json.loads(raw), last_access=float(last_access) if last_access else None)
+
+    async def update(self, name: str, fields: Optional[Dict] = None, doc_delta: int = 0, changed: bool = False):
+        """合并元数据字段并累加doc_count；新注册或changed为True时写入changelog"""
+        encoded = await self.redis.run_script(
+            UPDATE_SCRIPT,
+            [self.key, self.seq_key, self.log_key, self.trimmed_key],
+            [name, json.dumps(fields or {}), doc_delta, time.time(), settings.MILVUS_REGISTRY_LOG_MAX,
+             "1" if changed else "0"]
+        )
+        self.bloom.add(name)
+        self.meta.set(name, json.loads(encoded))
+
+    async def register(self, name: str, **fields):
+        await self.update(name, fields, changed=True)
+
+    async def register_if_absent(self, name: str, **fields) -> Dict:
+        """原子地注册尚不存在的collection，已注册时不做修改；返回当前元数据"""
+        fields.pop("physical", None)
+        encoded = await self.redis.run_script(
+            REGISTER_SCRIPT,
+            [self.key, self.seq_key, self.log_key, self.trimmed_key],
+            [name, json.dumps(fields), time.time(), settings.MILVUS_REGISTRY_LOG_MAX]
+        )
+        meta = json.loads(encoded)
+        self.bloom.add(name)
+        self.meta.set(name, meta)
+        return dict(meta)
+
+    async def unregister(self, name: str):
+        await self.redis.run_script(
+            DELETE_SCRIPT,
+            [self.key, self.seq_key, self.log_key, self.trimmed_key, self.access_key],
+            [name, settings.MILVUS_REGISTRY_LOG_MAX]
+        )
+        self.meta.set(name, None)
+        self.accessed.pop(name, None)
+
+    def touch(self, name: str):
+        """记录最后访问时间，同一collection按间隔合并，由刷新任务批量写入"""
+        now = time.time()
+        last = self.touched.get(name)
+        if last is None or now - last >= settings.MILVUS_REGISTRY_TOUCH_INTERVAL:
+            self.touched.set(name, now)
+            self.accessed[name] = now
+
+    async def flush_access(self):
+        if not self.accessed:
+            return
+        accessed, self.accessed = self.accessed, {}
+        await self.redis.execute_pipeline([("hset", self.access_key, None, None, accessed)])
+
+    async def is_bootstrapped(self) -> bool:
+        return await self.redis.get(self.bootstrap_key) is not None
+
+    async def bootstrap(self, entries: Dict[str, Dict]):
+        """第一次启用注册表时导入已有collection，重复执行结果相同"""
+        for name, fields in entries.items():
+            await self.update(name, fields)
+        await self.redis.set(self.bootstrap_key, str(len(entries)))
+        app_logger.info(f"Collection registry bootstrapped with {len(entries)} collections")
+
+    async def start(self):
+        try:
+            await self.load()
+        except Exception as e:
+            # 加载失败时查询全部走Redis，刷新任务会继续重试全量加载
+            await async_error_logger.error(f"Failed to load collection registry: {e}")
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+        app_logger.info(f"Collection registry loaded ({self.bloom.count} collections)")
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(settings.MILVUS_REGISTRY_REFRESH_INTERVAL)
+            try:
+                # 定期全量重建，清掉已删除的名字
+                stale = time.monotonic() - self.loaded_at >= settings.MILVUS_REGISTRY_FULL_RELOAD_INTERVAL
+                if not self.loaded or stale:
+                    await self.load()
+                else:
+                    await self.refresh()
+                await self.flush_access()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await async_error_logger.error(f"Collection registry refresh failed: {e}")
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        try:
+            await self.flush_access()
+        except Exception as e:
+            await async_error_logger.error(f"Failed to flush collection access times: {e}")
+
+    def stats(self) -> Dict:
+        return {
+            "loaded": self.loaded,
+            "known": self.bloom.count,
+            "seq": self.seq,
+            "negative_hits": self.negative_hits,
+            "cache_hits": self.cache_hits,
+            "redis_lookups": self.redis_lookups,
+            "refreshes": self.refreshes,
+            "full_loads": self.full_loads,
+            "pending_access": len(self.accessed),
+        }
@@ -0,0 +1,223 @@
+import asyncio
+import base64
+import hashlib
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional
+
+from langchain_core.embeddings import Embeddings
+
+from app.core.config import settings
+from app.core.logger import error_logger
+from app.storage.redis_manager import RedisManager
+from app.utils.cache import LRUCache
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    两级embedding缓存：进程内LRU + Redis共享缓存。
+    key为 模型名 + 文本sha256，value为float32向量（Redis中以base64存储）。
+    """
+
+    def __init__(self, embeddings: Embeddings, redis: Optional[RedisManager] = None,
+                 model_name: Optional[str] = None, max_size: int = None, ttl: Optional[int] = None,
+                 redis_timeout: float = None, namespace: str = "emb_cache"):
+        self.embeddings = embeddings
+        self.redis = redis
+        self.model_name = model_name or getattr(embeddings, "model", None) or embeddings.__class__.__name__
+        self.namespace = namespace
+        self.ttl = settings.EMBEDDING_CACHE_TTL if ttl is None else ttl
+        self.redis_timeout = settings.EMBEDDING_CACHE_REDIS_TIMEOUT if redis_timeout is None else redis_timeout
+        self.local_cache = LRUCache(settings.EMBEDDING_CACHE_SIZE if max_size is None else max_size)
+        try:
+            # 同步接口运行在线程池中，需要借助事件循环访问Redis
+            self.loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.loop = None
+
+        # 后台Redis写入任务，保留引用避免被回收，关闭时等待写完
+        self.write_tasks = set()
+        self._stats_lock = threading.Lock()
+        self.local_hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.redis_errors = 0
+        self.embed_calls = 0
+        self.embed_seconds = 0.0
+        self.chars_saved = 0
+
+    def _key(self, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{self.namespace}:{self.model_name}:{digest}"
+
+    @staticmethod
+    def _pack(vector: List[float]) -> array:
+        return array("f", vector)
+
+    @staticmethod
+    def _encode(vector: array) -> str:
+        return base64.b64encode(vector.tobytes()).decode("ascii")
+
+    @staticmethod
+    def _decode(value: str) -> array:
+        vector = array("f")
+        vector.frombytes(base64.b64decode(value))
+        return vector
+
+    def _lookup_local(self, texts: List[str], keys: List[str]) -> Dict[int, array]:
+        found = {}
+        for i, key in enumerate(keys):
+            vector = self.local_cache.get(key)
+            if vector is not None:
+                found[i] = vector
+        with self._stats_lock:
+            self.local_hits += len(found)
+            self.chars_saved += sum(len(texts[i]) for i in found)
+        return found
+
+    def _apply_redis_values(self, texts: List[str], keys: List[str], indexes: List[int], values,
+                            found: Dict[int, array]):
+        hits = 0
+        for i, value in zip(indexes, values or []):
+            if value is None:
+                continue
+            try:
+                vector = self._decode(value)
+            except Exception:
+                continue
+            found[i] = vector
+            self.local_cache.set(keys[i], vector)
+            hits += 1
+        with self._stats_lock:
+            self.redis_hits += hits
+            self.chars_saved += sum(len(texts[i]) for i in indexes if i in found)
+
+    def _record_embed(self, count: int, elapsed: float):
+        with self._stats_lock:
+            self.misses += count
+            self.embed_calls += 1
+            self.embed_seconds += elapsed
+
+    def _store(self, keys: List[str], vectors: List[array]):
+        for key, vector in zip(keys, vectors):
+            self.local_cache.set(key, vector)
+        if self.redis is None:
+            return None
+        return [("set", key, self._encode(vector), self.ttl) for key, vector in zip(keys, vectors)]
+
+    async def _redis_mget(self, keys: List[str]):
+        try:
+            return await asyncio.wait_for(self.redis.mget(keys), timeout=self.redis_timeout)
+        except Exception as e:
+            with self._stats_lock:
+                self.redis_errors += 1
+            error_logger.warning(f"Embedding cache redis lookup failed: {e}")
+            return None
+
+    async def _redis_write(self, commands):
+        try:
+            await self.redis.execute_pipeline(commands)
+        except Exception as e:
+            with self._stats_lock:
+                self.redis_errors += 1
+            error_logger.warning(f"Embedding cache redis write failed: {e}")
+
+    def _spawn_write(self, commands):
+        # 写入不阻塞调用方；必须在事件循环线程中调用
+        task = asyncio.ensure_future(self._redis_write(commands))
+        self.write_tasks.add(task)
+        task.add_done_callback(self.write_tasks.discard)
+
+    def _can_bridge(self) -> bool:
+        if self.redis is None or self.loop is None or not self.loop.is_running():
+            return False
+        try:
+            return asyncio.get_running_loop() is not self.loop
+        except RuntimeError:
+            return True
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = self._lookup_local(texts, keys)
+
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing and self._can_bridge():
+            future = asyncio.run_coroutine_threadsafe(self._redis_mget([keys[i] for i in missing]), self.loop)
+            try:
+                values = future.result(timeout=self.redis_timeout + 0.05)
+            except Exception:
+                future.cancel()
+                values = None
+            self._apply_redis_values(texts, keys, missing, values, found)
+
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing:
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            start = time.perf_counter()
+            embedded = self.embeddings.embed_documents(unique)
+            self._record_embed(len(unique), time.perf_counter() - start)
+            vectors = [self._pack(vector) for vector in embedded]
+            commands = self._store([self._key(text) for text in unique], vectors)
+            by_text = dict(zip(unique, vectors))
+            for i in missing:
+                found[i] = by_text[texts[i]]
+            if commands and self._can_bridge():
+                self.loop.call_soon_threadsafe(self._spawn_write, commands)
+
+        return [found[i].tolist() for i in range(len(texts))]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(text) for text in texts]
+        found = self._lookup_local(texts, keys)
+
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing and self.redis is not None:
+            values = await self._redis_mget([keys[i] for i in missing])
+            self._apply_redis_values(texts, keys, missing, values, found)
+
+        missing = [i for i in range(len(texts)) if i not in found]
+        if missing:
+            unique = list(dict.fromkeys(texts[i] for i in missing))
+            start = time.perf_counter()
+            embedded = await self.embeddings.aembed_documents(unique)
+            self._record_embed(len(unique), time.perf_counter() - start)
+            vectors = [self._pack(vector) for vector in embedded]
+            commands = self._store([self._key(text) for text in unique], vectors)
+            by_text = dict(zip(unique, vectors))
+            for i in missing:
+                found[i] = by_text[texts[i]]
+            if commands:
+                self._spawn_write(commands)
+
+        return [found[i].tolist() for i in range(len(texts))]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        return (await self.aembed_documents([text]))[0]
+
+    async def close(self):
+        if self.write_tasks:
+            await asyncio.gather(*self.write_tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            hits = self.local_hits + self.redis_hits
+            lookups = hits + self.misses
+            seconds_per_text = self.embed_seconds / self.misses if self.misses else 0.0
+            return {
+                "model": self.model_name,
+                "local_hits": self.local_hits,
+                "redis_hits": self.redis_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "redis_errors": self.redis_errors,
+                "embed_calls": self.embed_calls,
+                "embed_seconds": self.embed_seconds,
+                "estimated_seconds_saved": hits * seconds_per_text,
+                "chars_saved": self.chars_saved,
+                "pending_writes": len(self.write_tasks),
+                "local_cache": self.local_cache.stats(),
+            }
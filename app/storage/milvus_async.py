@@ -0,0 +1,151 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+from langchain_core.documents import Document
+from pymilvus import AsyncMilvusClient, CollectionSchema, MilvusClient
+
+from app.core.exceptions import MilvusError
+
+
+class AsyncCollectionHandle:
+    """异步模式下的collection句柄：只保存schema信息，数据面请求都通过AsyncMilvusClient发出"""
+
+    def __init__(self, collection_name: str, fields: List[str], vector_field: str):
+        self.collection_name = collection_name
+        self.fields = fields
+        self.output_fields = [field for field in fields if field != vector_field]
+
+
+class AsyncMilvusBackend:
+    """
+    基于pymilvus AsyncMilvusClient的原生asyncio访问路径。
+    用信号量限制同时在途的请求数，等待队列超过上限时直接拒绝，避免请求在线程池里无声排队。
+    """
+
+    def __init__(self, uri: str, max_concurrency: int, max_queue: int, timeout: Optional[float] = None,
+                 text_field: str = "text", vector_field: str = "vector", search_params: Optional[Dict] = None):
+        self.client = AsyncMilvusClient(uri=uri, timeout=timeout)
+        self.timeout = timeout
+        self.text_field = text_field
+        self.vector_field = vector_field
+        self.search_params = search_params or {}
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.calls = 0
+        self.rejected = 0
+        self.max_waiting = 0
+
+    @asynccontextmanager
+    async def _slot(self, operation: str):
+        if self.semaphore.locked() and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise MilvusError("Milvus async request queue is full", operation=operation,
+                              details={"max_queue": self.max_queue, "max_concurrency": self.max_concurrency})
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        self.calls += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    async def describe(self, collection_name: str) -> Optional[AsyncCollectionHandle]:
+        async with self._slot("describe"):
+            if not await self.client.has_collection(collection_name, timeout=self.timeout):
+                return None
+            desc = await self.client.describe_collection(collection_name, timeout=self.timeout)
+        return AsyncCollectionHandle(collection_name, [field["name"] for field in desc["fields"]], self.vector_field)
+
+    async def create(self, collection_name: str, schema: CollectionSchema, index_params: Dict,
+                     **kwargs) -> AsyncCollectionHandle:
+        params = MilvusClient.prepare_index_params()
+        params.add_index(
+            self.vector_field,
+            index_type=index_params["index_type"],
+            metric_type=index_params["metric_type"],
+            params=index_params.get("params", {})
+        )
+        async with self._slot("create"):
+            await self.client.create_collection(
+                collection_name, schema=schema, index_params=params, timeout=self.timeout, **kwargs
+            )
+        return AsyncCollectionHandle(collection_name, [field.name for field in schema.fields], self.vector_field)
+
+    async def load(self, collection_name: str):
+        async with self._slot("load"):
+            await self.client.load_collection(collection_name, timeout=self.timeout)
+
+    async def insert(self, handle: AsyncCollectionHandle, rows: List[Dict]) -> List:
+        if not rows:
+            return []
+        async with self._slot("insert"):
+            res = await self.client.insert(handle.collection_name, rows, timeout=self.timeout)
+        return list(res.get("ids", []))
+
+    async def search(self, handle: AsyncCollectionHandle, vectors: List[List[float]], k: int,
+                     expr: Optional[str] = None) -> List[List[Tuple[Document, float]]]:
+        async with self._slot("search"):
+            res = await self.client.search(
+                handle.collection_name,
+                data=vectors,
+                filter=expr or "",
+                limit=k,
+                output_fields=handle.output_fields,
+                search_params=self.search_params,
+                anns_field=self.vector_field,
+                timeout=self.timeout
+            )
+
+        results = []
+        for hits in res:
+            ret = []
+            for hit in hits:
+                metadata = dict(hit["entity"])
+                text = metadata.pop(self.text_field, "")
+                ret.append((Document(page_content=text, metadata=metadata), hit["distance"]))
+            results.append(ret)
+        return results
+
+    async def query(self, handle: AsyncCollectionHandle, expr: str, output_fields: List[str],
+                    limit: int) -> List[Dict]:
+        async with self._slot("query"):
+            return await self.client.query(handle.collection_name, filter=expr, output_fields=output_fields,
+                                           limit=limit, timeout=self.timeout)
+
+    async def delete(self, handle: AsyncCollectionHandle, expr: str):
+        async with self._slot("delete"):
+            await self.client.delete(handle.collection_name, filter=expr, timeout=self.timeout)
+
+    async def drop(self, collection_name: str):
+        async with self._slot("drop"):
+            await self.client.drop_collection(collection_name, timeout=self.timeout)
+
+    async def admin(self, operation: str, *args):
+        """list_collections/create_alias/alter_alias/drop_alias/drop_collection等管理操作，参数顺序与pymilvus一致"""
+        async with self._slot(operation):
+            return await getattr(self.client, operation)(*args, timeout=self.timeout)
+
+    def stats(self) -> Dict:
+        return {
+            "max_concurrency": self.max_concurrency,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "calls": self.calls,
+            "rejected": self.rejected,
+        }
+
+    async def close(self):
+        await self.client.close()
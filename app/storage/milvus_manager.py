@@ -1,146 +1,756 @@
+import hashlib
 import json
-from typing import Dict, List, Optional
+import re
+import time
+from typing import Any, Dict, List, Optional, Tuple
 from langchain_openai import OpenAIEmbeddings
 from langchain_community.vectorstores.milvus import Milvus
 from langchain_text_splitters import CharacterTextSplitter
 from app.core.logger import app_logger, async_error_logger, async_app_logger
 import asyncio
+from contextlib import AsyncExitStack
 from app.core.config import settings
 from app.storage.redis_manager import RedisManager
+from app.storage.collection_registry import CollectionRegistry
+from app.storage.embedding_cache import CachedEmbeddings
+from app.storage.search_batcher import SearchBatcher, search_by_vectors
+from app.utils.cache import LRUCache
+from app.utils.concurrency import KeyedRWLock, SingleFlight
 from concurrent.futures import ThreadPoolExecutor
+from pymilvus import Collection, CollectionSchema, DataType, FieldSchema, connections, utility
+
+PRIMARY_FIELD = "pk"
+TEXT_FIELD = "text"
+VECTOR_FIELD = "vector"
+LEGACY_PLACEHOLDER_TEXT = "None"
+TENANT_FIELD_MAX_LENGTH = 512
+# 共享collection模式下的租户字段，第一个字段作为partition key
+CHAT_TENANT_FIELDS = ("tenant_id", "user_id", "character_id")
+SOCIAL_TENANT_FIELDS = ("character_id",)
+# build_collection_schema的字段布局版本，记录在注册表中，schema变化时递增
+COLLECTION_SCHEMA_VERSION = 1
+ADMIN_CONNECTION_ALIAS = "milvus_admin"
+# 与langchain Milvus默认建索引/检索参数一致
+INDEX_PARAMS = {"metric_type": "L2", "index_type": "HNSW", "params": {"M": 8, "efConstruction": 64}}
+SEARCH_PARAMS = {"metric_type": "L2", "params": {"ef": 10}}
+# 蓝绿重建：实体collection为{name}__v{n}，name是指向当前版本的alias，注册表记录当前版本
+VERSIONED_COLLECTION_PATTERN = re.compile(r"^(?P<name>.+)__v(?P<version>\d+)$")
+# 社交资料的chunk索引：Redis hash，field为资料key，value为该key下各chunk的[内容哈希, 主键]列表
+SOCIAL_INDEX_PREFIX = "tw_social_chunks_"
+# 同一角色的增量更新跨worker互斥，避免并发的读索引-写Milvus-写索引互相覆盖
+SOCIAL_INDEX_LOCK_PREFIX = "tw_social_chunks_lock_"
+SOCIAL_SPLITTER = CharacterTextSplitter(chunk_size=800, chunk_overlap=0)
+# 重建锁：持有期间的追加写入journal（Redis list），重建结束时与释放锁一起原子取出；
+# 未进journal的追加计入in-flight计数，重建拿到锁后等计数归零再开始，追加要么先于重建完成，要么进journal
+REBUILD_LOCK_PREFIX = "milvus_rebuild_lock_"
+# KEYS: 重建锁, journal, in-flight计数  ARGV: 文本JSON, journal过期时间, 计数过期时间（毫秒）
+# 返回{1}表示已写入journal；返回{0, ...}表示计数已加一，附带上次补写失败留在journal里的数据由调用方一并写入
+JOURNAL_APPEND_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RPUSH', KEYS[2], ARGV[1])
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+    return {1}
+end
+redis.call('INCR', KEYS[3])
+redis.call('PEXPIRE', KEYS[3], ARGV[3])
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+table.insert(items, 1, 0)
+return items
+"""
+# KEYS: in-flight计数；计数过期后再减会变成负数，归零即删除
+APPEND_DONE_SCRIPT = """
+if redis.call('DECR', KEYS[1]) <= 0 then
+    redis.call('DEL', KEYS[1])
+end
+return 1
+"""
+# KEYS: 重建锁, journal  ARGV: 锁token
+JOURNAL_DRAIN_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+local items = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return items
+"""
+
+
+def build_collection_schema(tenant_fields: Tuple[str, ...] = ()) -> Tuple[CollectionSchema, Dict]:
+    # 字段顺序与Milvus.from_texts建出的collection保持一致：元数据字段在前
+    fields = [FieldSchema(field, DataType.VARCHAR, max_length=TENANT_FIELD_MAX_LENGTH) for field in tenant_fields]
+    fields += [
+        FieldSchema(TEXT_FIELD, DataType.VARCHAR, max_length=65_535),
+        FieldSchema(PRIMARY_FIELD, DataType.INT64, is_primary=True, auto_id=True),
+        FieldSchema(VECTOR_FIELD, DataType.FLOAT_VECTOR, dim=settings.MILVUS_EMBEDDING_DIM),
+    ]
+    if not tenant_fields:
+        return CollectionSchema(fields), {}
+    # 共享collection以第一个租户字段作为partition key
+    schema = CollectionSchema(fields, partition_key_field=tenant_fields[0])
+    return schema, {"num_partitions": settings.MILVUS_SHARED_NUM_PARTITIONS}
 
 
 class MilvusManager:
     def __init__(self, connection_args: Dict, embedding_api_key: str, redis: RedisManager, max_workers: int = 10):
         self.connection_args = connection_args
         client = settings.PROXY_HTTP_CLIENT if settings.IS_USE_PROXY else None
-        self.embeddings = OpenAIEmbeddings(openai_api_key=embedding_api_key, http_client=client)
+        async_client = settings.ASYNC_PROXY_HTTP_CLIENT if settings.IS_USE_PROXY else None
+        self.embeddings = CachedEmbeddings(
+            OpenAIEmbeddings(openai_api_key=embedding_api_key, http_client=client, http_async_client=async_client),
+            redis=redis
+        )
         self.redis = redis
-        self.local_dict: Dict[str, Milvus] = {}
+        self.registry = CollectionRegistry(redis)
         self.thread_pool = ThreadPoolExecutor(max_workers=max_workers)
+        self.local_dict = LRUCache(
+            settings.MILVUS_HANDLE_CACHE_SIZE,
+            ttl=settings.MILVUS_HANDLE_CACHE_TTL or None,
+            on_evict=self._release_handle,
+            refresh_on_get=True
+        )
+        self.open_flight = SingleFlight()
+        self.collection_locks = KeyedRWLock()
+        self.open_semaphore = asyncio.Semaphore(settings.MILVUS_MAX_CONCURRENT_OPENS)
+        self.opens = 0
+        # 已加载到Milvus内存的句柄，句柄变化（淘汰后重新打开、重建）时需要重新加载
+        self.loaded_handles: Dict[str, Any] = {}
+        self.loads = 0
+        self.releases = 0
+        self.social_updates = {"incremental": 0, "full": 0, "added": 0, "deleted": 0, "unchanged": 0}
+        self.rebuilds = 0
+        self.rebuild_failures = 0
+        self.background_tasks = set()
+        self.async_backend = None
+        if settings.MILVUS_CLIENT_MODE == "async":
+            from app.storage.milvus_async import AsyncMilvusBackend
+            self.async_backend = AsyncMilvusBackend(
+                connection_args.get("uri") or f"http://{connection_args['host']}:{connection_args['port']}",
+                max_concurrency=settings.MILVUS_ASYNC_MAX_CONCURRENCY,
+                max_queue=settings.MILVUS_ASYNC_MAX_QUEUE,
+                timeout=settings.MILVUS_ASYNC_TIMEOUT,
+                text_field=TEXT_FIELD,
+                vector_field=VECTOR_FIELD,
+                search_params=SEARCH_PARAMS
+            )
+        self.search_batcher = SearchBatcher(
+            self.embeddings,
+            self._search_vectors,
+            window_ms=settings.MILVUS_SEARCH_BATCH_WINDOW_MS,
+            max_batch_size=settings.MILVUS_SEARCH_BATCH_MAX_SIZE
+        ) if settings.MILVUS_SEARCH_BATCH_ENABLED else None
+
+    def _spawn(self, coro):
+        task = asyncio.ensure_future(coro)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    def _release_handle(self, collection_name: str, milvus):
+        self.loaded_handles.pop(collection_name, None)
+        # 被淘汰的句柄只释放本地引用；连接由同一地址的所有句柄共享，不在这里断开
+        if settings.MILVUS_RELEASE_ON_EVICT and isinstance(milvus, Milvus) and milvus.col is not None:
+            self._spawn(self._release_if_idle(collection_name, milvus))
+        app_logger.info(f"Milvus handle {collection_name} evicted")
+
+    async def _release_if_idle(self, collection_name: str, milvus: Milvus):
+        """release会让整个集群卸载该collection，只在所有worker都长时间未访问时执行"""
+        try:
+            await self.registry.flush_access()
+            meta = await self.registry.describe(collection_name)
+            if meta is None or self.local_dict.peek(collection_name) is not None:
+                return
+            if time.time() - (meta["last_access"] or 0) < settings.MILVUS_RELEASE_IDLE_SECONDS:
+                return
+            await asyncio.get_event_loop().run_in_executor(self.thread_pool, milvus.col.release)
+            self.releases += 1
+            await async_app_logger.info(f"Released idle collection {collection_name}")
+        except Exception as e:
+            await async_error_logger.error(f"Failed to release collection {collection_name}: {e}")
+
+    def _attach_milvus(self, collection_name: str) -> Milvus:
+        # 直接挂载已存在collection的schema和索引，不做embedding也不写入数据
+        return Milvus(
+            embedding_function=self.embeddings,
+            collection_name=collection_name,
+            connection_args=self.connection_args,
+            auto_id=True
+        )
+
+    def _create_milvus(self, collection_name: str, tenant_fields: Tuple[str, ...] = ()) -> Milvus:
+        milvus = self._attach_milvus(collection_name)
+        if milvus.col is not None:
+            return milvus
+
+        schema, kwargs = build_collection_schema(tenant_fields)
+        col = Collection(
+            name=collection_name,
+            schema=schema,
+            consistency_level=milvus.consistency_level,
+            using=milvus.alias,
+            **kwargs
+        )
+        col.create_index(VECTOR_FIELD, INDEX_PARAMS)
+        return self._attach_milvus(collection_name)
+
+    async def _open_handle(self, collection_name: str, tenant_fields: Tuple[str, ...] = (), create: bool = False):
+        if self.async_backend is not None:
+            handle = await self.async_backend.describe(collection_name)
+            if handle is None and create:
+                schema, kwargs = build_collection_schema(tenant_fields)
+                handle = await self.async_backend.create(collection_name, schema, INDEX_PARAMS, **kwargs)
+            return handle
+
+        loop = asyncio.get_event_loop()
+        if create:
+            milvus = await loop.run_in_executor(self.thread_pool, self._create_milvus, collection_name, tenant_fields)
+        else:
+            milvus = await loop.run_in_executor(self.thread_pool, self._attach_milvus, collection_name)
+        return milvus if milvus.col is not None else None
+
+    async def _insert(self, handle, texts: Optional[List[str]], metadatas: Optional[List[Dict]] = None) -> List:
+        if not texts:
+            return []
+        if self.async_backend is not None:
+            vectors = await self.embeddings.aembed_documents(texts)
+            metadatas = metadatas or [{} for _ in texts]
+            rows = [{TEXT_FIELD: text, VECTOR_FIELD: vector, **metadata}
+                    for text, vector, metadata in zip(texts, vectors, metadatas)]
+            return await self.async_backend.insert(handle, rows)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.thread_pool, lambda: handle.add_texts(texts, metadatas=metadatas)
+        )
+
+    async def _delete(self, handle, expr: str):
+        if self.async_backend is not None:
+            await self.async_backend.delete(handle, expr)
+        else:
+            await asyncio.get_event_loop().run_in_executor(self.thread_pool, handle.col.delete, expr)
+
+    async def _query(self, handle, expr: str, limit: int) -> List[Dict]:
+        if self.async_backend is not None:
+            return await self.async_backend.query(handle, expr, [PRIMARY_FIELD], limit)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.thread_pool, lambda: handle.col.query(expr, output_fields=[PRIMARY_FIELD], limit=limit)
+        )
+
+    async def _drop(self, handle):
+        if self.async_backend is not None:
+            await self.async_backend.drop(handle.collection_name)
+        else:
+            await asyncio.get_event_loop().run_in_executor(self.thread_pool, handle.col.drop)
+
+    async def _load(self, handle):
+        if self.async_backend is not None:
+            await self.async_backend.load(handle.collection_name)
+        else:
+            await asyncio.get_event_loop().run_in_executor(self.thread_pool, handle.col.load)
+
+    async def _admin(self, handle, operation: str, *args):
+        """collection/alias管理操作；线程池模式下借用handle的连接"""
+        if self.async_backend is not None:
+            return await self.async_backend.admin(operation, *args)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.thread_pool, lambda: getattr(utility, operation)(*args, using=handle.alias)
+        )
+
+    @staticmethod
+    def current_version(collection_name: str, physical: Optional[str]) -> Optional[str]:
+        """physical是collection_name的版本化实体collection时返回它，否则返回None"""
+        match = VERSIONED_COLLECTION_PATTERN.match(physical or "")
+        return physical if match and match["name"] == collection_name else None
+
+    async def _list_collections(self) -> List[str]:
+        if self.async_backend is not None:
+            return await self.async_backend.admin("list_collections")
+
+        def _list():
+            connections.connect(alias=ADMIN_CONNECTION_ALIAS, **self.connection_args)
+            return utility.list_collections(using=ADMIN_CONNECTION_ALIAS)
+
+        return await asyncio.get_event_loop().run_in_executor(self.thread_pool, _list)
+
+    async def bootstrap_registry(self) -> int:
+        """
+        第一次启用注册表时，按Milvus中已有的collection和旧版Redis裸key标记导入；
+        没有标记的collection原本也不会被get_or_create_milvus识别，不导入
+        """
+        if await self.registry.is_bootstrapped():
+            return 0
+        bases = set()
+        for name in await self._list_collections():
+            match = VERSIONED_COLLECTION_PATTERN.match(name)
+            bases.add(match["name"] if match else name)
+        bases = sorted(bases)
+        entries = {}
+        for i in range(0, len(bases), 1000):
+            chunk = bases[i:i + 1000]
+            for name, marker in zip(chunk, await self.redis.mget(chunk)):
+                if marker is not None:
+                    entries[name] = {"physical": self.current_version(name, marker),
+                                     "schema_version": COLLECTION_SCHEMA_VERSION}
+        await self.registry.bootstrap(entries)
+        return len(entries)
+
+    async def _count_docs(self, collection_name: str, delta: int):
+        # doc_count只是近似值：按条件删除的数据不扣减
+        if not delta:
+            return
+        try:
+            await self.registry.update(collection_name, doc_delta=delta)
+        except Exception as e:
+            await async_error_logger.error(f"Failed to update doc count of {collection_name}: {e}")
+
+    async def _search_vectors(self, collection_name: str, handle, vectors: List[List[float]], k: int,
+                              expr: Optional[str] = None) -> List[List]:
+        if self.async_backend is not None:
+            return await self.async_backend.search(handle, vectors, k, expr)
+        return await asyncio.get_event_loop().run_in_executor(
+            self.thread_pool, search_by_vectors, handle, vectors, k, expr
+        )
+
+    def chat_target(self, user_id: str, character_id: str) -> Tuple[str, Optional[Dict[str, str]]]:
+        if settings.MILVUS_STORAGE_MODE == "shared":
+            values = (f"uid_{user_id}_cid_{character_id}", str(user_id), str(character_id))
+            return settings.MILVUS_SHARED_CHAT_COLLECTION, dict(zip(CHAT_TENANT_FIELDS, values))
+        return f"chat_history_uid_{user_id}_cid_{character_id}", None
+
+    def social_target(self, character_id: str) -> Tuple[str, Optional[Dict[str, str]]]:
+        if settings.MILVUS_STORAGE_MODE == "shared":
+            return settings.MILVUS_SHARED_SOCIAL_COLLECTION, dict(zip(SOCIAL_TENANT_FIELDS, (str(character_id),)))
+        return f"character_social_cid_{character_id}", None
+
+    @staticmethod
+    def tenant_expr(tenant: Optional[Dict[str, str]]) -> Optional[str]:
+        if not tenant:
+            return None
+        # partition key字段放在第一位，按它过滤即可命中对应分区
+        field, value = next(iter(tenant.items()))
+        return f"{field} == {json.dumps(value)}"
+
+    async def open_collection(self, collection_name: str, tenant_fields: Tuple[str, ...] = ()):
+        milvus = self.local_dict.get(collection_name)
+        if milvus is not None:
+            return milvus
+
+        async def _open():
+            async with self.open_semaphore:
+                self.opens += 1
+                opened = await self._open_handle(collection_name, tenant_fields, create=True)
+            self.local_dict.set(collection_name, opened)
+            # 已注册（包括alias指向的版本）时保留原有元数据
+            await self.registry.register_if_absent(collection_name, schema_version=COLLECTION_SCHEMA_VERSION,
+                                                   tenant_fields=",".join(tenant_fields))
+            return opened
+
+        return await self.open_flight.do(("create", collection_name), _open)
 
     async def create_or_update_milvus(self, collection_name: str, texts: List[str] = None,
-                                      drop_old: bool = False):
-        if collection_name in self.local_dict:
-            if not drop_old:
-                await asyncio.get_event_loop().run_in_executor(
-                    self.thread_pool, self.local_dict[collection_name].add_texts, texts
-                )
+                                      drop_old: bool = False, tenant: Optional[Dict[str, str]] = None):
+        metadatas = [dict(tenant) for _ in texts] if tenant and texts else None
+        if tenant:
+            # 共享collection模式：drop_old只清理当前租户的数据
+            milvus = await self.open_collection(collection_name, tuple(tenant))
+            lock_key = (collection_name, self.tenant_expr(tenant))
+            if drop_old:
+                # 先写入新数据再按主键排除删除该租户的旧数据，替换期间检索不会为空；同一租户的替换互斥
+                async with self.collection_locks.write(("replace", lock_key)), self.collection_locks.read(lock_key):
+                    pks = await self._insert(milvus, texts, metadatas)
+                    expr = self.tenant_expr(tenant)
+                    await self._delete(milvus, f"{expr} and {PRIMARY_FIELD} not in {json.dumps(pks)}" if pks else expr)
             else:
-                await asyncio.get_event_loop().run_in_executor(
-                    self.thread_pool, self.local_dict[collection_name].col.drop
-                )
-                self.local_dict[collection_name] = await asyncio.get_event_loop().run_in_executor(
-                    self.thread_pool,
-                    lambda: Milvus.from_texts(
-                        texts=texts,
-                        embedding=self.embeddings,
-                        collection_name=collection_name,
-                        connection_args=self.connection_args
-                    )
-                )
-                await self.redis.set(collection_name, "1")
-        else:
-            redis_exists = await self.redis.get(collection_name)
-            if redis_exists is None:
-                self.local_dict[collection_name] = await asyncio.get_event_loop().run_in_executor(
-                    self.thread_pool,
-                    lambda: Milvus.from_texts(
-                        texts=texts,
-                        embedding=self.embeddings,
-                        collection_name=collection_name,
-                        connection_args=self.connection_args
-                    )
-                )
-                await self.redis.set(collection_name, "1")
+                async with self.collection_locks.read(lock_key):
+                    await self._insert(milvus, texts, metadatas)
+            await self._count_docs(collection_name, len(texts or []))
+            return
+
+        if not drop_old:
+            await self.append_collection(collection_name, texts)
+            return
+
+        await self.rebuild_collection(collection_name, texts)
+
+    @staticmethod
+    def rebuild_keys(collection_name: str) -> Tuple[str, str, str]:
+        lock_key = f"{REBUILD_LOCK_PREFIX}{collection_name}"
+        return lock_key, f"{lock_key}:journal", f"{lock_key}:inflight"
+
+    async def append_collection(self, collection_name: str, texts: Optional[List[str]]):
+        """追加写入独立collection；有worker正在重建时写入journal，由重建方写入新版本"""
+        if not texts:
+            async with self.collection_locks.read(collection_name):
+                milvus = await self.open_collection(collection_name)
+                await self._insert(milvus, texts)
+            return
+        _, journal_key, inflight_key = keys = self.rebuild_keys(collection_name)
+        journaled, *pending = await self.redis.run_script(
+            JOURNAL_APPEND_SCRIPT, list(keys),
+            [json.dumps(texts), settings.MILVUS_REBUILD_JOURNAL_TTL, int(settings.MILVUS_REBUILD_APPEND_WAIT * 1000)]
+        )
+        if int(journaled):
+            return
+        requeued = [text for item in pending for text in json.loads(item)]
+        try:
+            async with self.collection_locks.read(collection_name):
+                milvus = await self.open_collection(collection_name)
+                await self._insert(milvus, requeued + texts)
+        except Exception:
+            await self._requeue(journal_key, pending)
+            raise
+        finally:
+            await self.redis.run_script(APPEND_DONE_SCRIPT, [inflight_key], [])
+        await self._count_docs(collection_name, len(requeued) + len(texts))
+
+    async def _requeue(self, journal_key: str, items: List[str]):
+        """补写失败的数据放回journal，下一次追加或重建结束时再写入"""
+        if not items:
+            return
+        try:
+            await self.redis.execute_pipeline([("rpush", journal_key, *items),
+                                               ("expire", journal_key, settings.MILVUS_REBUILD_JOURNAL_TTL)])
+        except Exception as e:
+            await async_error_logger.error(f"Failed to requeue {len(items)} journal entries to {journal_key}: {e}")
+
+    async def _wait_appends(self, inflight_key: str):
+        """等待拿锁之前已开始的追加写完，超时（如追加方异常退出）后不再等待"""
+        deadline = time.monotonic() + settings.MILVUS_REBUILD_APPEND_WAIT
+        while True:
+            count, = await self.redis.execute_pipeline([("get", inflight_key)])
+            if int(count or 0) <= 0:
+                return
+            if time.monotonic() >= deadline:
+                await async_error_logger.error(f"Gave up waiting for {count} in-flight appends on {inflight_key}")
+                return
+            await asyncio.sleep(0.05)
+
+    async def rebuild_collection(self, collection_name: str, texts: List[str]):
+        """
+        蓝绿重建：数据写入新版本{name}__v{n}，索引建好并加载后把alias name切过去，
+        本地句柄和注册表随切换一起更新，旧版本在后台删除；重建失败时线上版本不受影响。
+        同名collection的重建通过Redis锁跨worker互斥，期间的追加写入在重建结束后补写到线上版本
+        """
+        lock_key, journal_key, inflight_key = self.rebuild_keys(collection_name)
+        async with self.collection_locks.write(("rebuild", collection_name)):
+            lock = self.redis.lock(lock_key, settings.MILVUS_REBUILD_LOCK_TTL, settings.MILVUS_REBUILD_LOCK_WAIT)
+            async with lock as token:
+                try:
+                    await self._wait_appends(inflight_key)
+                    shadow, handle, names = await self._rebuild(collection_name, texts)
+                finally:
+                    # 释放锁的同时取出journal，之后的追加直接写入线上版本
+                    journal = await self.redis.run_script(JOURNAL_DRAIN_SCRIPT, [lock_key, journal_key], [token])
+                    await self._replay_journal(collection_name, journal)
+
+        # 上一个版本以及之前失败遗留的版本
+        stale = [name for name in names if name != shadow and self.current_version(collection_name, name)]
+        if stale:
+            self._spawn(self._drop_versions(handle, stale))
+
+    async def _replay_journal(self, collection_name: str, journal: List[str]):
+        texts = [text for item in journal or [] for text in json.loads(item)]
+        if not texts:
+            return
+        try:
+            async with self.collection_locks.read(collection_name):
+                milvus = await self.open_collection(collection_name)
+                await self._insert(milvus, texts)
+            await self._count_docs(collection_name, len(texts))
+        except Exception as e:
+            await async_error_logger.error(f"Failed to replay {len(texts)} appended chunks into "
+                                           f"{collection_name}, requeued: {e}")
+            await self._requeue(self.rebuild_keys(collection_name)[1], journal)
+
+    async def _rebuild(self, collection_name: str, texts: List[str]):
+        # 持有重建锁时直接读Redis，并按Milvus中实际存在的版本取下一个版本号
+        meta = await self.registry.fetch(collection_name) or {}
+        current = self.current_version(collection_name, meta.get("physical"))
+        versions = [int(match["version"]) for match in map(VERSIONED_COLLECTION_PATTERN.match,
+                                                           await self._list_collections() + [current or ""])
+                    if match and match["name"] == collection_name]
+        shadow = f"{collection_name}__v{max(versions, default=0) + 1}"
+        async with self.open_semaphore:
+            self.opens += 1
+            handle = await self._open_handle(shadow, create=True)
+        try:
+            await self._insert(handle, texts)
+            await self._load(handle)
+        except Exception as e:
+            self.rebuild_failures += 1
+            await async_error_logger.error(f"Rebuild of {collection_name} into {shadow} failed: {e}")
+            try:
+                await self._drop(handle)
+            except Exception as drop_error:
+                await async_error_logger.error(f"Failed to drop shadow collection {shadow}: {drop_error}")
+            raise
+
+        names = await self._admin(handle, "list_collections")
+        # 只在切换的瞬间独占，等正在进行的检索结束
+        async with self.collection_locks.write(collection_name):
+            if current is not None:
+                await self._admin(handle, "alter_alias", shadow, collection_name)
             else:
-                self.local_dict[collection_name] = await asyncio.get_event_loop().run_in_executor(
-                    self.thread_pool,
-                    lambda: Milvus.from_texts(
-                        texts=texts,
-                        embedding=self.embeddings,
-                        collection_name=collection_name,
-                        connection_args=self.connection_args
-                    )
-                )
+                if collection_name in names:
+                    # 旧版同名实体collection：alias不能与之重名，第一次切换时先删除
+                    await self._admin(handle, "drop_collection", collection_name)
+                await self._admin(handle, "create_alias", shadow, collection_name)
+            self.local_dict.pop(collection_name)
+            self.loaded_handles.pop(collection_name, None)
+            live = await self._open_handle(collection_name)
+            if live is not None:
+                self.local_dict.set(collection_name, live)
+                self.loaded_handles[collection_name] = live
+            await self.registry.register(collection_name, physical=shadow, doc_count=len(texts or []),
+                                         schema_version=COLLECTION_SCHEMA_VERSION, tenant_fields="")
+        self.rebuilds += 1
+        return shadow, handle, names
+
+    async def _drop_versions(self, handle, names: List[str]):
+        # 其他worker的请求可能刚解析到旧版本，稍等再删除
+        await asyncio.sleep(settings.MILVUS_REBUILD_DROP_DELAY)
+        for name in names:
+            try:
+                await self._admin(handle, "drop_collection", name)
+                await async_app_logger.info(f"Dropped stale collection version {name}")
+            except Exception as e:
+                await async_error_logger.error(f"Failed to drop stale collection version {name}: {e}")
 
     async def get_or_create_milvus(self, collection_name: str) -> Optional[Milvus]:
-        if collection_name in self.local_dict:
-            return self.local_dict[collection_name]
-        else:
-            redis_exists = await self.redis.get(collection_name)
-            if redis_exists is not None:
-                self.local_dict[collection_name] = await asyncio.get_event_loop().run_in_executor(
-                    self.thread_pool,
-                    lambda: Milvus.from_texts(
-                        texts=["None"],
-                        embedding=self.embeddings,
-                        collection_name=collection_name,
-                        connection_args=self.connection_args
-                    )
-                )
-                return self.local_dict[collection_name]
-            else:
+        milvus = self.local_dict.get(collection_name)
+        if milvus is not None:
+            self.registry.touch(collection_name)
+            return milvus
+        # 读路径只看本地视图：不存在的collection由本地Bloom filter直接判定，不访问Redis，
+        # 其他worker刚创建的collection在下一次changelog刷新后可见
+        if not await self.registry.exists(collection_name):
+            return None
+
+        # 冷启动时同一collection只由第一个请求打开，其余请求等待同一个结果
+        async def _attach():
+            async with self.open_semaphore:
+                self.opens += 1
+                attached = await self._open_handle(collection_name)
+            if attached is None:
                 return None
+            self.local_dict.set(collection_name, attached)
+            self.registry.touch(collection_name)
+            return attached
 
-    async def save_chat(self, user_id: str, character_id: str, chat_history: str, drop_old=False) -> int:
-        collection_name = f"chat_history_uid_{user_id}_cid_{character_id}"
+        return await self.open_flight.do(("attach", collection_name), _attach)
+
+    async def warm_collection(self, collection_name: str) -> bool:
+        """挂载已存在的collection并加载到Milvus内存，不存在时不创建；返回collection是否存在"""
+        milvus = await self.get_or_create_milvus(collection_name)
+        if milvus is None:
+            return False
+        if self.loaded_handles.get(collection_name) is not milvus:
+            async def _load():
+                self.loads += 1
+                await self._load(milvus)
+                self.loaded_handles[collection_name] = milvus
 
+            await self.open_flight.do(("load", collection_name), _load)
+        return True
+
+    @staticmethod
+    def split_chat(chat_history: str) -> List[str]:
         text_splitter = CharacterTextSplitter(chunk_size=400, chunk_overlap=0)
-        docs = text_splitter.split_text(chat_history)
-        await self.create_or_update_milvus(collection_name, docs, drop_old)
+        return text_splitter.split_text(chat_history)
+
+    async def save_chat(self, user_id: str, character_id: str, chat_history: str, drop_old=False) -> int:
+        collection_name, tenant = self.chat_target(user_id, character_id)
+
+        docs = self.split_chat(chat_history)
+        await self.create_or_update_milvus(collection_name, docs, drop_old, tenant=tenant)
 
         await async_app_logger.info(f"Collection {collection_name} saved")
         return len(docs)
 
-    async def save_social(self, character_id: str, content: Dict, drop_old=True) -> int:
-        collection_name = f"character_social_cid_{character_id}"
+    async def save_chat_batch(self, chats: List[Tuple[str, str, str]]) -> int:
+        """批量追加多轮聊天记录(user_id, character_id, chat_history)，同一collection只做一次embedding和insert"""
+        groups: Dict[str, Tuple[List[str], List[Dict], set]] = {}
+        for user_id, character_id, chat_history in chats:
+            collection_name, tenant = self.chat_target(user_id, character_id)
+            docs = self.split_chat(chat_history)
+            if not docs:
+                continue
+            texts, metadatas, tenants = groups.setdefault(collection_name, ([], [], set()))
+            texts += docs
+            if tenant:
+                metadatas += [dict(tenant) for _ in docs]
+                tenants.add(self.tenant_expr(tenant))
+
+        saved = 0
+        for collection_name, (texts, metadatas, tenants) in groups.items():
+            if not tenants:
+                # 与create_or_update_milvus相同的追加路径，重建期间写入journal
+                await self.append_collection(collection_name, texts)
+                saved += len(texts)
+                continue
+            async with AsyncExitStack() as stack:
+                # 与create_or_update_milvus使用同样的读锁，避免和删除交错
+                milvus = await self.open_collection(collection_name, CHAT_TENANT_FIELDS)
+                for expr in sorted(tenants):
+                    await stack.enter_async_context(self.collection_locks.read((collection_name, expr)))
+                await self._insert(milvus, texts, metadatas)
+            await self._count_docs(collection_name, len(texts))
+            saved += len(texts)
+        await async_app_logger.info(f"Saved {saved} chat chunks into {len(groups)} collections")
+        return saved
 
-        docs = []
-        for key, value in content.items():
-            sub_content = json.dumps({key: value}, ensure_ascii=False)
-            text_splitter = CharacterTextSplitter(chunk_size=800, chunk_overlap=0)
-            sub_docs = text_splitter.split_text(sub_content)
-            docs += sub_docs
+    @staticmethod
+    def split_social(key, value) -> List[str]:
+        return SOCIAL_SPLITTER.split_text(json.dumps({key: value}, ensure_ascii=False))
 
-        await self.create_or_update_milvus(collection_name, docs, drop_old)
+    def social_index_key(self, character_id: str) -> str:
+        collection_name, _ = self.social_target(character_id)
+        return f"{SOCIAL_INDEX_PREFIX}{collection_name}:{character_id}"
+
+    async def save_social(self, character_id: str, content: Dict, drop_old=True, incremental: bool = None) -> int:
+        """
+        incremental（默认SOCIAL_INCREMENTAL_UPDATE）时按chunk内容哈希增量更新：
+        只embed并写入新增/变化的chunk，按主键删除消失的chunk，未变化的chunk不做任何操作；
+        drop_old为True时content是完整资料，为False时只更新content中出现的key
+        """
+        incremental = settings.SOCIAL_INCREMENTAL_UPDATE if incremental is None else incremental
+        if incremental:
+            return await self._save_social_incremental(character_id, content, drop_old)
+
+        collection_name, tenant = self.social_target(character_id)
+        docs = [doc for key, value in content.items() for doc in self.split_social(key, value)]
+        await self.create_or_update_milvus(collection_name, docs, drop_old, tenant=tenant)
+        # 全量写入后chunk索引不再准确，下次增量更新时按无索引处理
+        await self.redis.delete(self.social_index_key(character_id))
+        self.social_updates["full"] += 1
 
         await async_app_logger.info(f"Collection {collection_name} saved")
         return len(docs)
 
-    async def search_chats(self, user_id: str, character_id: str, question: str, k=3, score_threshold=0.6) -> List:
-        collection_name = f"chat_history_uid_{user_id}_cid_{character_id}"
+    async def _save_social_incremental(self, character_id: str, content: Dict, replace: bool) -> int:
+        collection_name, tenant = self.social_target(character_id)
+        index_key = self.social_index_key(character_id)
+        lock = self.redis.lock(f"{SOCIAL_INDEX_LOCK_PREFIX}{collection_name}:{character_id}",
+                               settings.SOCIAL_INDEX_LOCK_TTL, settings.SOCIAL_INDEX_LOCK_WAIT)
+        # 本地锁先排队，同一进程内的并发更新不去争抢Redis锁
+        async with self.collection_locks.write(("social_index", index_key)), lock:
+            raw, = await self.redis.execute_pipeline([("hgetall", index_key)])
+            index = {key: json.loads(value) for key, value in (raw or {}).items()}
+            existed = bool(index) or await self._has_data(collection_name, tenant)
+            if not index and existed and not replace:
+                # 没有索引时无法知道旧chunk属于哪个key，只追加，等下次完整更新时清理
+                docs = [doc for key, value in content.items() for doc in self.split_social(key, value)]
+                await self.create_or_update_milvus(collection_name, docs, tenant=tenant)
+                self.social_updates["full"] += 1
+                return len(docs)
+
+            new_index, added, deleted = {}, [], []
+            for key, value in content.items():
+                key = str(key)
+                old: Dict[str, List] = {}
+                for chunk_hash, pk in index.get(key, []):
+                    old.setdefault(chunk_hash, []).append(pk)
+                entries = []
+                for text in self.split_social(key, value):
+                    chunk_hash = hashlib.sha1(text.encode("utf-8")).hexdigest()
+                    pks = old.get(chunk_hash)
+                    entries.append([chunk_hash, pks.pop() if pks else None])
+                    if entries[-1][1] is None:
+                        added.append((entries[-1], text))
+                deleted += [pk for pks in old.values() for pk in pks]
+                new_index[key] = entries
+            if replace:
+                deleted += [pk for key, entries in index.items() if key not in new_index for _, pk in entries]
+                merged = new_index
+            else:
+                merged = dict(index, **new_index)
+
+            texts = [text for _, text in added]
+            metadatas = [dict(tenant) for _ in texts] if tenant else None
+            lock_key = (collection_name, self.tenant_expr(tenant)) if tenant else collection_name
+            milvus = await self.open_collection(collection_name, tuple(tenant) if tenant else ())
+            inserted = []
+            async with self.collection_locks.read(lock_key):
+                try:
+                    # 先写入再删除，更新期间检索不会出现空结果
+                    inserted = await self._insert(milvus, texts, metadatas)
+                    for (entry, _), pk in zip(added, inserted):
+                        entry[1] = pk
+                    if index:
+                        if deleted:
+                            await self._delete(milvus, f"{PRIMARY_FIELD} in {json.dumps(deleted)}")
+                    elif existed:
+                        # 旧数据没有chunk索引：保留刚写入的chunk，删除其余所有旧chunk
+                        keep = [pk for entries in merged.values() for _, pk in entries]
+                        expr = f"{PRIMARY_FIELD} not in {json.dumps(keep)}"
+                        await self._delete(milvus, f"{self.tenant_expr(tenant)} and {expr}" if tenant else expr)
+                except Exception:
+                    # 旧索引保持不变，撤回本次写入的chunk，避免留下索引之外的数据
+                    if inserted:
+                        try:
+                            await self._delete(milvus, f"{PRIMARY_FIELD} in {json.dumps(inserted)}")
+                        except Exception as e:
+                            await async_error_logger.error(f"Failed to roll back social chunks of "
+                                                           f"{character_id}: {e}")
+                    raise
+            # Milvus写入和删除都成功后才替换索引
+            mapping = {key: json.dumps(entries) for key, entries in merged.items() if entries}
+            commands = [("delete", index_key)]
+            if mapping:
+                commands.append(("hset", index_key, None, None, mapping))
+            await self.redis.execute_pipeline(commands, transaction=True)
+
+        await self._count_docs(collection_name, len(added) - len(deleted))
+        total = sum(len(entries) for entries in new_index.values())
+        self.social_updates["incremental"] += 1
+        self.social_updates["added"] += len(added)
+        self.social_updates["deleted"] += len(deleted)
+        self.social_updates["unchanged"] += total - len(added)
+        await async_app_logger.info(f"Collection {collection_name} updated for character {character_id}: "
+                                    f"{len(added)} added, {len(deleted)} deleted, {total - len(added)} unchanged")
+        return total
 
+    async def _has_data(self, collection_name: str, tenant: Optional[Dict[str, str]]) -> bool:
+        """collection中是否已有数据；共享collection按租户判断"""
+        if not tenant:
+            return await self.get_or_create_milvus(collection_name) is not None
+        # query要求collection已加载
+        if not await self.warm_collection(collection_name):
+            return False
         milvus = await self.get_or_create_milvus(collection_name)
-        if milvus is None:
-            await async_app_logger.info(f"Collection {collection_name} not found")
-            return []
+        return milvus is not None and bool(await self._query(milvus, self.tenant_expr(tenant), 1))
 
-        result_docs = await asyncio.get_event_loop().run_in_executor(
-            self.thread_pool,
-            milvus.similarity_search_with_score,
-            question,
-            k
-        )
+    async def similarity_search(self, collection_name: str, question: str, k: int, expr: Optional[str] = None,
+                                vector: Optional[List[float]] = None) -> List:
+        """vector为调用方已算好的question向量，传入时不再重复embedding"""
+        lock_key = (collection_name, expr) if expr else collection_name
+        async with self.collection_locks.read(lock_key):
+            milvus = await self.get_or_create_milvus(collection_name)
+            if milvus is None:
+                await async_app_logger.info(f"Collection {collection_name} not found")
+                return []
+
+            if vector is None and self.search_batcher is not None:
+                result_docs = await self.search_batcher.search(collection_name, milvus, question, k, expr)
+            else:
+                if vector is None:
+                    vector = await self.embeddings.aembed_query(question)
+                result_docs = (await self._search_vectors(collection_name, milvus, [vector], k, expr))[0]
+        # 过滤旧版本Milvus.from_texts(["None"])打开collection时写入的占位数据
+        return [doc for doc in result_docs if doc[0].page_content != LEGACY_PLACEHOLDER_TEXT]
+
+    async def search_chats(self, user_id: str, character_id: str, question: str, k=3, score_threshold=0.6,
+                           vector: Optional[List[float]] = None) -> List:
+        collection_name, tenant = self.chat_target(user_id, character_id)
+
+        result_docs = await self.similarity_search(collection_name, question, k, self.tenant_expr(tenant), vector)
 
         result_texts = [doc[0].page_content for doc in result_docs if float(doc[1]) < (1 - score_threshold)]
         print(f"搜到的角色相关long chat信息：{result_texts}")
         return result_texts
 
-    async def search_social(self, character_id: str, question: str, k=3, score_threshold=0.6) -> List:
-        collection_name = f"character_social_cid_{character_id}"
+    async def search_social(self, character_id: str, question: str, k=3, score_threshold=0.6,
+                            vector: Optional[List[float]] = None) -> List:
+        collection_name, tenant = self.social_target(character_id)
 
-        milvus = await self.get_or_create_milvus(collection_name)
-        if milvus is None:
-            await async_app_logger.info(f"Collection {collection_name} not found")
-            return []
-
-        result_docs = await asyncio.get_event_loop().run_in_executor(
-            self.thread_pool,
-            milvus.similarity_search_with_score,
-            question,
-            k
-        )
+        result_docs = await self.similarity_search(collection_name, question, k, self.tenant_expr(tenant), vector)
 
         result_texts = [doc[0].page_content for doc in result_docs if float(doc[1]) < (1 - score_threshold)]
         print(f"搜到的角色相关social信息：{result_texts}")
@@ -190,54 +800,93 @@ class MilvusManager:
     async def delete_collection(self, collection_name: str):
         await async_app_logger.info(f"Deleting collection {collection_name}")
 
-        if collection_name in self.local_dict:
-            try:
-                milvus = self.local_dict[collection_name]
-                await asyncio.get_event_loop().run_in_executor(self.thread_pool, milvus.col.drop)
-                del self.local_dict[collection_name]
-                await self.redis.delete(collection_name)
-                await async_app_logger.info(f"Collection {collection_name} deleted")
-            except Exception as e:
-                await async_error_logger.error(f"Failed to delete collection {collection_name}: {e}")
-        else:
-            try:
-                redis_exists = await self.redis.get(collection_name)
-                if redis_exists is not None:
-                    await self.redis.delete(collection_name)
-                    self.local_dict[collection_name] = await asyncio.get_event_loop().run_in_executor(
-                        self.thread_pool,
-                        Milvus.from_texts,
-                        ["None"],
-                        self.embeddings,
-                        collection_name,
-                        self.connection_args,
-                        True
-                    )
-
-                    milvus = self.local_dict[collection_name]
-                    await asyncio.get_event_loop().run_in_executor(self.thread_pool, milvus.col.drop)
-                    del self.local_dict[collection_name]
-                    await self.redis.delete(collection_name)
-                    await async_app_logger.info(f"Collection {collection_name} deleted")
-            except Exception as e:
-                await async_error_logger.error(f"Failed to delete collection {collection_name}: {e}")
-                raise
+        try:
+            async with self.collection_locks.write(collection_name):
+                milvus = self.local_dict.pop(collection_name)
+                self.loaded_handles.pop(collection_name, None)
+                # 删除前以Redis和Milvus为准，不依赖本地视图
+                meta = await self.registry.fetch(collection_name)
+                if milvus is None:
+                    milvus = await self._open_handle(collection_name)
+                if milvus is None and meta is None:
+                    await async_app_logger.info(f"Collection {collection_name} not found")
+                    return
+
+                current = self.current_version(collection_name, meta.get("physical") if meta else None)
+                if milvus is not None and current is not None:
+                    await self._admin(milvus, "drop_alias", collection_name)
+                    await self._admin(milvus, "drop_collection", current)
+                elif milvus is not None:
+                    await self._drop(milvus)
+                await self.registry.unregister(collection_name)
+            await async_app_logger.info(f"Collection {collection_name} deleted")
+        except Exception as e:
+            await async_error_logger.error(f"Failed to delete collection {collection_name}: {e}")
+            raise
+
+    async def delete_tenant(self, collection_name: str, tenant: Dict[str, str]):
+        await async_app_logger.info(f"Deleting {tenant} from collection {collection_name}")
+        await self.delete_where(collection_name, self.tenant_expr(tenant))
+
+    async def delete_where(self, collection_name: str, expr: str):
+        milvus = await self.get_or_create_milvus(collection_name)
+        if milvus is None:
+            return
+        async with self.collection_locks.write((collection_name, expr)):
+            await self._delete(milvus, expr)
 
     async def delete_chat_collection(self, user_id: str, character_id: str):
-        collection_name = f"chat_history_uid_{user_id}_cid_{character_id}"
-        await self.delete_collection(collection_name)
+        collection_name, tenant = self.chat_target(user_id, character_id)
+        if tenant:
+            await self.delete_tenant(collection_name, tenant)
+        else:
+            await self.delete_collection(collection_name)
 
     async def delete_social_collection(self, character_id: str):
-        collection_name = f"character_social_cid_{character_id}"
-        await self.delete_collection(collection_name)
+        collection_name, tenant = self.social_target(character_id)
+        await self.redis.delete(self.social_index_key(character_id))
+        if tenant:
+            await self.delete_tenant(collection_name, tenant)
+        else:
+            await self.delete_collection(collection_name)
+
+    def stats(self) -> Dict:
+        return {
+            "handle_cache": dict(self.local_dict.stats(), opens=self.opens, opening=len(self.open_flight),
+                                 shared_opens=self.open_flight.shared, loads=self.loads,
+                                 releases=self.releases),
+            "rebuilds": {"completed": self.rebuilds, "failed": self.rebuild_failures},
+            "background_tasks": len(self.background_tasks),
+            "embedding_cache": self.embeddings.stats(),
+            "search_batcher": self.search_batcher.stats() if self.search_batcher else None,
+            "social_updates": dict(self.social_updates),
+            "registry": self.registry.stats(),
+            "async_backend": self.async_backend.stats() if self.async_backend else None,
+        }
 
     async def close(self):
+        # 未完成的旧版本删除留给下一次重建清理，未执行的release直接放弃
+        for task in list(self.background_tasks):
+            task.cancel()
+        await self.registry.close()
+        if self.search_batcher is not None:
+            await self.search_batcher.close()
+        await self.embeddings.close()
+        # 关闭时不触发release，避免影响其他实例正在使用的collection
+        self.local_dict.on_evict = None
         self.local_dict.clear()
+        if self.async_backend is not None:
+            await self.async_backend.close()
         self.thread_pool.shutdown(wait=True)
 
 
 async def setup_milvus(embedding_api_key: str, redis: RedisManager, max_workers: int = 50, **connection_args):
     milvus_manager = MilvusManager(connection_args, embedding_api_key, redis, max_workers)
+    try:
+        await milvus_manager.bootstrap_registry()
+    except Exception as e:
+        await async_error_logger.error(f"Failed to bootstrap collection registry: {e}")
+    await milvus_manager.registry.start()
     app_logger.info("Milvus setup completed")
     return milvus_manager
 
@@ -0,0 +1,158 @@
+# app/storage/milvus_migration.py
+"""
+把按(user, character)拆分的旧collection批量迁移到共享collection（partition key模式）。
+直接复制已有向量，不重新embedding。
+
+python -m app.storage.milvus_migration --batch-size 1000 [--drop-source] [--dry-run]
+"""
+import argparse
+import asyncio
+import re
+from typing import Dict, Optional, Tuple
+
+from pymilvus import Collection, connections, utility
+from pymilvus.client.types import LoadState
+
+from app.core.config import settings
+from app.core.logger import async_app_logger, async_error_logger
+from app.storage.milvus_manager import (
+    MilvusManager, CHAT_TENANT_FIELDS, SOCIAL_TENANT_FIELDS, INDEX_PARAMS, LEGACY_PLACEHOLDER_TEXT, TEXT_FIELD,
+    VECTOR_FIELD, VERSIONED_COLLECTION_PATTERN, build_collection_schema, setup_milvus
+)
+from app.storage.redis_manager import setup_redis
+
+CHAT_COLLECTION_PATTERN = re.compile(r"^chat_history_uid_(?P<user_id>.+)_cid_(?P<character_id>.+)$")
+SOCIAL_COLLECTION_PATTERN = re.compile(r"^character_social_cid_(?P<character_id>.+)$")
+MIGRATED_KEY_PREFIX = "milvus_migrated_"
+MIGRATION_ALIAS = "milvus_migration"
+
+
+def parse_legacy_collection(collection_name: str) -> Optional[Tuple[str, Dict[str, str]]]:
+    match = CHAT_COLLECTION_PATTERN.match(collection_name)
+    if match:
+        values = (f"uid_{match['user_id']}_cid_{match['character_id']}", match["user_id"], match["character_id"])
+        return settings.MILVUS_SHARED_CHAT_COLLECTION, dict(zip(CHAT_TENANT_FIELDS, values))
+    match = SOCIAL_COLLECTION_PATTERN.match(collection_name)
+    if match:
+        return settings.MILVUS_SHARED_SOCIAL_COLLECTION, dict(zip(SOCIAL_TENANT_FIELDS, (match["character_id"],)))
+    return None
+
+
+def copy_collection(source: Collection, target: Collection, tenant: Dict[str, str], batch_size: int) -> int:
+    # 迁移前未加载的collection复制完就释放，避免批量迁移把所有旧collection都加载进query node内存
+    loaded = utility.load_state(source.name, using=MIGRATION_ALIAS) == LoadState.Loaded
+    if not loaded:
+        source.load()
+    iterator = source.query_iterator(
+        batch_size=batch_size,
+        expr=f'{TEXT_FIELD} != "{LEGACY_PLACEHOLDER_TEXT}"',
+        output_fields=[TEXT_FIELD, VECTOR_FIELD]
+    )
+    copied = 0
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            target.insert([{TEXT_FIELD: row[TEXT_FIELD], VECTOR_FIELD: row[VECTOR_FIELD], **tenant} for row in rows])
+            copied += len(rows)
+    finally:
+        iterator.close()
+        if not loaded:
+            source.release()
+    return copied
+
+
+def open_target(collection_name: str, tenant_fields, alias: str) -> Collection:
+    if utility.has_collection(collection_name, using=alias):
+        return Collection(collection_name, using=alias)
+    schema, kwargs = build_collection_schema(tenant_fields)
+    col = Collection(collection_name, schema=schema, using=alias, **kwargs)
+    col.create_index(VECTOR_FIELD, INDEX_PARAMS)
+    return col
+
+
+async def migrate_to_shared(milvus_manager: MilvusManager, batch_size: int = 1000, drop_source: bool = False,
+                            dry_run: bool = False) -> Dict[str, int]:
+    loop = asyncio.get_event_loop()
+    pool = milvus_manager.thread_pool
+    # 迁移直接走pymilvus ORM，不依赖MilvusManager当前的客户端模式
+    await loop.run_in_executor(pool, lambda: connections.connect(alias=MIGRATION_ALIAS,
+                                                                 **milvus_manager.connection_args))
+    targets = {}
+    for target_name, tenant_fields in ((settings.MILVUS_SHARED_CHAT_COLLECTION, CHAT_TENANT_FIELDS),
+                                       (settings.MILVUS_SHARED_SOCIAL_COLLECTION, SOCIAL_TENANT_FIELDS)):
+        # 经MilvusManager建表并写入注册表，迁移后共享模式的检索才能找到目标collection
+        await milvus_manager.open_collection(target_name, tenant_fields)
+        targets[target_name] = await loop.run_in_executor(pool, open_target, target_name, tenant_fields,
+                                                          MIGRATION_ALIAS)
+
+    names = await loop.run_in_executor(pool, lambda: utility.list_collections(using=MIGRATION_ALIAS))
+    summary = {"collections": 0, "rows": 0, "skipped": 0, "failed": 0}
+    for name in names:
+        live = name
+        match = VERSIONED_COLLECTION_PATTERN.match(name)
+        if match:
+            # 蓝绿重建出的版本按alias名解析，只迁移alias当前指向的版本
+            meta = await milvus_manager.registry.fetch(match["name"])
+            if not meta or meta.get("physical") != name:
+                continue
+            live = match["name"]
+        parsed = parse_legacy_collection(live)
+        if parsed is None or live in targets:
+            continue
+        target_name, tenant = parsed
+        if await milvus_manager.redis.get(f"{MIGRATED_KEY_PREFIX}{name}") is not None:
+            summary["skipped"] += 1
+            continue
+        if dry_run:
+            await async_app_logger.info(f"[dry-run] would migrate {name} -> {target_name} {tenant}")
+            summary["collections"] += 1
+            continue
+
+        try:
+            source = Collection(name, using=MIGRATION_ALIAS)
+            target = targets[target_name]
+            # 先清掉该租户在共享collection中的数据，保证重跑幂等
+            await loop.run_in_executor(pool, target.delete, milvus_manager.tenant_expr(tenant))
+            copied = await loop.run_in_executor(pool, copy_collection, source, target, tenant, batch_size)
+            await milvus_manager.redis.set(f"{MIGRATED_KEY_PREFIX}{name}", str(copied))
+            if drop_source:
+                await milvus_manager.delete_collection(live)
+            summary["collections"] += 1
+            summary["rows"] += copied
+            await async_app_logger.info(f"Migrated {copied} rows from {name} to {target_name}")
+        except Exception as e:
+            summary["failed"] += 1
+            await async_error_logger.error(f"Failed to migrate collection {name}: {e}")
+
+    for target in targets.values():
+        await loop.run_in_executor(pool, target.flush)
+    await async_app_logger.info(f"Milvus shared-layout migration finished: {summary}")
+    return summary
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Migrate per-pair Milvus collections into shared collections")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--drop-source", action="store_true")
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    redis_manager = await setup_redis()
+    milvus_manager = await setup_milvus(
+        settings.OPENAI_APIKEY,
+        redis=redis_manager,
+        host=settings.MILVUS_HOST,
+        port=settings.MILVUS_PORT
+    )
+    try:
+        summary = await migrate_to_shared(milvus_manager, args.batch_size, args.drop_source, args.dry_run)
+        print(summary)
+    finally:
+        await milvus_manager.close()
+        await redis_manager.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
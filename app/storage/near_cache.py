@@ -0,0 +1,102 @@
+import time
+import uuid
+from typing import Any, Dict, Iterable, Tuple
+
+from app.utils.cache import LRUCache
+
+
+class NearCache:
+    """
+    进程内的Redis近端缓存，只缓存指定前缀的key。
+    写入方通过pub/sub广播失效消息，各worker收到后删除本地副本；
+    订阅断开期间不提供缓存，重连后整体清空，TTL兜底保证最大陈旧时间。
+    """
+
+    def __init__(self, prefixes: Tuple[str, ...], max_size: int, ttl: float):
+        self.prefixes = prefixes
+        self.ttl = ttl
+        self.cache = LRUCache(max_size, ttl=ttl)
+        # 记录最近被失效的key及失效时的epoch，避免加载中的旧值在失效之后被写回缓存
+        self._invalidated = LRUCache(max_size, ttl=ttl)
+        self.epoch = 0
+        self._reset_epoch = 0
+        self.connected = False
+        self.instance_id = uuid.uuid4().hex
+
+        self.invalidations_sent = 0
+        self.invalidations_received = 0
+        self.stale_sets_skipped = 0
+        self.resets = 0
+        self.served_age_total = 0.0
+        self.served_age_max = 0.0
+        self.propagation_lag_total = 0.0
+        self.propagation_lag_max = 0.0
+
+    def accepts(self, key: str) -> bool:
+        return self.connected and key.startswith(self.prefixes)
+
+    def get(self, key: str) -> Tuple[bool, Any]:
+        age = self.cache.age(key)
+        item = self.cache.get(key)
+        if item is None:
+            return False, None
+        if age is not None:
+            self.served_age_total += age
+            self.served_age_max = max(self.served_age_max, age)
+        return True, item[0]
+
+    def begin(self) -> int:
+        return self.epoch
+
+    def set(self, key: str, value: Any, epoch: int):
+        invalidated_at = self._invalidated.peek(key)
+        if (not self.connected or epoch < self._reset_epoch
+                or (invalidated_at is not None and invalidated_at > epoch)):
+            self.stale_sets_skipped += 1
+            return
+        # 包一层元组，缓存的None（key不存在）与未命中可以区分
+        self.cache.set(key, (value,))
+
+    def invalidate_local(self, keys: Iterable[str]):
+        self.epoch += 1
+        for key in keys:
+            self.cache.pop(key)
+            self._invalidated.set(key, self.epoch)
+
+    def encode_message(self, keys: Iterable[str]) -> str:
+        self.invalidations_sent += 1
+        return "\n".join([self.instance_id, repr(time.time()), *keys])
+
+    def handle_message(self, data: str):
+        instance_id, sent_at, *keys = data.split("\n")
+        if instance_id == self.instance_id:
+            return
+        self.invalidations_received += 1
+        lag = max(0.0, time.time() - float(sent_at))
+        self.propagation_lag_total += lag
+        self.propagation_lag_max = max(self.propagation_lag_max, lag)
+        self.invalidate_local(keys)
+
+    def reset(self):
+        self.epoch += 1
+        self._reset_epoch = self.epoch
+        self.resets += 1
+        self.cache.clear()
+        self._invalidated.clear()
+
+    def stats(self) -> Dict:
+        stats = self.cache.stats()
+        return dict(
+            stats,
+            connected=self.connected,
+            ttl=self.ttl,
+            invalidations_sent=self.invalidations_sent,
+            invalidations_received=self.invalidations_received,
+            stale_sets_skipped=self.stale_sets_skipped,
+            resets=self.resets,
+            avg_served_age=self.served_age_total / stats["hits"] if stats["hits"] else 0.0,
+            max_served_age=self.served_age_max,
+            avg_propagation_lag=(self.propagation_lag_total / self.invalidations_received
+                                 if self.invalidations_received else 0.0),
+            max_propagation_lag=self.propagation_lag_max,
+        )
@@ -1,18 +1,55 @@
 # app/db/redis_manager.py
 
 import asyncio
-from typing import Optional
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 import aioredis
 from app.core.config import settings
 from app.core.logger import app_logger, error_logger, async_error_logger
+from app.storage.near_cache import NearCache
+from app.utils.codec import Codec
+from app.utils.concurrency import SingleFlight
 from contextlib import asynccontextmanager
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 
 
+# 只有持有者（token一致）才能续期/释放锁
+RENEW_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
 class RedisManager:
     _instance = None
     _redis_pool = None
 
+    _raw_redis_pool = None
+
+    def __init__(self):
+        self._scripts = {}
+        self.codec = Codec(
+            settings.REDIS_CODEC,
+            compress_threshold=settings.REDIS_CODEC_COMPRESS_THRESHOLD or None,
+            zstd_level=settings.REDIS_CODEC_ZSTD_LEVEL
+        )
+        self.near_cache = NearCache(
+            tuple(prefix for prefix in settings.REDIS_NEAR_CACHE_PREFIXES.split(",") if prefix),
+            max_size=settings.REDIS_NEAR_CACHE_SIZE,
+            ttl=settings.REDIS_NEAR_CACHE_TTL
+        ) if settings.REDIS_NEAR_CACHE_ENABLED else None
+        self._near_cache_task: Optional[asyncio.Task] = None
+        self.load_flight = SingleFlight()
+
     @classmethod
     async def get_instance(cls):
         if cls._instance is None:
@@ -39,22 +76,39 @@ class RedisManager:
                 connection_pool=self._redis_pool,
                 socket_timeout=settings.REDIS_TIMEOUT  # Add timeout here
             )
+            # 经过codec编码的二进制值走不做decode的连接池
+            self._raw_redis_pool = aioredis.ConnectionPool.from_url(
+                f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}",
+                password=settings.REDIS_PWD,
+                decode_responses=False,
+                max_connections=settings.REDIS_POOL_SIZE,
+            )
+            self._raw_redis = aioredis.Redis(
+                connection_pool=self._raw_redis_pool,
+                socket_timeout=settings.REDIS_TIMEOUT
+            )
             app_logger.info("Redis connection pool initialized successfully")
         except Exception as e:
             error_logger.exception(f"Failed to initialize Redis connection pool: {e}")
             raise
 
     async def close(self):
+        if self._near_cache_task is not None:
+            self._near_cache_task.cancel()
+            await asyncio.gather(self._near_cache_task, return_exceptions=True)
+            self._near_cache_task = None
         if self._redis_pool:
             await self._redis_pool.disconnect()
+            if self._raw_redis_pool:
+                await self._raw_redis_pool.disconnect()
             app_logger.info("Redis connection pool closed")
 
     @asynccontextmanager
-    async def get_connection(self):
+    async def get_connection(self, raw: bool = False):
         if not self._redis_pool:
             await self.init_pool()
         try:
-            yield self._redis
+            yield self._raw_redis if raw else self._redis
         except aioredis.RedisError as e:
             await async_error_logger.exception(f"Error while getting Redis connection: {e}")
             raise
@@ -74,6 +128,178 @@ class RedisManager:
         async with self.get_connection() as conn:
             return await conn.delete(key)
 
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=5))
+    async def mget(self, keys: List[str]):
+        if not keys:
+            return []
+        async with self.get_connection() as conn:
+            return await conn.mget(keys)
+
+    async def xadd(self, stream: str, fields: Dict[str, str], maxlen: Optional[int] = None):
+        async with self.get_connection() as conn:
+            return await conn.xadd(stream, fields, maxlen=maxlen, approximate=True)
+
+    async def ensure_group(self, stream: str, group: str):
+        async with self.get_connection() as conn:
+            try:
+                await conn.xgroup_create(stream, group, id="0", mkstream=True)
+            except aioredis.ResponseError as e:
+                # 消费组已存在
+                if "BUSYGROUP" not in str(e):
+                    raise
+
+    async def xreadgroup(self, group: str, consumer: str, streams: Dict[str, str], count: Optional[int] = None,
+                         block: Optional[int] = None):
+        async with self.get_connection() as conn:
+            return await conn.xreadgroup(group, consumer, streams, count=count, block=block)
+
+    async def xautoclaim(self, stream: str, group: str, consumer: str, min_idle_time: int, start_id: str = "0-0",
+                         count: Optional[int] = None):
+        # aioredis没有封装XAUTOCLAIM（Redis >= 6.2），直接发命令并整理成[(id, fields)]
+        args = [stream, group, consumer, min_idle_time, start_id]
+        if count:
+            args += ["COUNT", count]
+        async with self.get_connection() as conn:
+            res = await conn.execute_command("XAUTOCLAIM", *args)
+        next_id, entries = res[0], res[1]
+        messages = []
+        for entry in entries:
+            if not entry or entry[1] is None:
+                continue
+            message_id, flat = entry
+            fields = flat if isinstance(flat, dict) else dict(zip(flat[::2], flat[1::2]))
+            messages.append((message_id, fields))
+        return next_id, messages
+
+    async def xack(self, stream: str, group: str, *ids: str):
+        if not ids:
+            return 0
+        async with self.get_connection() as conn:
+            return await conn.xack(stream, group, *ids)
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=5))
+    async def set_obj(self, key: str, value, ex: Optional[int] = None):
+        async with self.get_connection(raw=True) as conn:
+            await conn.set(key, self.codec.encode(value), ex=ex)
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=5))
+    async def get_obj(self, key: str):
+        async with self.get_connection(raw=True) as conn:
+            return self.codec.decode(await conn.get(key))
+
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=1, min=1, max=5))
+    async def mget_obj(self, keys: List[str], raise_on_error: bool = True) -> List:
+        if not keys:
+            return []
+        async with self.get_connection(raw=True) as conn:
+            values = await conn.mget(keys)
+        results = []
+        for value in values:
+            try:
+                results.append(self.codec.decode(value))
+            except Exception as e:
+                # raise_on_error=False时解码失败的key返回异常对象，不影响其他key
+                if raise_on_error:
+                    raise
+                results.append(e)
+        return results
+
+    async def cached(self, key: str, loader: Callable[[], Awaitable]):
+        """
+        近端缓存读取：命中直接返回本地副本，未命中时调用loader从Redis加载并缓存。
+        同一key进行中的加载（例如会话预热）由后来的调用方共用，不重复读取
+        """
+        near_cache = self.near_cache
+        if near_cache is None or not near_cache.accepts(key):
+            return await self.load_flight.do(key, loader)
+        hit, value = near_cache.get(key)
+        if hit:
+            return value
+
+        async def _load():
+            epoch = near_cache.begin()
+            loaded = await loader()
+            near_cache.set(key, loaded, epoch)
+            return loaded
+
+        return await self.load_flight.do(key, _load)
+
+    async def cached_many(self, keys: List[str],
+                          loader: Callable[[List[str]], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """批量版cached：先取近端缓存，未命中的key交给loader一次性加载；loader未返回的key视为加载失败"""
+        results = {}
+        missing = []
+        near_cache = self.near_cache
+        for key in keys:
+            if near_cache is not None and near_cache.accepts(key):
+                hit, value = near_cache.get(key)
+                if hit:
+                    results[key] = value
+                    continue
+            missing.append(key)
+        if not missing:
+            return results
+
+        epoch = near_cache.begin() if near_cache is not None else 0
+        loaded = await loader(missing)
+        for key, value in loaded.items():
+            results[key] = value
+            if near_cache is not None and near_cache.accepts(key):
+                near_cache.set(key, value, epoch)
+        return results
+
+    async def invalidate(self, *keys: str):
+        """写入后调用：删除本进程的近端缓存副本，并通知其他worker"""
+        # 写入前发起的加载可能读到旧值，之后的读取不再复用
+        for key in keys:
+            self.load_flight.forget(key)
+        if self.near_cache is None or not keys:
+            return
+        self.near_cache.invalidate_local(keys)
+        try:
+            async with self.get_connection() as conn:
+                await conn.publish(settings.REDIS_NEAR_CACHE_CHANNEL, self.near_cache.encode_message(keys))
+        except aioredis.RedisError as e:
+            # 广播失败时其他worker依赖TTL过期
+            await async_error_logger.error(f"Failed to publish near-cache invalidation for {keys}: {e}")
+
+    def start_near_cache_listener(self):
+        if self.near_cache is not None and self._near_cache_task is None:
+            self._near_cache_task = asyncio.create_task(self._listen_invalidations())
+
+    async def _listen_invalidations(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = self._redis.pubsub()
+                await pubsub.subscribe(settings.REDIS_NEAR_CACHE_CHANNEL)
+                # 订阅建立前可能漏掉失效消息，先清空再开始提供缓存
+                self.near_cache.reset()
+                self.near_cache.connected = True
+                app_logger.info("Near-cache invalidation listener subscribed")
+                while True:
+                    message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if message is not None and message["type"] == "message":
+                        self.near_cache.handle_message(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await async_error_logger.error(f"Near-cache invalidation listener error: {e}")
+            finally:
+                self.near_cache.connected = False
+                self.near_cache.reset()
+                if pubsub is not None:
+                    await pubsub.close()
+            await asyncio.sleep(1)
+
+    def stats(self) -> Dict:
+        return {
+            "codec": self.codec.stats(),
+            "near_cache": self.near_cache.stats() if self.near_cache else None,
+            "loads": {"executed": self.load_flight.executed, "shared": self.load_flight.shared,
+                      "in_flight": len(self.load_flight)},
+        }
+
     async def health_check(self):
         try:
             return await self._redis.ping()
@@ -81,16 +307,62 @@ class RedisManager:
             error_logger.exception("Redis health check failed")
             return False
 
-    async def execute_pipeline(self, commands):
+    async def run_script(self, script: str, keys: List[str], args: List):
+        # 按脚本内容缓存Script对象，执行时走EVALSHA，未加载时自动回退到EVAL
+        async with self.get_connection() as conn:
+            registered = self._scripts.get(script)
+            if registered is None:
+                registered = self._scripts[script] = conn.register_script(script)
+            return await registered(keys=keys, args=args, client=conn)
+
+    @asynccontextmanager
+    async def lock(self, key: str, ttl: float, wait: Optional[float] = None, poll: float = 0.1):
+        """跨worker互斥锁：SET NX PX获取，持有期间每ttl/3续期一次，wait秒内拿不到锁时抛TimeoutError"""
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + (ttl if wait is None else wait)
         async with self.get_connection() as conn:
-            pipeline = conn.pipeline(transaction=False)
+            while not await conn.set(key, token, nx=True, px=int(ttl * 1000)):
+                if time.monotonic() >= deadline:
+                    raise TimeoutError(f"Timed out waiting for redis lock {key}")
+                await asyncio.sleep(poll)
+        renew = asyncio.ensure_future(self._renew_lock(key, token, ttl))
+        try:
+            yield token
+        finally:
+            renew.cancel()
+            try:
+                await self.run_script(RELEASE_LOCK_SCRIPT, [key], [token])
+            except Exception as e:
+                await async_error_logger.error(f"Failed to release redis lock {key}: {e}")
+
+    async def _renew_lock(self, key: str, token: str, ttl: float):
+        while True:
+            await asyncio.sleep(ttl / 3)
+            try:
+                if not await self.run_script(RENEW_LOCK_SCRIPT, [key], [token, int(ttl * 1000)]):
+                    await async_error_logger.error(f"Redis lock {key} was lost before release")
+                    return
+            except Exception as e:
+                await async_error_logger.error(f"Failed to renew redis lock {key}: {e}")
+
+    async def scan_keys(self, pattern: str, count: int = 1000):
+        async with self.get_connection() as conn:
+            async for key in conn.scan_iter(match=pattern, count=count):
+                yield key
+
+    async def execute_pipeline(self, commands, transaction: bool = False, raw: bool = False,
+                               raise_on_error: bool = True):
+        # raise_on_error=False时单条命令的错误以异常对象形式放在对应位置返回，不影响其他命令
+        async with self.get_connection(raw) as conn:
+            pipeline = conn.pipeline(transaction=transaction)
             for cmd, *args in commands:
                 getattr(pipeline, cmd)(*args)
-            return await pipeline.execute()
+            return await pipeline.execute(raise_on_error=raise_on_error)
 
 
 async def setup_redis():
     redis_manager = await RedisManager.get_instance()
+    redis_manager.start_near_cache_listener()
     app_logger.info("Redis setup completed")
     return redis_manager
 
@@ -0,0 +1,184 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from langchain_community.vectorstores.milvus import Milvus
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+from app.core.logger import async_error_logger
+
+
+def search_by_vectors(milvus: Milvus, vectors: List[List[float]], k: int,
+                      expr: Optional[str] = None) -> List[List[Tuple[Document, float]]]:
+    """一次nq>1的Milvus检索，结果格式与Milvus.similarity_search_with_score保持一致"""
+    if milvus.col is None or not vectors:
+        return [[] for _ in vectors]
+
+    output_fields = milvus.fields[:]
+    output_fields.remove(milvus._vector_field)
+    res = milvus.col.search(
+        data=vectors,
+        anns_field=milvus._vector_field,
+        param=milvus.search_params,
+        limit=k,
+        expr=expr,
+        output_fields=output_fields,
+        timeout=milvus.timeout,
+    )
+
+    results = []
+    for hits in res:
+        ret = []
+        for hit in hits:
+            data = {x: hit.entity.get(x) for x in output_fields}
+            ret.append((milvus._parse_document(data), hit.score))
+        results.append(ret)
+    return results
+
+
+SearchFn = Callable[[str, object, List[List[float]], int, Optional[str]], Awaitable[List[List]]]
+
+
+class _PendingSearch:
+    __slots__ = ("collection_name", "handle", "question", "k", "expr", "future")
+
+    def __init__(self, collection_name: str, handle, question: str, k: int, expr: Optional[str],
+                 future: asyncio.Future):
+        self.collection_name = collection_name
+        self.handle = handle
+        self.question = question
+        self.k = k
+        self.expr = expr
+        self.future = future
+
+
+class SearchBatcher:
+    """
+    合并短时间窗口内并发到达的检索请求：
+    一次embed_documents完成所有问题的向量化，每个collection只发起一次多向量检索，
+    再把结果分发回各自调用方的future。
+    """
+
+    def __init__(self, embeddings: Embeddings, search_fn: SearchFn, window_ms: float, max_batch_size: int):
+        self.embeddings = embeddings
+        # search_fn(collection_name, handle, vectors, k, expr)，由MilvusManager按线程池/异步模式提供
+        self.search_fn = search_fn
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.pending: List[_PendingSearch] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        # 正在执行的批次，保留引用避免被回收，关闭时取消
+        self.tasks = set()
+        self.closed = False
+
+        self.queries = 0
+        self.batches = 0
+        self.milvus_requests = 0
+        self.max_batch = 0
+
+    async def search(self, collection_name: str, handle, question: str, k: int,
+                     expr: Optional[str] = None) -> List[Tuple[Document, float]]:
+        if self.closed:
+            raise RuntimeError("SearchBatcher is closed")
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append(_PendingSearch(collection_name, handle, question, k, expr, future))
+
+        if len(self.pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.create_task(self._run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _run_batch(self, batch: List[_PendingSearch]):
+        try:
+            await self._execute(batch)
+        except asyncio.CancelledError:
+            self._fail(batch, RuntimeError("SearchBatcher is closed"))
+            raise
+        except Exception as e:
+            await async_error_logger.error(f"Batched search failed: {e}")
+            self._fail(batch, e)
+
+    async def _execute(self, batch: List[_PendingSearch]):
+        self.queries += len(batch)
+        self.batches += 1
+        self.max_batch = max(self.max_batch, len(batch))
+
+        questions = list(dict.fromkeys(item.question for item in batch))
+        try:
+            vectors = await self.embeddings.aembed_documents(questions)
+        except Exception as e:
+            await async_error_logger.error(f"Batched embedding of {len(questions)} queries failed: {e}")
+            self._fail(batch, e)
+            return
+        by_question = dict(zip(questions, vectors))
+
+        groups: Dict[Tuple[str, Optional[str]], List[_PendingSearch]] = {}
+        for item in batch:
+            groups.setdefault((item.collection_name, item.expr), []).append(item)
+
+        await asyncio.gather(*(self._search_group(items, by_question) for items in groups.values()))
+
+    async def _search_group(self, items: List[_PendingSearch], by_question: Dict[str, List[float]]):
+        questions = list(dict.fromkeys(item.question for item in items))
+        k = max(item.k for item in items)
+        self.milvus_requests += 1
+        try:
+            results = await self.search_fn(
+                items[0].collection_name,
+                items[0].handle,
+                [by_question[q] for q in questions],
+                k,
+                items[0].expr
+            )
+        except Exception as e:
+            await async_error_logger.error(f"Batched search on {items[0].collection_name} failed: {e}")
+            self._fail(items, e)
+            return
+
+        by_result = dict(zip(questions, results))
+        for item in items:
+            if not item.future.done():
+                item.future.set_result(by_result[item.question][:item.k])
+
+    @staticmethod
+    def _fail(items: List[_PendingSearch], error: Exception):
+        for item in items:
+            if not item.future.done():
+                item.future.set_exception(error)
+
+    async def close(self):
+        """未发出的请求直接失败，执行中的批次取消，等待中的调用方都会收到异常"""
+        self.closed = True
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self.pending = self.pending, []
+        self._fail(batch, RuntimeError("SearchBatcher is closed"))
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict:
+        return {
+            "queries": self.queries,
+            "batches": self.batches,
+            "milvus_requests": self.milvus_requests,
+            "avg_batch_size": self.queries / self.batches if self.batches else 0.0,
+            "max_batch_size": self.max_batch,
+            "pending": len(self.pending),
+            "running": len(self.tasks),
+        }
@@ -0,0 +1,109 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """线程安全的LRU缓存，支持容量上限、可选TTL以及命中/淘汰统计"""
+
+    def __init__(self, max_size: int, ttl: Optional[float] = None,
+                 on_evict: Optional[Callable[[Hashable, Any], None]] = None, refresh_on_get: bool = False):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_evict = on_evict
+        # 为True时TTL按最后一次访问计算（空闲过期）
+        self.refresh_on_get = refresh_on_get
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        evicted = None
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, stored_at = item
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                self.expirations += 1
+                evicted = (key, value)
+            else:
+                self._data.move_to_end(key)
+                if self.refresh_on_get:
+                    self._data[key] = (value, time.monotonic())
+                self.hits += 1
+                return value
+        self._notify_evict([evicted])
+        return default
+
+    def peek(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            return default if item is None else item[0]
+
+    def age(self, key: Hashable) -> Optional[float]:
+        with self._lock:
+            item = self._data.get(key)
+            return None if item is None else time.monotonic() - item[1]
+
+    def set(self, key: Hashable, value: Any):
+        evicted = []
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+            self._data[key] = (value, time.monotonic())
+            while len(self._data) > self.max_size:
+                old_key, (old_value, _) = self._data.popitem(last=False)
+                self.evictions += 1
+                evicted.append((old_key, old_value))
+        self._notify_evict(evicted)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            item = self._data.pop(key, None)
+        return default if item is None else item[0]
+
+    def clear(self):
+        with self._lock:
+            evicted = [(key, value) for key, (value, _) in self._data.items()]
+            self._data.clear()
+        self._notify_evict(evicted)
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            return key in self._data
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _notify_evict(self, evicted):
+        if self.on_evict is None:
+            return
+        for item in evicted:
+            if item is not None:
+                self.on_evict(*item)
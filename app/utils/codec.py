@@ -0,0 +1,132 @@
+import ast
+import json
+from typing import Any, Dict, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 每个值的第一个字节标记格式，旧版本写入的纯文本JSON（无标记）仍可读取
+TAG_JSON = 0x01
+TAG_JSON_ZSTD = 0x02
+TAG_MSGPACK = 0x03
+TAG_MSGPACK_ZSTD = 0x04
+ZSTD_TAGS = (TAG_JSON_ZSTD, TAG_MSGPACK_ZSTD)
+
+SERIALIZERS = ("json", "orjson", "msgpack")
+
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _json_loads(data: Union[bytes, str]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_legacy(data: Union[bytes, str]) -> Any:
+    """读取无格式标记的旧数据：json.dumps写入的JSON，或str(list)写入的Python字面量"""
+    text = data.decode("utf-8") if isinstance(data, bytes) else data
+    try:
+        return json.loads(text)
+    except ValueError:
+        pass
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+
+class Codec:
+    """
+    Redis值的序列化层。
+    serializer: json（旧格式，无标记的文本JSON，兼容老版本读取方）、orjson、msgpack；
+    编码后超过compress_threshold字节且安装了zstandard时再做zstd压缩。
+    """
+
+    def __init__(self, serializer: str = "orjson", compress_threshold: Optional[int] = 1024, zstd_level: int = 3):
+        if serializer not in SERIALIZERS:
+            raise ValueError(f"Unknown codec serializer: {serializer}")
+        if serializer == "msgpack" and msgpack is None:
+            serializer = "orjson"
+        self.serializer = serializer
+        self.compress_threshold = compress_threshold if zstandard is not None else None
+        self.zstd_level = zstd_level
+        self._compressor = zstandard.ZstdCompressor(level=zstd_level) if zstandard is not None else None
+        self._decompressor = zstandard.ZstdDecompressor() if zstandard is not None else None
+
+        self.encoded = 0
+        self.decoded = 0
+        self.compressed = 0
+        self.legacy_decoded = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def encode(self, obj: Any) -> Union[bytes, str]:
+        self.encoded += 1
+        if self.serializer == "json":
+            # 灰度期间保持旧格式，老版本实例仍能读取
+            return json.dumps(obj, ensure_ascii=False)
+
+        if self.serializer == "msgpack":
+            payload, tag, zstd_tag = msgpack.packb(obj, use_bin_type=True), TAG_MSGPACK, TAG_MSGPACK_ZSTD
+        else:
+            payload, tag, zstd_tag = _json_dumps(obj), TAG_JSON, TAG_JSON_ZSTD
+        self.bytes_in += len(payload)
+        if self.compress_threshold is not None and len(payload) > self.compress_threshold:
+            compressed = self._compressor.compress(payload)
+            if len(compressed) < len(payload):
+                self.compressed += 1
+                payload, tag = compressed, zstd_tag
+        self.bytes_out += len(payload) + 1
+        return bytes((tag,)) + payload
+
+    def decode(self, data: Union[bytes, str, None]) -> Any:
+        if data is None:
+            return None
+        self.decoded += 1
+        if isinstance(data, str):
+            self.legacy_decoded += 1
+            return decode_legacy(data)
+        if not data:
+            return data.decode("utf-8")
+
+        tag, payload = data[0], data[1:]
+        if tag in ZSTD_TAGS:
+            if self._decompressor is None:
+                raise RuntimeError("zstandard is required to decode compressed values")
+            payload = self._decompressor.decompress(payload)
+        if tag in (TAG_JSON, TAG_JSON_ZSTD):
+            return _json_loads(payload)
+        if tag in (TAG_MSGPACK, TAG_MSGPACK_ZSTD):
+            if msgpack is None:
+                raise RuntimeError("msgpack is required to decode msgpack values")
+            return msgpack.unpackb(payload, raw=False)
+        self.legacy_decoded += 1
+        return decode_legacy(data)
+
+    def stats(self) -> Dict:
+        return {
+            "serializer": self.serializer,
+            "compress_threshold": self.compress_threshold,
+            "encoded": self.encoded,
+            "decoded": self.decoded,
+            "compressed": self.compressed,
+            "legacy_decoded": self.legacy_decoded,
+            "compression_ratio": self.bytes_out / self.bytes_in if self.bytes_in else 1.0,
+        }
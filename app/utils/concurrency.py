@@ -0,0 +1,111 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """同一key的并发调用只真正执行一次，其余调用方等待同一个future"""
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+        self.executed = 0
+        self.shared = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            self.executed += 1
+            # 放到独立task中执行，发起方被取消时不影响其他等待者
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            self.shared += 1
+        return await asyncio.shield(task)
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    def forget(self, key: Hashable):
+        """之后的调用重新执行，不再复用进行中的结果（已在等待的调用方不受影响）"""
+        self._calls.pop(key, None)
+
+    def _forget(self, key: Hashable, task: asyncio.Future):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def __len__(self) -> int:
+        return len(self._calls)
+
+
+class _RWState:
+    __slots__ = ("cond", "readers", "writer", "waiting_writers", "refs")
+
+    def __init__(self):
+        self.cond = asyncio.Condition()
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+        self.refs = 0
+
+
+class KeyedRWLock:
+    """按key区分的异步读写锁：读可并发，写独占且优先于后来的读，空闲时自动回收"""
+
+    def __init__(self):
+        self._states: Dict[Hashable, _RWState] = {}
+
+    def _enter(self, key: Hashable) -> _RWState:
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _RWState()
+        state.refs += 1
+        return state
+
+    def _exit(self, key: Hashable, state: _RWState):
+        state.refs -= 1
+        if state.refs == 0 and self._states.get(key) is state:
+            del self._states[key]
+
+    @asynccontextmanager
+    async def read(self, key: Hashable):
+        state = self._enter(key)
+        try:
+            async with state.cond:
+                await state.cond.wait_for(lambda: not state.writer and state.waiting_writers == 0)
+                state.readers += 1
+            try:
+                yield
+            finally:
+                async with state.cond:
+                    state.readers -= 1
+                    state.cond.notify_all()
+        finally:
+            self._exit(key, state)
+
+    @asynccontextmanager
+    async def write(self, key: Hashable):
+        state = self._enter(key)
+        try:
+            async with state.cond:
+                state.waiting_writers += 1
+                try:
+                    await state.cond.wait_for(lambda: not state.writer and state.readers == 0)
+                finally:
+                    state.waiting_writers -= 1
+                    # 等待被取消时需要唤醒被挡住的读者
+                    state.cond.notify_all()
+                state.writer = True
+            try:
+                yield
+            finally:
+                async with state.cond:
+                    state.writer = False
+                    state.cond.notify_all()
+        finally:
+            self._exit(key, state)
+
+    def __len__(self) -> int:
+        return len(self._states)
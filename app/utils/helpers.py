@@ -5,13 +5,16 @@ from functools import wraps
 
 
 # 异步重试装饰器
-def async_retry(retries=3, delay=1):
+def async_retry(retries=3, delay=1, no_retry=()):
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, **kwargs):
             for attempt in range(retries):
                 try:
                     return await func(*args, **kwargs)
+                except no_retry:
+                    # 限流等错误重试只会放大突发，直接抛出
+                    raise
                 except Exception as e:
                     if attempt == retries - 1:  # 最后一次尝试
                         await async_error_logger.error(f"All retry attempts failed: {str(e)}")
@@ -0,0 +1,89 @@
+import json
+from typing import Any, Optional, Tuple
+
+
+class JsonFieldExtractor:
+    """
+    增量解析流式返回的JSON对象，顶层字段field的值完整后立即返回，不必等整个对象结束。
+    只跟踪括号深度和字符串状态，不做完整校验；取到的值交给json.loads解析。
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.buffer = []
+        self.length = 0
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.string_start = -1
+        self.last_key: Optional[str] = None
+        self.expect_key = False
+        self.value_start = -1
+        self.text = ""
+        self.done = False
+        self.value: Any = None
+
+    def feed(self, chunk: str) -> Tuple[bool, Any]:
+        """返回(是否已取到, 值)"""
+        if self.done:
+            return True, self.value
+        start = self.length
+        self.buffer.append(chunk)
+        self.length += len(chunk)
+        self.text = "".join(self.buffer) if len(self.buffer) > 1 else chunk
+        self.buffer = [self.text]
+        for i in range(start, self.length):
+            if self._step(i, self.text[i]):
+                return True, self.value
+        return False, None
+
+    def _step(self, i: int, ch: str) -> bool:
+        if self.in_string:
+            if self.escaped:
+                self.escaped = False
+            elif ch == "\\":
+                self.escaped = True
+            elif ch == '"':
+                self.in_string = False
+                if self.depth == 1 and self.expect_key:
+                    self.last_key = json.loads(self.text[self.string_start:i + 1])
+                    self.expect_key = False
+                elif self.depth == 1 and self.value_start >= 0:
+                    # 顶层字段的值是字符串
+                    return self._resolve(i + 1)
+            return False
+
+        if ch == '"':
+            self.in_string = True
+            self.string_start = i
+        elif ch in "{[":
+            self.depth += 1
+            if self.depth == 1:
+                self.expect_key = True
+        elif ch in "}]":
+            if self.depth == 2 and self.value_start >= 0:
+                self.depth -= 1
+                return self._resolve(i + 1)
+            if self.depth == 1 and self.value_start >= 0:
+                # 顶层字段的值是数字、true/false/null，遇到对象结束
+                return self._resolve(i)
+            self.depth -= 1
+        elif self.depth == 1:
+            if ch == ":" and self.last_key == self.field:
+                self.value_start = i + 1
+            elif ch == ",":
+                if self.value_start >= 0:
+                    return self._resolve(i)
+                self.expect_key = True
+                self.last_key = None
+        return False
+
+    def _resolve(self, end: int) -> bool:
+        try:
+            self.value = json.loads(self.text[self.value_start:end])
+        except ValueError:
+            self.value_start = -1
+            self.last_key = None
+            return False
+        self.done = True
+        return True
@@ -0,0 +1,89 @@
+# benchmarks/redis_codec_benchmark.py
+"""
+对比Redis值编码方式的存储字节数和编解码耗时，样本为模拟的聊天数据：
+recent chat整块数据（旧布局）、单条消息（list布局）、important memories列表。
+
+python -m benchmarks.redis_codec_benchmark [--records 14] [--iterations 2000]
+"""
+import argparse
+import json
+import random
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from app.utils.codec import Codec, msgpack, orjson, zstandard
+
+SAMPLE_SENTENCES = [
+    "今天天气不错，我们要不要一起去海边走走？",
+    "I just checked the charts, $DOGE is up 12% since this morning!",
+    "你还记得上次我们聊到的那本书吗？我已经读完第三章了。",
+    "Honestly I think the market is overreacting, let's wait for the weekly close.",
+    "哈哈哈，你说得对，我下次一定早点睡 😴",
+    "Can you remind me what my favourite coffee order was?",
+    "我最近在学吉他，手指好痛，但是很开心。",
+    "Tell me a story about a shiba inu who travels to the moon.",
+]
+
+
+def make_message(i: int) -> Dict[str, Any]:
+    content = " ".join(random.choice(SAMPLE_SENTENCES) for _ in range(random.randint(1, 6)))
+    return {"timestamp": f"2024-11-0{i % 9 + 1} 12:{i % 60:02d}:00", "role": random.choice(["user", "assistant"]),
+            "content": content}
+
+
+def make_samples(records: int) -> Dict[str, Any]:
+    random.seed(42)
+    return {
+        "recent_blob": {
+            "chat_history": [make_message(i) for i in range(records)],
+            "character_name": "Doge",
+            "scene": "beach",
+        },
+        "message": make_message(0),
+        "important_memories": [random.choice(SAMPLE_SENTENCES) for _ in range(20)],
+    }
+
+
+def bench(fn: Callable, arg, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(arg)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def codecs() -> List[Tuple[str, Callable, Callable]]:
+    items = [("json (legacy)", lambda v: json.dumps(v).encode("utf-8"), json.loads)]
+    variants = [("orjson", None)]
+    if msgpack is not None:
+        variants.append(("msgpack", None))
+    if zstandard is not None:
+        variants += [("orjson", 512), ("msgpack", 512)] if msgpack is not None else [("orjson", 512)]
+    for serializer, threshold in variants:
+        codec = Codec(serializer, compress_threshold=threshold)
+        name = serializer + (f"+zstd(>{threshold}B)" if threshold else "")
+        items.append((name, codec.encode, codec.decode))
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Redis payload codecs on chat-like data")
+    parser.add_argument("--records", type=int, default=14)
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"orjson={'yes' if orjson else 'no'} msgpack={'yes' if msgpack else 'no'} "
+          f"zstandard={'yes' if zstandard else 'no'}")
+    samples = make_samples(args.records)
+    for sample_name, value in samples.items():
+        print(f"\n== {sample_name} ==")
+        print(f"{'codec':<24}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+        for name, encode, decode in codecs():
+            encoded = encode(value)
+            size = len(encoded.encode("utf-8") if isinstance(encoded, str) else encoded)
+            encode_us = bench(encode, value, args.iterations)
+            decode_us = bench(decode, encoded, args.iterations)
+            print(f"{name:<24}{size:>8}{encode_us:>12.2f}{decode_us:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# worker_doge.py
+# 独立部署的聊天记录写入worker：消费Redis Stream中的post-turn事件并批量写入Milvus
+# 使用时API进程设置 CHAT_WRITE_WORKER_IN_PROCESS=no
+
+import asyncio
+import signal
+import sys
+
+from app.core.config import settings
+from app.core.logger import app_logger, error_logger, async_app_logger
+from app.memory.chat_write_pipeline import setup_chat_write_workers
+from app.storage.redis_manager import setup_redis
+from app.storage.milvus_manager import setup_milvus
+
+
+async def run_workers():
+    redis_manager = await setup_redis()
+    milvus_manager = await setup_milvus(
+        settings.OPENAI_APIKEY,
+        redis=redis_manager,
+        host=settings.MILVUS_HOST,
+        port=settings.MILVUS_PORT
+    )
+    workers = await setup_chat_write_workers(redis_manager, milvus_manager)
+
+    stop_event = asyncio.Event()
+    if sys.platform != "win32":
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        await workers.stop()
+        await milvus_manager.close()
+        await redis_manager.close()
+        await async_app_logger.info(f"Chat write workers shut down: {workers.stats()}")
+
+
+if __name__ == "__main__":
+    app_logger.info("Starting chat write workers")
+    try:
+        asyncio.run(run_workers())
+    except KeyboardInterrupt:
+        pass
+    except Exception as e:
+        error_logger.exception(f"Chat write workers crashed: {str(e)}")
+        raise